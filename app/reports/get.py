@@ -13,20 +13,160 @@
 
 """Get the emails, parse them and store what needs to be sent."""
 
+import concurrent.futures
+import contextlib
+import functools
 import imaplib
+import itertools
 import logging
 import os
 import pymongo
+import queue
+import re
 import sys
+import threading
 
 import utils
 import utils.db
 import utils.emails
+import utils.imap
+import utils.journal
+import utils.lmtp
+import utils.maildir
+import utils.publicinbox
+import utils.seen
 
 # pylint: disable=invalid-name
 log = logging.getLogger("kernelci-reports")
 
 DEFAULT_MAIL_FOLDER = "/var/lib/kernelci-reports"
+DEFAULT_SEEN_FILE = "/var/cache/kernelci-reports/seen.bloom"
+DEFAULT_JOURNAL_FILE = "/var/spool/kernelci-reports/journal.sqlite"
+# Seconds between checks of the stop event while watching the Maildir.
+MAILDIR_WAIT = 1.0
+
+# How messages are retrieved from the IMAP server: "headers" fetches only the
+# header block of all the new messages with a single FETCH command, "full"
+# fetches the complete messages one by one.
+FETCH_MODE_HEADERS = "headers"
+FETCH_MODE_FULL = "full"
+FETCH_MODES = [FETCH_MODE_HEADERS, FETCH_MODE_FULL]
+
+# How new messages are found on the IMAP server: "unseen" looks for messages
+# without the \Seen flag, "uid" looks for messages with a UID bigger than the
+# last one checked.
+SYNC_MODE_UNSEEN = "unseen"
+SYNC_MODE_UID = "uid"
+SYNC_MODES = [SYNC_MODE_UNSEEN, SYNC_MODE_UID]
+
+DEFAULT_MAILBOX = "INBOX"
+# The options defining a mail account, not shared with the other accounts.
+MAIL_ACCOUNT_KEYS = [
+    utils.MAIL_FOLDER,
+    utils.MAIL_FOLDERS,
+    utils.MAIL_PASSWORD,
+    utils.MAIL_SERVER,
+    utils.MAIL_SERVER_PORT,
+    utils.MAIL_USERNAME
+]
+# How many mail sources to check at the same time.
+DEFAULT_MAIL_WORKERS = 4
+# How many emails are retrieved, parsed and saved at once.
+DEFAULT_BATCH_SIZE = 500
+# Seconds between checks of the abort event while a batch is being saved.
+STREAM_WAIT = 1.0
+
+# Seconds between attempts to save the journaled emails, doubled each time
+# the database cannot be reached up to the maximum.
+FLUSH_INTERVAL = 5.0
+MAX_FLUSH_INTERVAL = 300.0
+# Seconds to wait for the database when checking if emails are known.
+HANDLED_TIMEOUT = 5.0
+
+# Outcome of saving each parsed email.
+SAVE_NEW = "new"
+SAVE_DUPLICATE = "duplicate"
+SAVE_ERROR = "error"
+
+DUPLICATE_KEY_ERROR = 11000
+# An index with the same keys but other options already exists.
+INDEX_OPTIONS_CONFLICT = 85
+
+STATUS_UIDS_RGX = re.compile(
+    br"(UIDVALIDITY|UIDNEXT)\s+(\d+)", re.IGNORECASE)
+
+# The Message-Ids that have already been handled, checked before parsing
+# the emails. Disabled until load_seen() is called.
+SEEN = utils.seen.SeenSet()
+# The parsed emails waiting to be saved. Disabled until open_journal() is
+# called.
+JOURNAL = utils.journal.Journal()
+
+
+def _remove_duplicates(collection, keys):
+    """Remove the documents with the same keys, keeping the first one.
+
+    :param collection: The database collection.
+    :param keys: The index keys.
+    :type keys: list
+    :return int The number of removed documents.
+    """
+    duplicates = collection.aggregate(
+        [
+            {"$sort": {"_id": pymongo.ASCENDING}},
+            {
+                "$group": {
+                    "_id": dict((key, "$" + key) for key, _ in keys),
+                    "ids": {"$push": "$_id"},
+                    "count": {"$sum": 1}
+                }
+            },
+            {"$match": {"count": {"$gt": 1}}}
+        ],
+        allowDiskUse=True
+    )
+
+    removed = 0
+    for duplicate in duplicates:
+        removed += collection.delete_many(
+            {"_id": {"$in": duplicate["ids"][1:]}}).deleted_count
+
+    return removed
+
+
+def _create_unique_index(collection, keys):
+    """Create a unique index, removing the duplicate documents if needed.
+
+    :param collection: The database collection.
+    :param keys: The index keys.
+    :type keys: list
+    """
+    try:
+        collection.create_index(keys, unique=True, background=True)
+    except pymongo.errors.OperationFailure as ex:
+        if ex.code != DUPLICATE_KEY_ERROR:
+            raise
+        log.warning(
+            "Removed %d duplicate documents to create unique index on %s",
+            _remove_duplicates(collection, keys), keys)
+        collection.create_index(keys, unique=True, background=True)
+
+
+def _ensure_unique_index(collection, keys):
+    """Create a unique index, replacing a non unique one on the same keys.
+
+    :param collection: The database collection.
+    :param keys: The index keys.
+    :type keys: list
+    """
+    try:
+        _create_unique_index(collection, keys)
+    except pymongo.errors.OperationFailure as ex:
+        if ex.code != INDEX_OPTIONS_CONFLICT:
+            raise
+        log.info("Replacing non unique index on %s", keys)
+        collection.drop_index(keys)
+        _create_unique_index(collection, keys)
 
 
 def ensure_indexes(options):
@@ -37,162 +177,1204 @@ def ensure_indexes(options):
     """
     log.debug("Creating/Updating database indexes...")
     connection = utils.db.get_connection(options)
-    try:
-        database = connection[utils.db.DB_NAME]
+    database = connection[utils.db.DB_NAME]
 
-        if database:
-            database[utils.db.DB_CHECK_QUEUE].create_index(
-                [
-                    ("message_id", pymongo.ASCENDING),
-                    ("subject", pymongo.ASCENDING)
-                ],
-                background=True
-            )
-        else:
-            log.error("No database connection found, cannot continue")
-            sys.exit(1)
-    finally:
-        connection.close()
+    if database is not None:
+        _ensure_unique_index(
+            database[utils.db.DB_CHECK_QUEUE],
+            [
+                ("message_id", pymongo.ASCENDING),
+                ("subject", pymongo.ASCENDING)
+            ]
+        )
+    else:
+        log.error("No database connection found, cannot continue")
+        sys.exit(1)
+
+
+def _save_results(data, result, write_errors):
+    """Build the outcome of each write of the bulk operation.
+
+    :param data: The documents to save.
+    :type data: list
+    :param result: The upserted documents, as {index: _id}.
+    :type result: dict
+    :param write_errors: The write errors of the bulk operation.
+    :type write_errors: list
+    :return list The outcome of each document.
+    """
+    outcomes = [SAVE_DUPLICATE] * len(data)
+
+    for idx in result:
+        outcomes[idx] = SAVE_NEW
+
+    for error in write_errors:
+        # Duplicate key errors come from concurrent inserts of the same
+        # document: it is already in the database.
+        if error.get("code") != DUPLICATE_KEY_ERROR:
+            log.error(
+                "Error saving report with Message-Id '%s': %s",
+                data[error["index"]]["message_id"], error.get("errmsg"))
+            outcomes[error["index"]] = SAVE_ERROR
+
+    for message, outcome in zip(data, outcomes):
+        if outcome == SAVE_NEW:
+            log.debug(
+                "Saved report with Message-Id '%s': '%s'",
+                message["message_id"], message["subject"])
+        elif outcome == SAVE_DUPLICATE:
+            log.info(
+                "Similar report found with Message-Id '%s': %s",
+                message["message_id"], message["subject"])
+
+    return outcomes
 
 
 def save(options, data):
     """Save the parsed email into the database.
 
+    All the emails are saved with a single unordered bulk write of upserts,
+    keyed on the Message-Id and the subject: emails already in the database
+    are not saved again.
+
     :param options: The options read from the command line and the config.
     :type options: dict
     :param data: List of dictionaries to save.
     :type data: list
+    :return list The outcome for each dictionary: SAVE_NEW, SAVE_DUPLICATE
+    or SAVE_ERROR.
+    :raise pymongo.errors.PyMongoError if the database cannot be reached.
     """
+    outcomes = []
+
     if data:
+        log.debug("Saving parsed emails")
+        connection = utils.db.get_connection(options)
+        database = connection[utils.db.DB_NAME]
+
+        requests = [
+            pymongo.UpdateOne(
+                {
+                    "message_id": message["message_id"],
+                    "subject": message["subject"]
+                },
+                {"$setOnInsert": message},
+                upsert=True
+            )
+            for message in data
+        ]
+
         try:
-            log.debug("Saving parsed emails")
-            connection = utils.db.get_connection(options)
-            database = connection[utils.db.DB_NAME]
-
-            if database:
-                for message in data:
-                    msg_id = message["message_id"]
-                    subject = message["subject"]
-
-                    prev_doc = database[utils.db.DB_CHECK_QUEUE].find_one(
-                        {"message_id": msg_id, "subject": subject},
-                        projection={
-                            "_id": False, "message_id": True, "subject": True}
-                    )
-
-                    if not prev_doc:
-                        log.debug(
-                            "Saving report with Message-Id '%s': '%s'",
-                            msg_id, subject)
-                        database[utils.db.DB_CHECK_QUEUE].insert_many(
-                            data, ordered=False)
-                    else:
-                        log.info(
-                            "Similar report found with Message-Id '%s': %s",
-                            msg_id, subject)
-            else:
-                log.error(
-                    "No database connection found, parsed data will be lost")
-                sys.exit(1)
-        finally:
-            connection.close()
+            result = database[utils.db.DB_CHECK_QUEUE].bulk_write(
+                requests, ordered=False)
+            upserted = result.upserted_ids
+            write_errors = []
+        except pymongo.errors.BulkWriteError as ex:
+            upserted = dict(
+                (doc["index"], doc["_id"])
+                for doc in ex.details.get("upserted", []))
+            write_errors = ex.details.get("writeErrors", [])
 
+        outcomes = _save_results(data, upserted, write_errors)
+        SEEN.add(
+            message["message_id"]
+            for message, outcome in zip(data, outcomes)
+            if outcome != SAVE_ERROR
+        )
 
-def check_from_server(options):
-    """Check for new emails via IMAP protocol.
+    return outcomes
+
+
+def open_journal(options):
+    """Open the journal of the parsed emails waiting to be saved.
+
+    :param options: The configuration options.
+    :type options: dict
+    """
+    JOURNAL.open(
+        options.get(utils.JOURNAL_FILE, None) or DEFAULT_JOURNAL_FILE)
+
+
+def enqueue(options, data):
+    """Store the parsed emails to be saved into the database.
+
+    If the journal is open, the emails are appended to it and saved later by
+    flush_journal(): the database being slow or unreachable does not slow
+    down or lose them. Otherwise they are saved right away.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param data: List of dictionaries to save.
+    :type data: list
+    """
+    if not data:
+        return
+
+    if JOURNAL.enabled:
+        JOURNAL.append(data)
+    else:
+        save(options, data)
+
+
+def flush(options):
+    """Save all the journaled emails into the database, in batches.
+
+    Entries are removed from the journal only once saved: if interrupted,
+    they are saved again and found as duplicates.
+
+    :param options: The configuration options.
+    :type options: dict
+    :return int The number of entries removed from the journal.
+    :raise pymongo.errors.PyMongoError if the database cannot be reached.
+    """
+    flushed = 0
+
+    while True:
+        entries = JOURNAL.peek(_batch_size(options))
+        if not entries:
+            break
+
+        save(options, [document for _, document in entries])
+        # Documents that could not be saved are logged by save(): they would
+        # fail again.
+        JOURNAL.remove([entry_id for entry_id, _ in entries])
+        flushed += len(entries)
+
+    if flushed:
+        log.debug("Saved %d journaled emails", flushed)
+
+    return flushed
+
+
+def flush_journal(options, stop):
+    """Save the journaled emails as soon as they are appended.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param stop: The event used to stop flushing.
+    :type stop: threading.Event
+    """
+    interval = FLUSH_INTERVAL
+
+    while not stop.is_set():
+        if not JOURNAL.appended.wait(interval):
+            continue
+        JOURNAL.appended.clear()
+
+        try:
+            flush(options)
+            interval = FLUSH_INTERVAL
+        except pymongo.errors.PyMongoError:
+            log.warning(
+                "Cannot save the journaled emails, %d waiting, retrying in "
+                "%s seconds", JOURNAL.count(), interval)
+            JOURNAL.appended.set()
+            stop.wait(interval)
+            interval = min(interval * 2, MAX_FLUSH_INTERVAL)
+
+
+def _seen_file(options):
+    """Get the path of the file where the seen Message-Ids are stored."""
+    return options.get(utils.SEEN_FILE, None) or DEFAULT_SEEN_FILE
+
+
+def load_seen(options):
+    """Load the already handled Message-Ids.
+
+    They are read from the file written by store_seen(), or collected from
+    the database if the file is not available.
+
+    :param options: The configuration options.
+    :type options: dict
+    """
+    if SEEN.load(_seen_file(options)):
+        return
+
+    log.info("Collecting the already handled Message-Ids...")
+    connection = utils.db.get_connection(options)
+    database = connection[utils.db.DB_NAME]
+    queued = database[utils.db.DB_CHECK_QUEUE]
+    processed = database[utils.db.DB_PROCESSED]
+
+    capacity = 2 * (
+        queued.estimated_document_count() +
+        processed.estimated_document_count())
+
+    message_ids = itertools.chain(
+        (doc.get("message_id") for doc in queued.find(
+            {}, projection={"message_id": True, "_id": False})),
+        (doc["_id"] for doc in processed.find(
+            {}, projection={"_id": True}))
+    )
+    SEEN.rebuild(
+        message_ids,
+        capacity=max(capacity, utils.seen.DEFAULT_CAPACITY))
+
+
+def store_seen(options):
+    """Store the already handled Message-Ids, to be loaded at restart.
+
+    :param options: The configuration options.
+    :type options: dict
+    """
+    SEEN.dump(_seen_file(options))
+
+
+def _handled(options, message_ids):
+    """Find which Message-Ids have been saved in the database.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param message_ids: The Message-Ids to look for.
+    :type message_ids: list
+    :return set The Message-Ids found.
+    """
+    connection = utils.db.get_connection(options)
+    database = connection[utils.db.DB_NAME]
+
+    try:
+        with pymongo.timeout(HANDLED_TIMEOUT):
+            found = set(
+                doc["message_id"]
+                for doc in database[utils.db.DB_CHECK_QUEUE].find(
+                    {"message_id": {"$in": message_ids}},
+                    projection={"message_id": True, "_id": False})
+            )
+            found.update(
+                doc["_id"]
+                for doc in database[utils.db.DB_PROCESSED].find(
+                    {"_id": {"$in": message_ids}}, projection={"_id": True})
+            )
+    except pymongo.errors.PyMongoError:
+        # Parsing the emails again is harmless, saving them is idempotent.
+        log.warning("Cannot check for already handled emails")
+        found = set()
+
+    return found
+
+
+def _unseen(options, messages):
+    """Drop the messages that have already been handled.
+
+    The seen set is checked first: only the Message-Ids it might contain
+    are looked for in the database, with a single query.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param messages: The raw header blocks.
+    :type messages: list
+    :return list The header blocks of the messages not handled yet.
+    """
+    if not SEEN.enabled or not messages:
+        return messages
+
+    message_ids = [utils.emails.message_id(message) for message in messages]
+    maybe_seen = sorted(set(
+        message_id for message_id in message_ids
+        if message_id and SEEN.might_contain(message_id)))
+
+    if not maybe_seen:
+        return messages
+
+    handled = _handled(options, maybe_seen)
+    if handled:
+        log.info("Skipping %d already handled emails", len(handled))
+
+    return [
+        message for message, message_id in zip(messages, message_ids)
+        if message_id not in handled
+    ]
+
+
+def _message_set(msg_ids):
+    """Build an IMAP message set out of a list of message numbers.
+
+    Consecutive numbers are collapsed into ranges, so that [1, 2, 3, 5]
+    becomes "1:3,5".
+
+    :param msg_ids: The message numbers.
+    :type msg_ids: list
+    :return str The message set.
+    """
+    ranges = []
+
+    for msg_id in sorted(int(x) for x in msg_ids):
+        if ranges and ranges[-1][1] == msg_id - 1:
+            ranges[-1][1] = msg_id
+        else:
+            ranges.append([msg_id, msg_id])
+
+    return ",".join(
+        str(start) if start == end else "{0:d}:{1:d}".format(start, end)
+        for start, end in ranges
+    )
+
+
+def _fetch(server, use_uid, message_set, parts):
+    """Run a FETCH command, by message number or by UID."""
+    if use_uid:
+        return server.uid("FETCH", message_set, parts)
+    return server.fetch(message_set, parts)
+
+
+def _fetch_headers(server, message_set, use_uid=False):
+    """Retrieve the header block of all the messages in the set.
+
+    The BODY.PEEK item is used so that the messages are not marked as seen.
+
+    :param server: The IMAP connection.
+    :type server: imaplib.IMAP4
+    :param message_set: The IMAP message set to fetch.
+    :type message_set: str
+    :param use_uid: If the message set is made of UIDs.
+    :type use_uid: bool
+    :return list A list of (message number, headers) tuples.
+    """
+    headers = []
+
+    status, response = _fetch(
+        server, use_uid, message_set, "(BODY.PEEK[HEADER])")
+    if status == "OK":
+        for part in response:
+            # The literal data comes as a (envelope, data) tuple, while the
+            # closing parenthesis of each message is returned as bytes.
+            if isinstance(part, tuple):
+                headers.append((part[0].split(None, 1)[0], part[1]))
+    else:
+        log.error("Error fetching messages '%s'", message_set)
+
+    return headers
+
+
+def _parse(options, messages):
+    """Parse the header blocks with the configured process pool.
+
+    Messages that have already been handled are not parsed.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param messages: The raw header blocks.
+    :type messages: list
+    :return list The parsed data of each message not handled yet.
+    """
+    return utils.emails.parse_many(
+        _unseen(options, messages),
+        parser=utils.emails.parse_headers,
+        workers=options.get(utils.PARSE_WORKERS, None),
+        threshold=options.get(utils.PARSE_THRESHOLD, None))
+
+
+def _check_headers(options, server, msg_ids, use_uid=False):
+    """Parse the new messages looking only at their headers.
+
+    All the headers are retrieved with one FETCH command.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param server: The IMAP connection.
+    :type server: imaplib.IMAP4
+    :param msg_ids: The message numbers, or UIDs, to check.
+    :type msg_ids: list
+    :param use_uid: If the messages are identified by UID.
+    :type use_uid: bool
+    :return tuple A list with the parsed emails data, and the list of the
+    message numbers that have been retrieved.
+    """
+    message_set = _message_set(msg_ids)
+
+    log.debug("Retrieving headers for %d messages", len(msg_ids))
+    headers = _fetch_headers(server, message_set, use_uid)
+    parsed_emails = _parse(options, [header for _, header in headers])
+
+    return (
+        [email_data for email_data in parsed_emails if email_data],
+        [msg_id for msg_id, _ in headers]
+    )
+
+
+def _check_full(options, server, msg_ids, use_uid=False):
+    """Parse the new messages fetching them one by one.
+
+    The BODY.PEEK item is used so that the messages are not marked as seen.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param server: The IMAP connection.
+    :type server: imaplib.IMAP4
+    :param msg_ids: The message numbers, or UIDs, to check.
+    :type msg_ids: list
+    :param use_uid: If the messages are identified by UID.
+    :type use_uid: bool
+    :return tuple A list with the parsed emails data, and the list of the
+    message numbers, or UIDs, that have been retrieved.
+    """
+    messages = []
+    fetched = []
+
+    for msg_id in msg_ids:
+        status, message = _fetch(server, use_uid, msg_id, "(BODY.PEEK[])")
+
+        if status == "OK" and message and isinstance(message[0], tuple):
+            messages.append(utils.emails.split_headers(message[0][1]))
+            fetched.append(msg_id)
+        else:
+            log.error("Error fetching message with ID '%s'", msg_id)
+
+    parsed_emails = _parse(options, messages)
+
+    return (
+        [email_data for email_data in parsed_emails if email_data],
+        fetched
+    )
+
+
+def _is_full_fetch(options):
+    """Check if the complete messages have to be fetched."""
+    return options.get(
+        utils.MAIL_FETCH_MODE, FETCH_MODE_HEADERS) == FETCH_MODE_FULL
+
+
+def _check_messages(options, server, msg_ids, use_uid=False):
+    """Retrieve and parse the messages as configured by the fetch mode.
+
+    :return tuple A list with the parsed emails data, and the list of the
+    messages that have been retrieved.
+    """
+    if _is_full_fetch(options):
+        return _check_full(options, server, msg_ids, use_uid)
+    return _check_headers(options, server, msg_ids, use_uid)
+
+
+def _batch_size(options):
+    """Get the maximum number of emails handled at once."""
+    return int(options.get(utils.BATCH_SIZE, None) or DEFAULT_BATCH_SIZE)
+
+
+def _batches(items, size):
+    """Split a list into lists of at most the provided size."""
+    for idx in range(0, len(items), size):
+        yield items[idx:idx + size]
+
+
+def _search_criteria(options):
+    """Get the configured SEARCH criteria used to filter messages.
+
+    :param options: The configuration options.
+    :type options: dict
+    :return list The search criteria, empty if filtering is disabled.
+    """
+    criteria = options.get(utils.MAIL_SEARCH, None)
+    if criteria is None:
+        criteria = utils.emails.SEARCH_CRITERIA
+
+    return [criteria] if criteria.strip() else []
+
+
+def _sync_unseen(options, server):
+    """Check the messages that are not flagged as seen.
+
+    Once a batch has been saved, the messages that have been retrieved are
+    flagged as seen: the others are checked again the next time.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param server: The IMAP connection.
+    :type server: imaplib.IMAP4
+    :return A generator of lists with the parsed emails data.
+    """
+    server.select(utils.imap.quote(_mailbox(options)))
+
+    log.debug("Retrieving new messages...")
+    status, messages = server.search(
+        None, "UNSEEN", *_search_criteria(options))
+    if status == "OK":
+        msg_ids = messages[0].split()
+        if not msg_ids:
+            log.debug("No new messages found")
+
+        for batch in _batches(msg_ids, _batch_size(options)):
+            parsed_emails, fetched = _check_messages(options, server, batch)
+            yield parsed_emails
+
+            if fetched:
+                server.store(_message_set(fetched), "+FLAGS", "\\Seen")
+
+
+def _mailbox_uids(server, mailbox):
+    """Get the UIDVALIDITY and UIDNEXT values of the selected mail box.
+
+    They are usually sent by the server in reply to the SELECT command, if
+    not they are asked with a STATUS command.
+
+    :return tuple The UIDVALIDITY and UIDNEXT values as integers.
+    """
+    _, uidvalidity = server.response("UIDVALIDITY")
+    _, uidnext = server.response("UIDNEXT")
+
+    if uidvalidity[-1] is None or uidnext[-1] is None:
+        status, response = server.status(mailbox, "(UIDVALIDITY UIDNEXT)")
+        if status != "OK":
+            raise imaplib.IMAP4.error(
+                "Cannot retrieve UID values of '{0:s}'".format(mailbox))
+
+        values = STATUS_UIDS_RGX.findall(response[0])
+        values = dict((key.upper(), value) for key, value in values)
+        uidvalidity = [values[b"UIDVALIDITY"]]
+        uidnext = [values[b"UIDNEXT"]]
+
+    return int(uidvalidity[-1]), int(uidnext[-1])
+
+
+def _sync_uid(options, server):
+    """Check the messages received after the last synchronization.
+
+    The UIDVALIDITY of the mail box and the highest UID checked are stored in
+    the database: only messages with a bigger UID are searched for. When
+    there is no valid state, the unseen messages are checked and the state is
+    initialized.
+
+    Message flags are never modified. The state is updated each time a
+    batch has been saved.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param server: The IMAP connection.
+    :type server: imaplib.IMAP4
+    :return A generator of lists with the parsed emails data.
+    """
+    mailbox = utils.imap.quote(_mailbox(options))
+    state_id = source_id(options)
+
+    server.select(mailbox)
+    uidvalidity, uidnext = _mailbox_uids(server, mailbox)
+    # Messages received after the SELECT command will have a UID at least
+    # equal to the UIDNEXT value, and will be checked the next time.
+    high_uid = uidnext - 1
+
+    state = load_sync_state(options, state_id)
+    if state and state["uidvalidity"] == uidvalidity:
+        last_uid = state["last_uid"]
+        criteria = []
+    else:
+        log.info(
+            "No valid UID state for '%s', checking unseen messages",
+            state_id)
+        last_uid = 0
+        criteria = ["UNSEEN"]
+
+    if last_uid < high_uid:
+        criteria.extend(
+            ["UID", "{0:d}:{1:d}".format(last_uid + 1, high_uid)])
+        criteria.extend(_search_criteria(options))
+        status, messages = server.uid("SEARCH", *criteria)
+    else:
+        status, messages = "OK", [b""]
 
-    Will only check the default 'INBOX' mail box.
+    if status == "OK":
+        # Searching for a UID range always returns the last message, even
+        # if its UID is not in the range.
+        uids = sorted(
+            (uid for uid in messages[0].split()
+             if last_uid < int(uid) <= high_uid),
+            key=int)
+        if not uids:
+            log.debug("No new messages found")
+
+        for batch in _batches(uids, _batch_size(options)):
+            yield _check_messages(options, server, batch, use_uid=True)[0]
+            save_sync_state(options, state_id, uidvalidity, int(batch[-1]))
+
+        save_sync_state(options, state_id, uidvalidity, high_uid)
+    else:
+        log.error("Error searching messages in '%s'", mailbox)
+
+
+def _mailbox(options):
+    """Get the name of the mail box to check."""
+    return options.get(utils.MAIL_FOLDER, None) or DEFAULT_MAILBOX
+
+
+def source_id(options):
+    """Build the ID of a mail source: user@server/folder.
+
+    The ID is also used for the synchronization state of the mail box.
+
+    :param options: The options of the mail source.
+    :type options: dict
+    :return str The mail source ID.
+    """
+    return "{0:s}@{1:s}/{2:s}".format(
+        options[utils.MAIL_USERNAME], options[utils.MAIL_SERVER],
+        _mailbox(options))
+
+
+def mail_sources(options):
+    """Build the list of mail boxes to check on the IMAP servers.
+
+    The main account is defined by the mail_* options, more accounts can be
+    listed in the mail_accounts option, each one as a dictionary with its
+    own mail_* options. The other options, as the database ones, are shared
+    by all the accounts, the account options are not: an account without
+    a password or folders does not use the main account ones, an account
+    without a server uses the default IMAP server and port. Each folder of
+    each account is a separate source.
+
+    :param options: The configuration options.
+    :type options: dict
+    :return list A list of options dictionaries, one for each source.
+    """
+    sources = []
+    accounts = []
+
+    if options.get(utils.MAIL_USERNAME, None):
+        accounts.append(options)
+
+    shared = dict(
+        (key, value) for key, value in options.items()
+        if key not in MAIL_ACCOUNT_KEYS)
+    # The same defaults of the main account.
+    shared[utils.MAIL_SERVER] = utils.DEFAULT_IMAP_SERVER
+    shared[utils.MAIL_SERVER_PORT] = utils.DEFAULT_IMAP_PORT
+    for account in options.get(utils.MAIL_ACCOUNTS, None) or []:
+        account_options = dict(shared)
+        account_options.update(account)
+        accounts.append(account_options)
+
+    for account_options in accounts:
+        folders = account_options.get(utils.MAIL_FOLDERS, None) or \
+            DEFAULT_MAILBOX
+        for folder in folders.split(","):
+            if folder.strip():
+                source = dict(account_options)
+                source[utils.MAIL_FOLDER] = folder.strip()
+                sources.append(source)
+
+    return sources
+
+
+def load_sync_state(options, state_id):
+    """Load the synchronization state of a mail box.
 
     :param options: The configuration options.
     :type options: dict
-    :return list A list with the parsed emails data.
+    :param state_id: The ID of the mail box state.
+    :type state_id: str
+    :return dict The state with the 'uidvalidity' and 'last_uid' keys, or
+    None if not found.
     """
-    log.info("Checking emails from server")
+    connection = utils.db.get_connection(options)
+    return connection[utils.db.DB_NAME][utils.db.DB_MAIL_STATE].find_one(
+        {"_id": state_id})
 
+
+def save_sync_state(options, state_id, uidvalidity, last_uid):
+    """Store the synchronization state of a mail box.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param state_id: The ID of the mail box state.
+    :type state_id: str
+    :param uidvalidity: The UIDVALIDITY value of the mail box.
+    :type uidvalidity: int
+    :param last_uid: The highest UID that has been checked.
+    :type last_uid: int
+    """
+    connection = utils.db.get_connection(options)
+    connection[utils.db.DB_NAME][utils.db.DB_MAIL_STATE].update_one(
+        {"_id": state_id},
+        {"$set": {"uidvalidity": uidvalidity, "last_uid": last_uid}},
+        upsert=True
+    )
+
+
+def save_inbox_state(options, state_id, last_commit):
+    """Store the last commit read from a public-inbox repository.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param state_id: The ID of the repository state.
+    :type state_id: str
+    :param last_commit: The ID of the last commit read.
+    :type last_commit: str
+    """
+    connection = utils.db.get_connection(options)
+    connection[utils.db.DB_NAME][utils.db.DB_MAIL_STATE].update_one(
+        {"_id": state_id},
+        {"$set": {"last_commit": last_commit}},
+        upsert=True
+    )
+
+
+def _skip_repository(options, repository, state_id):
+    """Start reading a repository from its last commit."""
+    until = utils.publicinbox.head(repository)
+    if until is not None:
+        log.info("Reading '%s' from its last commit", repository)
+        save_inbox_state(options, state_id, until)
+
+
+def _check_repository(options, repository, state_id, since):
+    """Parse the messages added to a repository after a commit.
+
+    The state is updated each time a batch has been saved.
+
+    :return A generator of lists with the parsed emails data.
+    """
+    until = utils.publicinbox.head(repository)
+    if until is None or until == since:
+        log.debug("No new messages found")
+        return
+
+    commits = utils.publicinbox.new_messages(repository, since, until)
+    reader = utils.publicinbox.BlobReader(repository)
     try:
-        parsed_emails = []
-        server = imaplib.IMAP4_SSL(
-            host=options[utils.MAIL_SERVER],
-            port=options[utils.MAIL_SERVER_PORT])
-        server.login(
-            options[utils.MAIL_USERNAME], options[utils.MAIL_PASSWORD])
-
-        # Only check in the INBOX.
-        server.select()
-
-        log.debug("Retrieving new messages...")
-        status, messages = server.search(None, "(UNSEEN)")
-        if status == "OK":
-            for msg_id in messages[0].split():
-                status, message = server.fetch(msg_id, "(RFC822)")
-
-                if status == "OK":
-                    email_data = utils.emails.parse(message)
-                    if email_data:
-                        parsed_emails.append(email_data)
+        for batch in _batches(commits, _batch_size(options)):
+            messages = []
+            for _, blobs in batch:
+                for blob in blobs:
+                    message = reader.read(blob)
+                    if message is not None:
+                        messages.append(utils.emails.split_headers(message))
+
+            parsed_emails = _parse(options, messages)
+            yield [email_data for email_data in parsed_emails if email_data]
+
+            save_inbox_state(options, state_id, batch[-1][0])
+    finally:
+        reader.close()
+
+
+def check_from_public_inbox(options):
+    """Check for new emails in the local public-inbox archives.
+
+    Only the commits added after the last one read are walked. The first
+    time an archive is seen, reading starts from its last commit: the
+    existing messages are not read. New epochs of an archive already being
+    read are read from their first commit.
+
+    As with check_from_server(), the generator must be resumed only after
+    the previous batch has been saved.
+
+    :param options: The configuration options.
+    :type options: dict
+    :return A generator of lists with the parsed emails data.
+    """
+    archives = options.get(utils.PUBLIC_INBOXES, None) or ""
+
+    for archive in (path.strip() for path in archives.split(",")):
+        if not archive:
+            continue
+
+        log.info("Checking emails from public-inbox archive: %s", archive)
+        is_known = False
+
+        try:
+            for repository in utils.publicinbox.repositories(archive):
+                state_id = "public-inbox:{0:s}".format(
+                    os.path.abspath(repository))
+                state = load_sync_state(options, state_id)
+                since = state.get("last_commit") if state else None
+
+                if since is not None and \
+                        not utils.publicinbox.has_commit(repository, since):
+                    log.warning(
+                        "Last commit read not found in '%s', the archive "
+                        "has been rewritten", repository)
+                    _skip_repository(options, repository, state_id)
+                elif since is None and not is_known:
+                    _skip_repository(options, repository, state_id)
                 else:
-                    log.error("Error fetching message with ID '%s'", msg_id)
+                    yield from _check_repository(
+                        options, repository, state_id, since)
 
-        server.close()
-        server.logout()
+                is_known = is_known or since is not None
+        except utils.publicinbox.Error as ex:
+            log.error(
+                "Error checking emails from public-inbox archive: %s", ex)
 
-        return parsed_emails
-    except imaplib.IMAP4.error:
-        log.error("Error connecting to IMAP server, aborting.")
-        sys.exit(1)
 
+def check_from_server(options, session=None):
+    """Check for new emails via IMAP protocol.
+
+    Will only check the configured mail folder, by default 'INBOX'.
+
+    If a session is provided, its connection is used and left open so that
+    it can be reused, otherwise a new one is created and closed when done.
+
+    The emails are parsed in batches: the generator must be resumed only
+    after the previous batch has been saved, since the messages are then
+    marked as checked on the server.
+
+    :param options: The options of the mail source.
+    :type options: dict
+    :param session: A persistent IMAP session.
+    :type session: utils.imap.Session
+    :return A generator of lists with the parsed emails data.
+    """
+    log.info("Checking emails from server: %s", source_id(options))
+
+    is_shared = session is not None
+    if not is_shared:
+        session = utils.imap.Session(options)
 
-def check_from_system():
+    try:
+        server = session.connect()
+        if options.get(utils.MAIL_SYNC_MODE, SYNC_MODE_UNSEEN) == \
+                SYNC_MODE_UID:
+            yield from _sync_uid(options, server)
+        else:
+            yield from _sync_unseen(options, server)
+    except (imaplib.IMAP4.error, OSError):
+        log.error(
+            "Error checking emails from IMAP server: %s", source_id(options))
+        session.reset()
+    finally:
+        if not is_shared:
+            session.close()
+
+
+def _stream_source(source, session, batches, abort):
+    """Put the batches of a mail source in the queue.
+
+    Each batch is put together with an event, set when the batch has been
+    saved: only then the next batch is retrieved.
+    """
+    try:
+        with contextlib.closing(check_from_server(source, session)) as \
+                source_batches:
+            for batch in source_batches:
+                saved = threading.Event()
+                batches.put((batch, saved))
+
+                while not saved.wait(STREAM_WAIT):
+                    if abort.is_set():
+                        return
+    # pylint: disable=broad-except
+    except Exception:
+        log.exception("Error checking emails from %s", source_id(source))
+    finally:
+        batches.put(None)
+
+
+def check_from_servers(options, sessions=None):
+    """Check for new emails on all the mail sources.
+
+    The sources are checked concurrently, each one with its own connection:
+    an error with one of them does not prevent the others from being
+    checked.
+
+    As with check_from_server(), the generator must be resumed only after
+    the previous batch has been saved.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param sessions: The persistent IMAP sessions, indexed by source ID.
+    Missing sessions are added to it.
+    :type sessions: dict
+    :return A generator of lists with the parsed emails data.
+    """
+    sources = mail_sources(options)
+
+    if sources:
+        workers = min(
+            int(options.get(utils.MAIL_WORKERS, None) or
+                DEFAULT_MAIL_WORKERS),
+            len(sources))
+        batches = queue.Queue()
+        abort = threading.Event()
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for source in sources:
+                session = None
+                if sessions is not None:
+                    session = sessions.setdefault(
+                        source_id(source), utils.imap.Session(source))
+
+                executor.submit(
+                    _stream_source, source, session, batches, abort)
+
+            try:
+                running = len(sources)
+                while running:
+                    item = batches.get()
+                    if item is None:
+                        running -= 1
+                    else:
+                        batch, saved = item
+                        yield batch
+                        saved.set()
+            finally:
+                # Stop the sources if the batches are not consumed anymore.
+                abort.set()
+
+
+def _wait_for_source(options, session, stop):
+    """Wait with IDLE on a single mail source.
+
+    :return bool True if new emails have been notified.
+    """
+    has_new = False
+
+    try:
+        server = session.connect()
+        # IDLE works on the selected mail box.
+        server.select(utils.imap.quote(_mailbox(session.options)))
+        has_new = utils.imap.idle(
+            server, float(options[utils.CHECK_EVERY]), stop=stop)
+    except (imaplib.IMAP4.error, OSError):
+        log.warning(
+            "IMAP connection lost while idling: %s",
+            source_id(session.options))
+        session.reset()
+
+    if has_new:
+        # Wake up the other sources as well.
+        stop.set()
+
+    return has_new
+
+
+def wait_for_mail(options, sessions):
+    """Wait for new emails on the IMAP servers with the IDLE command.
+
+    All the sources are waited on at the same time, and the wait ends as
+    soon as one of them notifies new emails. The wait lasts at most the
+    configured check interval, so that the local mail directory is still
+    checked regularly.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param sessions: The persistent IMAP sessions, indexed by source ID.
+    :type sessions: dict
+    :return bool True if new emails have been notified.
+    """
+    stop = threading.Event()
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max(len(sessions), 1)) as executor:
+        futures = [
+            executor.submit(_wait_for_source, options, session, stop)
+            for session in sessions.values()
+        ]
+
+    return any(future.result() for future in futures)
+
+
+def supports_idle(options, sessions):
+    """Check if all the mail sources support the IDLE command.
+
+    Without mail sources there is nothing to wait on: IDLE is not supported.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param sessions: The persistent IMAP sessions, indexed by source ID.
+    Missing sessions are added to it.
+    :type sessions: dict
+    :return bool
+    """
+    sources = mail_sources(options)
+    if not sources:
+        log.warning("No IMAP server to wait on with IDLE")
+        return False
+
+    for source in sources:
+        session = sessions.setdefault(
+            source_id(source), utils.imap.Session(source))
+        if not utils.imap.has_idle(session.connect()):
+            log.warning("IMAP server does not support IDLE: %s",
+                        source_id(source))
+            return False
+
+    return True
+
+
+def _mail_directory(options):
+    """Get the path of the local mail directory."""
+    return options.get(utils.MAIL_DIRECTORY, None) or DEFAULT_MAIL_FOLDER
+
+
+def _check_files(options, paths, done):
+    """Parse email files in batches.
+
+    The generator must be resumed only after the previous batch has been
+    saved: only then the files of the batch are handed to the done
+    function.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param paths: The full paths of the email files.
+    :type paths: list
+    :param done: The function called with the path of each parsed file.
+    :type done: function
+    :return A generator of lists with the parsed emails data.
+    """
+    for batch in _batches(paths, _batch_size(options)):
+        parsed_paths = []
+        messages = []
+
+        for path in batch:
+            log.info("Parsing email from file %s", path)
+
+            headers = utils.emails.read_headers(path)
+            if headers is not None:
+                parsed_paths.append(path)
+                messages.append(headers)
+
+        parsed_emails = _parse(options, messages)
+        yield [email_data for email_data in parsed_emails if email_data]
+
+        for path in parsed_paths:
+            done(path)
+
+
+def _check_maildir(options, directory):
+    """Parse the messages delivered in the 'new' directory of a Maildir.
+
+    Parsed messages are moved into the 'cur' directory.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param directory: The Maildir path.
+    :type directory: str
+    :return A generator of lists with the parsed emails data.
+    """
+    return _check_files(
+        options,
+        utils.maildir.list_new(directory),
+        functools.partial(utils.maildir.mark_read, directory))
+
+
+def check_from_system(options=None):
     """Check if there are email files and read them.
 
-    :return list A list with the parsed emails data.
+    If the mail directory has the Maildir layout, only the messages in its
+    'new' directory are read. Otherwise all the files in the directory are
+    read, and then removed.
+
+    :param options: The configuration options.
+    :type options: dict
+    :return A generator of lists with the parsed emails data.
     """
-    parsed_emails = []
+    options = options or {}
+    directory = _mail_directory(options)
+    paths = []
 
     log.info("Checking emails from local directory")
 
-    if os.path.isdir(DEFAULT_MAIL_FOLDER):
-        for entry in os.listdir(DEFAULT_MAIL_FOLDER):
-            path = os.path.join(DEFAULT_MAIL_FOLDER, entry)
+    if utils.maildir.is_maildir(directory):
+        return _check_maildir(options, directory)
+
+    if os.path.isdir(directory):
+        for entry in os.listdir(directory):
+            path = os.path.join(directory, entry)
             if all([not entry.startswith("."), os.path.isfile(path)]):
-                log.info("Parsing email from file %s", path)
+                paths.append(path)
+
+    return _check_files(options, paths, utils.emails.remove_file)
+
 
-                data = utils.emails.parse_from_file(path)
-                if data:
-                    parsed_emails.append(data)
+def watch_maildir(options, stop):
+    """Parse and save the messages as soon as they reach the Maildir.
+
+    The Maildir layout is created in the mail directory if needed.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param stop: The event used to stop watching.
+    :type stop: threading.Event
+    """
+    directory = _mail_directory(options)
+    utils.maildir.create(directory)
+
+    log.info("Watching for emails in %s", directory)
+    watcher = utils.maildir.Watcher(directory)
+    try:
+        # Messages delivered before the watch started are parsed as well.
+        changed = True
+        while not stop.is_set():
+            if changed:
+                for parsed_emails in _check_maildir(options, directory):
+                    enqueue(options, parsed_emails)
+
+            changed = watcher.wait(MAILDIR_WAIT)
+    finally:
+        watcher.close()
+
+
+def deliver(options, message):
+    """Parse and save an email delivered by the MTA.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param message: The complete email message.
+    :type message: bytes
+    :return bool False if the email could not be saved.
+    """
+    headers = _unseen(options, [utils.emails.split_headers(message)])
+    if not headers:
+        return True
+
+    email_data = utils.emails.parse_headers(headers[0])
+    if not email_data:
+        return True
+
+    return SAVE_ERROR not in save(options, [email_data])
+
+
+def listen(options, stop):
+    """Receive the emails from the MTA over LMTP or SMTP.
+
+    Each email is saved before its delivery is acknowledged.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param stop: The event used to stop listening.
+    :type stop: threading.Event
+    """
+    utils.lmtp.serve(
+        options[utils.LMTP_LISTEN], functools.partial(deliver, options), stop)
 
-    return parsed_emails
 
+def check(options, sessions=None):
+    """Check for new emails through the mail servers and on the filesystem.
 
-def check(options):
-    """Check for new emails through the mail server and on the filesystem.
+    Emails are retrieved and parsed in batches: the generator must be
+    resumed only after the previous batch has been saved.
 
     :param options: The configuration options.
     :type options: dict
-    :return list A list with the parsed emails data.
+    :param sessions: The persistent IMAP sessions, indexed by source ID.
+    :type sessions: dict
+    :return A generator of lists with the parsed emails data.
     """
     log.debug("Checking emails...")
 
-    parsed_emails = []
+    # The Maildir watcher takes care of the local emails.
+    if not options.get(utils.MAILDIR_WATCH, False):
+        yield from check_from_system(options)
 
-    parsed_emails.extend(check_from_system())
-    parsed_emails.extend(check_from_server(options))
+    yield from check_from_public_inbox(options)
 
-    return parsed_emails
+    yield from check_from_servers(options, sessions=sessions)
 
 
-def process(options, event):
+def process(options, event, sessions=None):
     """Execute the operations inside the event protected zone.
 
     :param options: The app configuration parameters.
     :type options: dict
     :param event: The even object used to synchronize.
     :type event: threading.Event
+    :param sessions: The persistent IMAP sessions, indexed by source ID.
+    :type sessions: dict
     """
     if event.is_set():
         try:
             event.clear()
-            save(options, check(options))
+            with contextlib.closing(check(options, sessions=sessions)) as \
+                    batches:
+                for parsed_emails in batches:
+                    enqueue(options, parsed_emails)
         finally:
             event.set()
     else:
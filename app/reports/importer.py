@@ -0,0 +1,163 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Import the emails of mbox files into the database."""
+
+import concurrent.futures
+import datetime
+import io
+import itertools
+import logging
+import mmap
+import os
+import time
+
+import reports.get
+import reports.send
+import utils
+import utils.emails
+import utils.mbox
+
+# pylint: disable=invalid-name
+log = logging.getLogger("kernelci-reports")
+
+# How many emails are parsed and saved at once.
+DEFAULT_BATCH_SIZE = 5000
+
+
+def _chunks(iterable, size):
+    """Split an iterable into lists of at most the provided size."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def _new_stats():
+    """Create the import counters."""
+    return {
+        "messages": 0,
+        "ignored": 0,
+        "expired": 0,
+        "queued": 0,
+        "duplicates": 0,
+        "errors": 0
+    }
+
+
+def _count_outcomes(stats, outcomes):
+    """Update the counters with the outcomes of a save."""
+    for outcome in outcomes:
+        if outcome == reports.get.SAVE_NEW:
+            stats["queued"] += 1
+        elif outcome == reports.get.SAVE_DUPLICATE:
+            stats["duplicates"] += 1
+        else:
+            stats["errors"] += 1
+
+
+def _pending(parsed_emails, now, stats):
+    """Keep only the emails that can still be sent before their deadline.
+
+    A report is sent by the backend reports.send.SEND_DELAY seconds after
+    it is asked to: the emails with a closer deadline would be expired as
+    soon as checked.
+    """
+    pending = []
+    limit = now + datetime.timedelta(seconds=reports.send.SEND_DELAY)
+
+    for email_data in parsed_emails:
+        if not email_data:
+            stats["ignored"] += 1
+        elif email_data["deadline"] <= limit:
+            stats["expired"] += 1
+        else:
+            pending.append(email_data)
+
+    return pending
+
+
+def _log_progress(path, stats, elapsed):
+    """Log how many messages have been imported, and how fast."""
+    log.info(
+        "%s: %d messages, %.0f messages/s (%d queued, %d duplicates, "
+        "%d expired, %d ignored, %d errors)",
+        path, stats["messages"], stats["messages"] / max(elapsed, 1e-6),
+        stats["queued"], stats["duplicates"], stats["expired"],
+        stats["ignored"], stats["errors"])
+
+
+def import_mbox(options, path, now=None):
+    """Import the emails of an mbox file.
+
+    The file is memory mapped, and only the header block of each message is
+    copied to be parsed. Emails are parsed by a pool of processes and saved
+    in batches. Saving a batch overlaps with parsing the next one. Emails
+    whose deadline has already passed are not saved.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param path: The mbox file path.
+    :type path: str
+    :param now: The time the deadlines are compared to, by default now.
+    :type now: datetime.datetime
+    :return dict The import counters.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    batch_size = int(
+        options.get(utils.BATCH_SIZE, None) or DEFAULT_BATCH_SIZE)
+    workers = int(
+        options.get(utils.PARSE_WORKERS, None) or os.cpu_count() or 1)
+    stats = _new_stats()
+
+    if os.path.getsize(path) == 0:
+        log.info("%s: empty file", path)
+        return stats
+
+    start = time.monotonic()
+    with io.open(path, mode="rb") as mbox_file, \
+            mmap.mmap(
+                mbox_file.fileno(), 0, access=mmap.ACCESS_READ) as mbox, \
+            utils.emails.parse_pool(workers) as parsers, \
+            concurrent.futures.ThreadPoolExecutor(1) as writer:
+        saving = None
+
+        for batch in _chunks(utils.mbox.messages(mbox), batch_size):
+            messages = [
+                utils.mbox.headers(mbox, msg_start, msg_end)
+                for msg_start, msg_end in batch
+            ]
+            parsed_emails = utils.emails.parse_many(
+                messages,
+                parser=utils.emails.parse_headers,
+                workers=workers,
+                threshold=options.get(utils.PARSE_THRESHOLD, None),
+                executor=parsers)
+
+            stats["messages"] += len(messages)
+            pending = _pending(parsed_emails, now, stats)
+
+            if saving is not None:
+                _count_outcomes(stats, saving.result())
+            saving = writer.submit(reports.get.save, options, pending)
+
+            _log_progress(path, stats, time.monotonic() - start)
+
+        if saving is not None:
+            _count_outcomes(stats, saving.result())
+
+    _log_progress(path, stats, time.monotonic() - start)
+
+    return stats
@@ -13,21 +13,110 @@
 
 """Check the queue in the database and the API, send reports."""
 
+import collections
+import concurrent.futures
+import contextlib
 import datetime
 import logging
+import os
+import pymongo
 import re
+import socket
+import threading
+import time
+import uuid
 
 import utils
 import utils.backend
 import utils.db
+import utils.timers
 
 # pylint: disable=invalid-name
 log = logging.getLogger("kernelci-reports")
 
 # Seconds to wait before the backend should send the email report.
 SEND_DELAY = 12600
+# How many reports are checked at the same time.
+DEFAULT_SEND_WORKERS = 8
+# How the job results are retrieved: with one request per report, or with
+# one request for all the reports of the same tree and branch.
+JOB_FETCH_MODE_REPORT = "report"
+JOB_FETCH_MODE_TREE = "tree"
+JOB_FETCH_MODES = [JOB_FETCH_MODE_REPORT, JOB_FETCH_MODE_TREE]
+# Maximum number of kernel versions asked with a single job request.
+MAX_TREE_VERSIONS = 50
+# Why a report is checked again later.
+RETRY_BUILD = "build"
+RETRY_NO_RESULTS = "no_results"
+RETRY_NO_BOOTS = "no_boots"
+RETRY_BACKEND_ERROR = "backend_error"
+RETRY_MAINTENANCE = "maintenance"
+# Seconds before checking a report again, for each retry reason: the first
+# delay, doubled at each attempt up to the maximum one.
+RETRY_BACKOFFS = {
+    RETRY_BUILD: (300, 1800),
+    RETRY_NO_RESULTS: (120, 3600),
+    RETRY_NO_BOOTS: (120, 1800),
+    RETRY_BACKEND_ERROR: (60, 900),
+    RETRY_MAINTENANCE: (600, 3600)
+}
+# Seconds before the last useful check of a report, at most, the next one
+# is scheduled.
+RETRY_MARGIN = 60
+# Why a report has been removed from the check queue, as recorded with its
+# Message-Id.
+OUTCOME_SENT = "sent"
+OUTCOME_FAILED = "failed"
+OUTCOME_EXPIRED = "expired"
+OUTCOME_DISCARDED = "discarded"
+# The counters of the queue statistics, for each outcome.
+OUTCOME_COUNTERS = {
+    OUTCOME_SENT: "sent",
+    OUTCOME_FAILED: "failed",
+    OUTCOME_EXPIRED: "expired_pending",
+    OUTCOME_DISCARDED: "discarded"
+}
+# Order in which the reports are checked: oldest first, or closest to the
+# deadline first.
+QUEUE_ORDER_CREATED = "created"
+QUEUE_ORDER_DEADLINE = "deadline"
+QUEUE_ORDERS = [QUEUE_ORDER_CREATED, QUEUE_ORDER_DEADLINE]
+# Error code of the writes violating a unique index.
+DUPLICATE_KEY_ERROR = 11000
+# How the reports are checked: all the due ones at fixed intervals, or each
+# one as soon as it is due.
+SEND_MODE_INTERVAL = "interval"
+SEND_MODE_SCHEDULER = "scheduler"
+SEND_MODE_STREAM = "stream"
+SEND_MODES = [SEND_MODE_INTERVAL, SEND_MODE_SCHEDULER, SEND_MODE_STREAM]
+# Seconds between looking for new reports when checking them as soon as they
+# are due.
+SCHEDULER_REFRESH = 60.0
+# The ID of the stored change stream resume token, in the mail state
+# collection.
+STREAM_STATE_ID = "check_queue_stream"
+# Seconds between saves of the change stream resume token.
+STREAM_SAVE_INTERVAL = 10.0
+# Seconds to wait before opening the change stream again after an error.
+STREAM_RETRY_DELAY = 30.0
+# Error codes of the change streams: not supported without a replica set,
+# and resume token not usable anymore.
+STREAM_NOT_SUPPORTED_ERRORS = [40573]
+STREAM_TOKEN_ERRORS = [260, 280, 286]
+# Seconds a report claimed by a process is reserved to it, when more
+# processes share the check queue.
+DEFAULT_LEASE_TIME = 300.0
+# How many reports a process claims at once.
+LEASE_BATCH_SIZE = 50
+# The fields of the queued reports used to check and send them.
+QUEUE_FIELDS = [
+    "tree", "branch", "version", "patches", "deadline", "attempts",
+    "message_id", "subject", "from", "to", "cc"
+]
 # TODO: need a better check for different git_describe format.
 GIT_DESCRIBE_MATCHER = r"^v{0:s}-{1:s}-g(.*)"
+# Kernel version and number of patches out of a git_describe value.
+GIT_DESCRIBE_RGX = re.compile(r"^v(?P<version>.+)-(?P<patches>\d+)-g")
 # Format string to re-build to from email address.
 FROM_ADR_FMT = "{0:s} <{1:s}>"
 # Format string for the reply message.
@@ -41,6 +130,542 @@ def _add_api_endpoint(url, endpoint):
     return url + endpoint
 
 
+class JobIndex(object):
+    """The job results of a tree, by kernel version and number of patches.
+
+    Both are taken from the git_describe value of the results, as it is
+    done to validate a result against a report.
+    """
+
+    def __init__(self, results=None):
+        self.results = collections.defaultdict(list)
+        if results:
+            self.update(results)
+
+    def update(self, results):
+        """Add job results to the index.
+
+        :param results: The job results from the backend.
+        :type results: list
+        """
+        for result in results:
+            git_describe = result.get("git_describe_v", None) or \
+                result.get("git_describe", None)
+            match = GIT_DESCRIBE_RGX.match(git_describe or "")
+            if match:
+                self.results[match.group("version", "patches")].append(
+                    result)
+
+    def lookup(self, report):
+        """Get the job results that might belong to a report.
+
+        :param report: The report as parsed from the email.
+        :type report: dict
+        :return list The job results.
+        """
+        results = []
+        for patches in report["patches"]:
+            results.extend(
+                self.results.get((report["version"], patches), []))
+        return results
+
+
+class QueueStats(object):
+    """Count what happened to the queued reports since the start.
+
+    Reports that reach their deadline while still in the check queue are
+    counted as expired_pending, reports claimed after the lease of another
+    process expired as taken_over.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.reset()
+
+    def reset(self):
+        """Set all the counters to zero."""
+        with self.lock:
+            self.counters = dict(
+                (counter, 0) for counter in OUTCOME_COUNTERS.values())
+            self.counters["rescheduled"] = 0
+            self.counters["taken_over"] = 0
+
+    def count(self, counter, value=1):
+        """Increase a counter.
+
+        :param counter: The counter name.
+        :type counter: str
+        :param value: How much to add.
+        :type value: int
+        """
+        with self.lock:
+            self.counters[counter] += value
+
+    def snapshot(self):
+        """Get the current counters.
+
+        :return dict The counters.
+        """
+        with self.lock:
+            return dict(self.counters)
+
+
+STATS = QueueStats()
+
+
+class Outcomes(object):
+    """The writes on the check queue decided while checking the reports.
+
+    Reports are checked concurrently, each one adding its own writes. They
+    are sent to the database at the end, with a single unordered bulk write
+    per collection.
+
+    The sent reports are the exception: with a database, they are removed
+    right after being sent, so that a crash before the end of the cycle does
+    not send them again. A crash between sending a report and removing it
+    still sends it again at the next check: reports are sent at least once.
+
+    With a lease, the reports are only written if still claimed by this
+    process, and their claim ends with the writes.
+    """
+
+    def __init__(self, lease=None, database=None):
+        self.lease = lease
+        self.database = database
+        self.lock = threading.Lock()
+        self.queue = []
+        self.processed = []
+        self.removed = 0
+        self.rescheduled = 0
+        self.counters = collections.Counter()
+        # The next check time of the rescheduled reports, by ID.
+        self.next_checks = {}
+        # The IDs of the removed reports.
+        self.done = set()
+
+    def remove(self, report, outcome):
+        """Remove a report from the check queue.
+
+        Its Message-Id is recorded as processed, so that the email is not
+        queued again if delivered again.
+
+        :param report: The report as parsed from the email.
+        :type report: dict
+        :param outcome: Why the report is removed, one of the OUTCOME_ values.
+        :type outcome: str
+        """
+        processed = []
+        if report.get("message_id", None):
+            processed.append(pymongo.UpdateOne(
+                {"_id": report["message_id"]},
+                {
+                    "$set": {
+                        "processed_on": datetime.datetime.utcnow(),
+                        "outcome": outcome
+                    }
+                },
+                upsert=True
+            ))
+        queue = [pymongo.DeleteOne(self._spec(report))]
+
+        if outcome == OUTCOME_SENT and self.database is not None:
+            try:
+                _bulk_write(self.database[utils.db.DB_PROCESSED], processed)
+                _bulk_write(self.database[utils.db.DB_CHECK_QUEUE], queue)
+                processed, queue = [], []
+            except pymongo.errors.PyMongoError:
+                log.exception(
+                    "Error removing sent report with Message-Id '%s'",
+                    report.get("message_id"))
+
+        with self.lock:
+            self.processed.extend(processed)
+            self.queue.extend(queue)
+            self.removed += 1
+            self.counters[OUTCOME_COUNTERS[outcome]] += 1
+            self.done.add(report["_id"])
+
+    def _spec(self, report):
+        """Get the filter of the writes on a report."""
+        spec = {"_id": report["_id"]}
+        if self.lease is not None:
+            spec["lease_owner"] = self.lease.owner
+        return spec
+
+    def confirm(self, report):
+        """Check that a report can still be sent by this process.
+
+        :param report: The report as parsed from the email.
+        :type report: dict
+        :return bool True if the report is still claimed, or if there is no
+        lease.
+        """
+        return self.lease is None or self.lease.renew_one(report)
+
+    def reschedule(self, report, next_check):
+        """Set when a report is checked again.
+
+        :param report: The report as parsed from the email.
+        :type report: dict
+        :param next_check: When the report is checked again.
+        :type next_check: datetime.datetime
+        """
+        with self.lock:
+            document = {
+                "$set": {"next_check_at": next_check},
+                "$inc": {"attempts": 1}
+            }
+            if self.lease is not None:
+                document["$unset"] = {"lease_owner": ""}
+
+            self.queue.append(
+                pymongo.UpdateOne(self._spec(report), document))
+            self.rescheduled += 1
+            self.counters["rescheduled"] += 1
+            self.next_checks[report["_id"]] = next_check
+
+    def write(self, database):
+        """Write all the outcomes into the database.
+
+        The processed Message-Ids are written before the reports are removed
+        from the check queue.
+
+        :param database: The database connection.
+        :raise pymongo.errors.PyMongoError if the database cannot be reached.
+        """
+        with self.lock:
+            processed, self.processed = self.processed, []
+            queue, self.queue = self.queue, []
+            counters, self.counters = self.counters, collections.Counter()
+
+        _bulk_write(database[utils.db.DB_PROCESSED], processed)
+        _bulk_write(database[utils.db.DB_CHECK_QUEUE], queue)
+
+        for counter, value in counters.items():
+            STATS.count(counter, value)
+
+
+class Lease(object):
+    """Claims of queued reports, so that more processes share the queue.
+
+    A report is claimed by setting its owner and moving its next check time
+    to the end of the lease: other processes see it as not due. If the owner
+    does not reschedule or remove it before the end of the lease, because it
+    died or lost the database, the report becomes due again and another
+    process takes it over.
+
+    The leases of the reports being checked are renewed in the background.
+    """
+
+    def __init__(self, options, duration=DEFAULT_LEASE_TIME, owner=None):
+        self.options = options
+        self.duration = duration
+        self.owner = owner or "{0:s}:{1:d}:{2:s}".format(
+            socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lock = threading.Lock()
+        self.held = set()
+
+    def _collection(self):
+        """Get the check queue collection."""
+        connection = utils.db.get_connection(self.options)
+        return connection[utils.db.DB_NAME][utils.db.DB_CHECK_QUEUE]
+
+    def _expires(self):
+        """Get the end of a lease starting now."""
+        return datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=self.duration)
+
+    def claim(self, order=QUEUE_ORDER_CREATED, spec=None,
+              limit=LEASE_BATCH_SIZE):
+        """Claim due reports, one at a time.
+
+        :param order: The order of the reports, one of QUEUE_ORDERS.
+        :type order: str
+        :param spec: Filter to restrict the reports to claim.
+        :type spec: dict
+        :param limit: How many reports to claim at most.
+        :type limit: int
+        :return list The claimed reports.
+        """
+        collection = self._collection()
+
+        claimed = []
+        for _ in range(limit):
+            query, sort = _due_query(datetime.datetime.utcnow(), order)
+            if spec:
+                query = {"$and": [query, spec]}
+
+            report = collection.find_one_and_update(
+                query,
+                {
+                    "$set": {
+                        "next_check_at": self._expires(),
+                        "lease_owner": self.owner
+                    }
+                },
+                projection=QUEUE_FIELDS + ["lease_owner"],
+                sort=sort,
+                return_document=pymongo.ReturnDocument.BEFORE
+            )
+            if report is None:
+                break
+
+            previous_owner = report.pop("lease_owner", None)
+            if previous_owner not in (None, self.owner):
+                log.info(
+                    "Taking over report with Message-Id '%s' from %s",
+                    report.get("message_id"), previous_owner)
+                STATS.count("taken_over")
+
+            claimed.append(report)
+
+        with self.lock:
+            self.held.update(report["_id"] for report in claimed)
+
+        return claimed
+
+    def renew(self):
+        """Extend the leases of all the claimed reports.
+
+        :return int The number of leases still held.
+        """
+        with self.lock:
+            held = list(self.held)
+
+        if not held:
+            return 0
+
+        renewed = self._collection().update_many(
+            {"_id": {"$in": held}, "lease_owner": self.owner},
+            {"$set": {"next_check_at": self._expires()}}
+        ).matched_count
+        if renewed < len(held):
+            log.warning("Lost %d report leases", len(held) - renewed)
+
+        return renewed
+
+    def renew_one(self, report):
+        """Extend the lease of a report, checking that it is still held.
+
+        :param report: The report.
+        :type report: dict
+        :return bool True if the report is still claimed by this process.
+        """
+        renewed = self._collection().update_one(
+            {"_id": report["_id"], "lease_owner": self.owner},
+            {"$set": {"next_check_at": self._expires()}}
+        ).matched_count == 1
+        if not renewed:
+            log.warning(
+                "Lease lost for report with Message-Id '%s'",
+                report.get("message_id"))
+
+        return renewed
+
+    def release(self, report_ids):
+        """Stop renewing the leases of reports.
+
+        Reports still claimed, because their check failed, are checked again
+        by any process when their lease expires.
+
+        :param report_ids: The IDs of the reports.
+        :type report_ids: list
+        """
+        with self.lock:
+            self.held.difference_update(report_ids)
+
+    @contextlib.contextmanager
+    def renewing(self):
+        """Renew the leases in the background, a few times per lease."""
+        stop = threading.Event()
+
+        def _renew():
+            while not stop.wait(self.duration / 3.0):
+                try:
+                    self.renew()
+                # pylint: disable=broad-except
+                except Exception:
+                    log.exception("Error renewing the report leases")
+
+        thread = threading.Thread(target=_renew, daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
+
+
+def _bulk_write(collection, requests):
+    """Write requests with an unordered bulk write, logging the failures.
+
+    Duplicate keys are not failures: reports with the same Message-Id can be
+    removed during the same cycle.
+    """
+    if requests:
+        try:
+            collection.bulk_write(requests, ordered=False)
+        except pymongo.errors.BulkWriteError as ex:
+            errors = [
+                error for error in ex.details.get("writeErrors", [])
+                if error.get("code") != DUPLICATE_KEY_ERROR
+            ]
+            if errors:
+                log.error(
+                    "%d writes failed on '%s': %s",
+                    len(errors), collection.name, errors[0].get("errmsg"))
+
+
+def expire_reports(database, now):
+    """Remove the reports that cannot be sent before their deadline.
+
+    Everything is done by the database: the Message-Ids of the expired
+    reports are recorded as processed, then the reports are deleted.
+
+    :param database: The database connection.
+    :param now: The current time.
+    :type now: datetime.datetime
+    :return int The number of removed reports.
+    """
+    # The backend sends the report SEND_DELAY seconds after it is asked to.
+    limit = now + datetime.timedelta(seconds=SEND_DELAY)
+    expired = {"deadline": {"$lte": limit}}
+
+    database[utils.db.DB_CHECK_QUEUE].aggregate([
+        {"$match": dict(expired, message_id={"$ne": None})},
+        {
+            "$project": {
+                "_id": "$message_id",
+                "processed_on": {"$literal": now},
+                "outcome": {"$literal": OUTCOME_EXPIRED}
+            }
+        },
+        {
+            "$merge": {
+                "into": utils.db.DB_PROCESSED,
+                "whenMatched": "merge",
+                "whenNotMatched": "insert"
+            }
+        }
+    ])
+
+    deleted = database[utils.db.DB_CHECK_QUEUE].delete_many(
+        expired).deleted_count
+    STATS.count(OUTCOME_COUNTERS[OUTCOME_EXPIRED], deleted)
+
+    return deleted
+
+
+def queue_stats():
+    """Get the statistics of the check queue since the start.
+
+    :return dict The counters.
+    """
+    return STATS.snapshot()
+
+
+def ensure_indexes(options):
+    """Make sure the database indexes used to check the queue are setup.
+
+    :param options: The database connection parameters.
+    :type options: dict
+    """
+    log.debug("Creating/Updating check queue indexes...")
+    connection = utils.db.get_connection(options)
+    collection = connection[utils.db.DB_NAME][utils.db.DB_CHECK_QUEUE]
+    collection.create_index(
+        [("next_check_at", pymongo.ASCENDING)], background=True)
+    collection.create_index([("deadline", pymongo.ASCENDING)], background=True)
+    collection.create_index(
+        [
+            ("deadline", pymongo.ASCENDING),
+            ("next_check_at", pymongo.ASCENDING)
+        ],
+        background=True
+    )
+
+
+def reschedule(outcomes, report, reason):
+    """Schedule the next check of a report, with an exponential backoff.
+
+    The next check is never scheduled after the last moment the report can
+    still be sent. When that moment has passed, the report is checked again
+    when it expires.
+
+    :param outcomes: The outcomes of the checked reports.
+    :type outcomes: Outcomes
+    :param report: The report as parsed from the email.
+    :type report: dict
+    :param reason: Why the report is checked again, one of RETRY_BACKOFFS.
+    :type reason: str
+    """
+    attempts = report.get("attempts", None) or 0
+    first, maximum = RETRY_BACKOFFS[reason]
+    delay = min(first * 2 ** attempts, maximum)
+
+    now = datetime.datetime.utcnow()
+    next_check = now + datetime.timedelta(seconds=delay)
+    if report.get("deadline", None):
+        expires = report["deadline"] - datetime.timedelta(seconds=SEND_DELAY)
+        next_check = min(
+            next_check, expires - datetime.timedelta(seconds=RETRY_MARGIN))
+        if next_check <= now:
+            next_check = expires
+
+    log.debug(
+        "Checking report with Message-Id '%s' again at %s (%s)",
+        report.get("message_id"), next_check, reason)
+    outcomes.reschedule(report, next_check)
+
+
+def _due_spec(now):
+    """Get the filter of the reports due at a time."""
+    return {
+        "$or": [
+            {"next_check_at": None},
+            {"next_check_at": {"$lte": now}}
+        ]
+    }
+
+
+def _due_query(now, order):
+    """Get the filter and the sort of the due reports, in an order."""
+    spec = _due_spec(now)
+
+    if order == QUEUE_ORDER_DEADLINE:
+        spec["deadline"] = {
+            "$gt": now + datetime.timedelta(seconds=SEND_DELAY)}
+        sort = [("deadline", pymongo.ASCENDING)]
+    else:
+        sort = [("created_on", pymongo.ASCENDING)]
+
+    return spec, sort
+
+
+def due_reports(database, order=QUEUE_ORDER_CREATED):
+    """Get the queued reports that need to be checked now.
+
+    Reports never checked before have no next check time and are due.
+
+    With the deadline order, the reports closest to the last moment they can
+    be sent, their deadline minus SEND_DELAY, come first. SEND_DELAY being
+    the same for all of them, they are sorted by deadline with the
+    (deadline, next_check_at) index. Reports that cannot be sent anymore are
+    left out.
+
+    :param database: The database connection.
+    :param order: The order of the reports, one of QUEUE_ORDERS.
+    :type order: str
+    :return A pymongo.cursor.Cursor of reports, with only the fields needed
+    to check and send them.
+    """
+    spec, sort = _due_query(datetime.datetime.utcnow(), order)
+
+    return database[utils.db.DB_CHECK_QUEUE].find(
+        spec, projection=QUEUE_FIELDS, sort=sort)
+
+
 def check_boots(result, options):
     """Verify there are boot reports in the backend.
 
@@ -162,146 +787,732 @@ def is_valid_result(result, report):
     return is_valid
 
 
-# pylint: disable=too-many-branches
-def handle_result(response, report, database, options):
-    """Handle the results as obtained from the backend.
+def _find_valid_result(results, report):
+    """Get the first result matching the report, if any."""
+    for result in results:
+        if is_valid_result(result, report):
+            return result
+    return None
 
-    Check the status code of the response and apply the correct logic.
-    It will update the 'retries' field only if the status is 200 and we don't
-    have any results.
 
-    :param response: The response from the backend.
+def handle_job_results(results, report, outcomes, options):
+    """Handle the job results of a report.
+
+    :param results: The job results from the backend.
+    :type results: list
     :param report: The original report as parsed from the email.
-    :param database: The database connection.
+    :param outcomes: The outcomes of the checked reports.
+    :type outcomes: Outcomes
     :param options: The app configuration parameters.
     """
-    def _delete_report():
-        """Delete the report from the database."""
-        database[utils.db.DB_CHECK_QUEUE].delete_one({"_id": report["_id"]})
+    if not results:
+        log.warn("No results found yet, retrying later")
+        reschedule(outcomes, report, RETRY_NO_RESULTS)
+        return
+
+    valid_result = _find_valid_result(results, report)
+
+    if valid_result:
+        log.info(
+            "Found valid job from backend: %s - %s - %s",
+            valid_result["job"],
+            valid_result["git_branch"],
+            valid_result["kernel"])
+
+        status = valid_result["status"]
+        if status == "PASS":
+            response = check_boots(valid_result, options)
+
+            if response.status_code == 200:
+                result = response.json()["result"][0]
+
+                # Check if we have the first boot reports in the
+                # backend. If so, schedule the email reports for
+                # later.
+                if int(result["count"]) > 0:
+                    if not outcomes.confirm(report):
+                        return
+                    response = send_report(valid_result, report, options)
+                    if (response.status_code == 202 or
+                            response.status_code == 200):
+                        outcomes.remove(report, OUTCOME_SENT)
+                    else:
+                        reschedule(outcomes, report, RETRY_BACKEND_ERROR)
+                else:
+                    log.info("No boot reports yet, retrying later")
+                    reschedule(outcomes, report, RETRY_NO_BOOTS)
+            else:
+                log.error("Error checking boot results from backend")
+                reschedule(outcomes, report, RETRY_BACKEND_ERROR)
+        elif status == "BUILD":
+            log.info("Job still building, retrying later")
+            reschedule(outcomes, report, RETRY_BUILD)
+        elif status == "FAIL":
+            outcomes.remove(report, OUTCOME_FAILED)
+            log.info("Job failed, will not send report")
+    else:
+        log.info("No valid results found from the backend, retrying later")
+        reschedule(outcomes, report, RETRY_NO_RESULTS)
 
-    if response.status_code == 200:
-        response = response.json()
 
-        if response["count"] > 0:
-            response = response["result"]
-            valid_result = None
+def handle_result(response, report, outcomes, options, index=None):
+    """Handle the results as obtained from the backend.
 
-            for result in response:
-                if is_valid_result(result, report):
-                    valid_result = result
-                    break
+    Check the status code of the response and apply the correct logic.
+    When the report has to be checked again, its next check is scheduled
+    with a backoff depending on the reason.
 
-            if valid_result:
-                log.info(
-                    "Found valid job from backend: %s - %s - %s",
-                    valid_result["job"],
-                    valid_result["git_branch"],
-                    valid_result["kernel"])
-
-                status = valid_result["status"]
-                if status == "PASS":
-                    response = check_boots(valid_result, options)
-
-                    if response.status_code == 200:
-                        result = response.json()["result"][0]
-
-                        # Check if we have the first boot reports in the
-                        # backend. If so, schedule the email reports for
-                        # later.
-                        if int(result["count"]) > 0:
-                            response = send_report(
-                                valid_result, report, options)
-                            if (response.status_code == 202 or
-                                    response.status_code == 200):
-                                _delete_report()
-                        else:
-                            log.info("No boot reports yet, retrying later")
-                    else:
-                        log.error("Error checking boot results from backend")
-                elif status == "BUILD":
-                    log.info("Job still building, retrying later")
-                elif status == "FAIL":
-                    _delete_report()
-                    log.info("Job failed, will not send report")
-            else:
-                log.info(
-                    "No valid results found from the backend, retrying later")
+    :param response: The response from the backend.
+    :param report: The original report as parsed from the email.
+    :param outcomes: The outcomes of the checked reports.
+    :type outcomes: Outcomes
+    :param options: The app configuration parameters.
+    :param index: The job results of the report tree, when the response
+    holds the results of all the reports of the tree.
+    :type index: JobIndex
+    """
+    if response.status_code == 200:
+        if index is not None:
+            results = index.lookup(report)
         else:
-            log.warn("No results found yet, retrying later")
+            response = response.json()
+            results = response["result"] if response["count"] > 0 else []
+
+        handle_job_results(results, report, outcomes, options)
     elif response.status_code == 503:
         log.warn("Backend is in maintenance, retrying later")
+        reschedule(outcomes, report, RETRY_MAINTENANCE)
     elif response.status_code == 400:
         log.error("Something wrong in the request, report will be discarded")
-        _delete_report()
-    elif response.status_code == 500:
-        log.warn("Backend error, retrying later")
+        outcomes.remove(report, OUTCOME_DISCARDED)
+    elif response.status_code >= 500:
+        log.warn(
+            "Backend error (%d), retrying later", response.status_code)
+        reschedule(outcomes, report, RETRY_BACKEND_ERROR)
+    else:
+        log.error(
+            "Unexpected response from the backend (%d), report will be "
+            "discarded", response.status_code)
+        outcomes.remove(report, OUTCOME_DISCARDED)
+
 
+def _past_deadline(report, outcomes):
+    """Remove a report if it cannot be sent before its deadline anymore.
 
-def check_and_send(options):
+    :param report: The report as parsed from the email.
+    :type report: dict
+    :param outcomes: The outcomes of the checked reports.
+    :type outcomes: Outcomes
+    :return bool True if the report has been removed.
+    """
+    deadline = report.get("deadline")
+
+    now = datetime.datetime.utcnow()
+    # Time when the scheduled report should be sent by the backend.
+    # If this value is bigger than deadline, no point in sending the
+    # report.
+    scheduled = now + datetime.timedelta(seconds=SEND_DELAY)
+
+    if now >= deadline or scheduled >= deadline:
+        log.info(
+            "Removing mail request, past the deadline: %s - %s",
+            deadline, scheduled)
+        outcomes.remove(report, OUTCOME_EXPIRED)
+        return True
+
+    return False
+
+
+def _job_params(tree, branch, versions):
+    """Build the job request parameters."""
+    params = [("job", tree)]
+    params.extend(("kernel_version", version) for version in versions)
+    if branch:
+        params.append(("git_branch", branch))
+    return params
+
+
+def _check_report(report, outcomes, url, options):
+    """Check a single report against the backend, and send it if ready.
+
+    :param report: The report as parsed from the email.
+    :type report: dict
+    :param outcomes: The outcomes of the checked reports.
+    :type outcomes: Outcomes
+    :param url: The URL of the job API endpoint.
+    :type url: str
+    :param options: The app configuration parameters.
+    :type options: dict
+    """
+    r_get = report.get
+
+    log.info(
+        "Working on: %s - %s / %s",
+        r_get("tree"), r_get("version"), r_get("patches"))
+    if not _past_deadline(report, outcomes):
+        response = utils.backend.get(
+            url,
+            _job_params(r_get("tree"), r_get("branch"), [r_get("version")]))
+        handle_result(response, report, outcomes, options)
+
+
+def _safe_check_report(report, outcomes, url, options):
+    """Check a report, logging the errors instead of raising them."""
+    try:
+        _check_report(report, outcomes, url, options)
+    # pylint: disable=broad-except
+    except Exception:
+        log.exception(
+            "Error checking report with Message-Id '%s'",
+            report.get("message_id"))
+
+
+def _group_by_tree(queued_reports, outcomes):
+    """Group the reports that can still be sent by tree and branch.
+
+    :param queued_reports: The reports from the check queue.
+    :param outcomes: The outcomes of the checked reports.
+    :type outcomes: Outcomes
+    :return list Tuples of tree, branch, kernel versions and reports; each
+    one with at most MAX_TREE_VERSIONS kernel versions.
+    """
+    trees = collections.OrderedDict()
+    for report in queued_reports:
+        if not _past_deadline(report, outcomes):
+            r_get = report.get
+            trees.setdefault(
+                (r_get("tree"), r_get("branch")),
+                collections.OrderedDict()
+            ).setdefault(r_get("version"), []).append(report)
+
+    groups = []
+    for (tree, branch), versions in trees.items():
+        names = list(versions)
+        for idx in range(0, len(names), MAX_TREE_VERSIONS):
+            chunk = names[idx:idx + MAX_TREE_VERSIONS]
+            groups.append((
+                tree,
+                branch,
+                chunk,
+                [report for name in chunk for report in versions[name]]
+            ))
+
+    return groups
+
+
+def _fetch_tree(group, url):
+    """Get the job results of a group of reports.
+
+    :param group: The tree, branch, kernel versions and reports.
+    :type group: tuple
+    :param url: The URL of the job API endpoint.
+    :type url: str
+    :return tuple The backend response and the JobIndex of its results, or
+    None on errors.
+    """
+    tree, branch, versions, _ = group
+    log.info("Retrieving jobs of: %s - %s / %s", tree, branch, versions)
+    try:
+        response = utils.backend.get(url, _job_params(tree, branch, versions))
+        index = JobIndex()
+        if response.status_code == 200:
+            index.update(response.json()["result"])
+        return response, index
+    # pylint: disable=broad-except
+    except Exception:
+        log.exception("Error retrieving jobs of: %s - %s", tree, branch)
+        return None
+
+
+def _safe_handle_result(response, report, outcomes, options, index):
+    """Handle the results of a report, logging the errors."""
+    try:
+        handle_result(response, report, outcomes, options, index=index)
+    # pylint: disable=broad-except
+    except Exception:
+        log.exception(
+            "Error checking report with Message-Id '%s'",
+            report.get("message_id"))
+
+
+def _run(workers, function, arguments):
+    """Call a function for each set of arguments, with a pool of workers.
+
+    :param workers: The number of workers, 1 to run the calls in order.
+    :type workers: int
+    :param function: The function to call.
+    :param arguments: The positional arguments of each call.
+    :type arguments: iterable
+    :return list The return values.
+    """
+    if workers == 1:
+        return [function(*args) for args in arguments]
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(function, *args) for args in arguments]
+        return [future.result() for future in futures]
+
+
+def check_by_tree(queued_reports, outcomes, url, options, workers):
+    """Check the reports with a job request per tree and branch.
+
+    All the job results of a tree are retrieved at once, and each report is
+    resolved against them: the backend requests scale with the trees, not
+    with the reports.
+
+    :param queued_reports: The reports from the check queue.
+    :param outcomes: The outcomes of the checked reports.
+    :type outcomes: Outcomes
+    :param url: The URL of the job API endpoint.
+    :type url: str
+    :param options: The app configuration parameters.
+    :type options: dict
+    :param workers: The number of workers.
+    :type workers: int
+    """
+    groups = _group_by_tree(queued_reports, outcomes)
+    fetched = _run(workers, _fetch_tree, [(group, url) for group in groups])
+
+    checks = []
+    for group, result in zip(groups, fetched):
+        if result is not None:
+            response, index = result
+            checks.extend(
+                (response, report, outcomes, options, index)
+                for report in group[3]
+            )
+
+    _run(workers, _safe_handle_result, checks)
+    log.info(
+        "Checked %d reports with %d job requests", len(checks), len(groups))
+
+
+def check_reports(options, database, queued_reports, lease=None):
+    """Check reports and in case send the build/boot report.
+
+    Reports are checked concurrently by the configured number of workers,
+    and what has to be written is written at the end with a bulk write,
+    except for the sent reports that are removed as soon as sent.
+
+    :param options: The app configuration parameters.
+    :type options: dict
+    :param database: The database connection.
+    :param queued_reports: The reports to check.
+    :param lease: The lease of the reports, when claimed.
+    :type lease: Lease
+    :return Outcomes The outcomes of the checked reports.
+    """
+    utils.backend.req.headers.update(
+        {"Authorization": options.get(utils.BACKEND_TOKEN, None)})
+
+    url = _add_api_endpoint(options[utils.BACKEND_URL], "job")
+    workers = int(
+        options.get(utils.SEND_WORKERS, None) or DEFAULT_SEND_WORKERS)
+
+    outcomes = Outcomes(lease=lease, database=database)
+    try:
+        if options.get(utils.JOB_FETCH_MODE, None) == JOB_FETCH_MODE_TREE:
+            check_by_tree(queued_reports, outcomes, url, options, workers)
+        else:
+            _run(
+                workers,
+                _safe_check_report,
+                (
+                    (report, outcomes, url, options)
+                    for report in queued_reports
+                )
+            )
+    finally:
+        outcomes.write(database)
+        log.info(
+            "Reports removed: %d, rescheduled: %d",
+            outcomes.removed, outcomes.rescheduled)
+
+    return outcomes
+
+
+def check_and_send(options, lease=None):
     """Check the queue and in case send the build/boot report.
 
+    The expired reports are removed first, then only the reports whose next
+    check is due are retrieved and checked.
+
+    With a lease, the due reports are claimed and checked in batches, so
+    that other processes can check the other ones at the same time.
+
     :param options: The app configuration parameters.
     :type options: dict
+    :param lease: The lease to claim the reports with.
+    :type lease: Lease
     """
     connection = utils.db.get_connection(options)
+    database = connection[utils.db.DB_NAME]
 
-    try:
-        database = connection[utils.db.DB_NAME]
+    expired = expire_reports(database, datetime.datetime.utcnow())
+    if expired:
+        log.info("Removed %d reports past their deadline", expired)
 
-        queued_reports = \
-            database[utils.db.DB_CHECK_QUEUE].find(sort=[("created_on", 1)])
+    order = options.get(utils.QUEUE_ORDER, None) or QUEUE_ORDER_CREATED
 
-        utils.backend.req.headers.update(
-            {"Authorization": options.get(utils.BACKEND_TOKEN, None)})
+    if lease is None:
+        check_reports(options, database, due_reports(database, order))
+    else:
+        while True:
+            claimed = lease.claim(order=order)
+            if not claimed:
+                break
 
-        url = _add_api_endpoint(options[utils.BACKEND_URL], "job")
+            try:
+                with lease.renewing():
+                    check_reports(options, database, claimed, lease=lease)
+            finally:
+                lease.release([report["_id"] for report in claimed])
 
-        for report in queued_reports:
-            r_get = report.get
-            tree = r_get("tree")
-            version = r_get("version")
-            deadline = r_get("deadline")
-            branch = r_get("branch")
+            if len(claimed) < LEASE_BATCH_SIZE:
+                break
+
+
+class Scheduler(object):
+    """Check each report when its next check is due.
+
+    The due times of all the queued reports are loaded in a heap, and the
+    scheduler sleeps until the earliest one. The new reports, without a next
+    check time, are looked for every `refresh` seconds.
+
+    With a lease, the due reports are claimed before being checked. Those
+    claimed by other processes are looked at again when their lease ends.
 
+    With watch(), the changes of the check queue are followed as they
+    happen, and new reports are checked at once.
+    """
+
+    def __init__(self, options, refresh=SCHEDULER_REFRESH, lease=None):
+        self.options = options
+        self.refresh = refresh
+        self.lease = lease
+        self.timers = utils.timers.TimerHeap()
+        # Set to check the due reports before the planned time.
+        self.wakeup = threading.Event()
+        # Set while the check queue changes are followed.
+        self.streaming = threading.Event()
+
+    def _database(self):
+        """Get the database connection."""
+        return utils.db.get_connection(self.options)[utils.db.DB_NAME]
+
+    def load(self):
+        """Remove the expired reports and load the due times of the others.
+
+        :return int The number of scheduled reports.
+        """
+        database = self._database()
+        now = datetime.datetime.utcnow()
+
+        expired = expire_reports(database, now)
+        if expired:
+            log.info("Removed %d reports past their deadline", expired)
+
+        # The heap is rebuilt in place: the reports scheduled meanwhile by
+        # the other threads are kept.
+        mark = self.timers.mark()
+        due_times = {}
+        for report in database[utils.db.DB_CHECK_QUEUE].find(
+                projection=["next_check_at"]):
+            due_times[report["_id"]] = report.get("next_check_at") or now
+        self.timers.rebuild(due_times, mark)
+
+        return len(self.timers)
+
+    def add_new(self):
+        """Schedule the reports never checked before, if not yet scheduled.
+
+        :return int The number of new reports.
+        """
+        database = self._database()
+        now = datetime.datetime.utcnow()
+
+        count = 0
+        for report in database[utils.db.DB_CHECK_QUEUE].find(
+                {"next_check_at": None}, projection=["_id"]):
+            if report["_id"] not in self.timers:
+                self.timers.schedule(report["_id"], now)
+                count += 1
+
+        return count
+
+    def check_due(self, now):
+        """Check the reports that are due.
+
+        The reports are scheduled again with their new next check time. If
+        a report has not been checked because of an error, it is checked
+        again later.
+
+        :param now: The current time.
+        :type now: datetime.datetime
+        :return int The number of checked reports.
+        :raise Any error checking the reports, once they are scheduled again.
+        """
+        report_ids = self.timers.pop_due(now)
+        if not report_ids:
+            return 0
+
+        retry = now + datetime.timedelta(
+            seconds=RETRY_BACKOFFS[RETRY_BACKEND_ERROR][0])
+        try:
+            queued_reports, outcomes = self._check(now, report_ids)
+        except Exception:
+            for report_id in report_ids:
+                if report_id not in self.timers:
+                    self.timers.schedule(report_id, retry)
+            raise
+
+        for report in queued_reports:
+            report_id = report["_id"]
+            if report_id in outcomes.next_checks:
+                self.timers.schedule(
+                    report_id, outcomes.next_checks[report_id])
+            elif report_id not in outcomes.done:
+                self.timers.schedule(report_id, retry)
+
+        return len(queued_reports)
+
+    def _check(self, now, report_ids):
+        """Check some reports, claiming them first if leases are used.
+
+        :return tuple The checked reports and their outcomes.
+        """
+        database = self._database()
+        if self.lease is None:
+            queued_reports = list(database[utils.db.DB_CHECK_QUEUE].find(
+                {"_id": {"$in": report_ids}},
+                projection=QUEUE_FIELDS,
+                sort=[("deadline", pymongo.ASCENDING)]
+            ))
+            outcomes = check_reports(self.options, database, queued_reports)
+        else:
+            queued_reports = self.lease.claim(
+                order=QUEUE_ORDER_DEADLINE,
+                spec={"_id": {"$in": report_ids}},
+                limit=len(report_ids))
+
+            claimed = set(report["_id"] for report in queued_reports)
+            lease_end = now + datetime.timedelta(seconds=self.lease.duration)
+            for report_id in report_ids:
+                if report_id not in claimed:
+                    self.timers.schedule(report_id, lease_end)
+
+            try:
+                with self.lease.renewing():
+                    outcomes = check_reports(
+                        self.options, database, queued_reports,
+                        lease=self.lease)
+            finally:
+                self.lease.release(claimed)
+
+        return queued_reports, outcomes
+
+    def handle_change(self, change):
+        """Update the due times with a change of the check queue.
+
+        :param change: The change stream event.
+        :type change: dict
+        """
+        report_id = change["documentKey"]["_id"]
+        operation = change["operationType"]
+        now = datetime.datetime.utcnow()
+
+        if operation == "delete":
+            self.timers.cancel(report_id)
+            return
+
+        if operation == "update":
+            fields = change["updateDescription"]["updatedFields"]
+            if "next_check_at" not in fields:
+                return
+            due = fields["next_check_at"]
+        else:
+            due = change["fullDocument"].get("next_check_at", None)
+
+        due = due or now
+        self.timers.schedule(report_id, due)
+        if due <= now:
+            log.debug("Report '%s' is due, waking up", report_id)
+            self.wakeup.set()
+
+    def _follow(self, stop, collection, token):
+        """Follow the check queue changes, from a resume token.
+
+        :return The last resume token.
+        """
+        pipeline = [
+            {
+                "$match": {
+                    "operationType": {
+                        "$in": ["insert", "replace", "update", "delete"]
+                    }
+                }
+            }
+        ]
+
+        with collection.watch(
+                pipeline, resume_after=token, max_await_time_ms=1000) \
+                as stream:
+            self.streaming.set()
+            log.info("Following the check queue changes")
+            # Reports queued before the stream was open, the first time.
+            if token is None:
+                self.add_new()
+
+            saved = time.monotonic()
+            while not stop.is_set() and stream.alive:
+                change = stream.try_next()
+                if change is not None:
+                    self.handle_change(change)
+
+                if stream.resume_token != token:
+                    token = stream.resume_token
+                    if time.monotonic() - saved > STREAM_SAVE_INTERVAL:
+                        save_resume_token(self.options, token)
+                        saved = time.monotonic()
+
+        return token
+
+    def watch(self, stop):
+        """Follow the check queue changes until stopped.
+
+        The changes are followed from the stored resume token, so nothing is
+        missed across restarts. Without a replica set, change streams are
+        not available: new reports are then looked for every `refresh`
+        seconds.
+
+        :param stop: Event set to stop following the changes.
+        :type stop: threading.Event
+        :return bool False if change streams are not available.
+        """
+        connection = utils.db.get_connection(self.options)
+        collection = connection[utils.db.DB_NAME][utils.db.DB_CHECK_QUEUE]
+        token = load_resume_token(self.options)
+
+        while not stop.is_set():
+            try:
+                token = self._follow(stop, collection, token)
+            except pymongo.errors.OperationFailure as ex:
+                if ex.code in STREAM_NOT_SUPPORTED_ERRORS:
+                    log.warning(
+                        "Change streams not available, looking for new "
+                        "reports every %.0f seconds", self.refresh)
+                    return False
+                if ex.code in STREAM_TOKEN_ERRORS and token is not None:
+                    log.warning("Cannot resume the check queue changes")
+                    token = None
+                    continue
+                log.exception("Error following the check queue changes")
+                self.streaming.clear()
+                stop.wait(STREAM_RETRY_DELAY)
+            except pymongo.errors.PyMongoError:
+                log.exception("Error following the check queue changes")
+                self.streaming.clear()
+                stop.wait(STREAM_RETRY_DELAY)
+            finally:
+                if token is not None:
+                    try:
+                        save_resume_token(self.options, token)
+                    except pymongo.errors.PyMongoError:
+                        log.warning("Cannot save the change stream token")
+
+        self.streaming.clear()
+        return True
+
+    def run(self, stop, period):
+        """Check the reports as they become due, for a period of time.
+
+        :param stop: Event set to stop the scheduler.
+        :type stop: threading.Event
+        :param period: Seconds before returning; the due times are loaded
+        again from the database at each run.
+        :type period: float
+        """
+        start = time.monotonic()
+        log.info("Scheduled reports: %d", self.load())
+        next_refresh = start + self.refresh
+
+        while not stop.is_set():
             now = datetime.datetime.utcnow()
-            # Time when the scheduled report should be sent by the backend.
-            # If this value is bigger than deadline, no point in sending the
-            # report.
-            scheduled = now + datetime.timedelta(seconds=SEND_DELAY)
-
-            log.info(
-                "Working on: %s - %s / %s", tree, version, r_get("patches"))
-            if now >= deadline or scheduled >= deadline:
-                log.info(
-                    "Removing mail request, past the deadline: %s - %s",
-                    deadline, scheduled)
-                database[utils.db.DB_CHECK_QUEUE].delete_one(
-                    {"_id": r_get("_id")})
-            else:
-                params = [
-                    ("job", tree),
-                    ("kernel_version", version)
-                ]
-                if branch:
-                    params.append(("git_branch", branch))
-                response = utils.backend.get(url, params)
-                handle_result(response, report, database, options)
-    finally:
-        connection.close()
+            try:
+                self.check_due(now)
+            # pylint: disable=broad-except
+            except Exception:
+                log.exception("Error checking the due reports")
+
+            clock = time.monotonic()
+            if clock >= start + period:
+                break
+
+            if clock >= next_refresh and not self.streaming.is_set():
+                try:
+                    new_reports = self.add_new()
+                    if new_reports:
+                        log.info("New reports scheduled: %d", new_reports)
+                # pylint: disable=broad-except
+                except Exception:
+                    log.exception("Error looking for new reports")
+                next_refresh = clock + self.refresh
+
+            timeout = min(next_refresh, start + period) - clock
+            next_due = self.timers.next_due()
+            if next_due is not None:
+                timeout = min(
+                    timeout,
+                    (next_due - datetime.datetime.utcnow()).total_seconds())
+
+            if self.wakeup.wait(max(timeout, 0)):
+                self.wakeup.clear()
+
+
+def load_resume_token(options):
+    """Get the stored resume token of the check queue changes.
+
+    :param options: The configuration options.
+    :type options: dict
+    :return dict The resume token, or None.
+    """
+    connection = utils.db.get_connection(options)
+    state = connection[utils.db.DB_NAME][utils.db.DB_MAIL_STATE].find_one(
+        {"_id": STREAM_STATE_ID})
+
+    return state.get("resume_token", None) if state else None
+
+
+def save_resume_token(options, token):
+    """Store the resume token of the check queue changes.
+
+    :param options: The configuration options.
+    :type options: dict
+    :param token: The resume token.
+    :type token: dict
+    """
+    connection = utils.db.get_connection(options)
+    connection[utils.db.DB_NAME][utils.db.DB_MAIL_STATE].update_one(
+        {"_id": STREAM_STATE_ID},
+        {"$set": {"resume_token": token}},
+        upsert=True
+    )
 
 
-def process(options, event):
+def process(options, event, lease=None):
     """Execute the operations inside the event protected zone.
 
     :param options: The app configuration parameters.
     :type options: dict
     :param event: The even object used to synchronize.
     :type event: threading.Event
+    :param lease: The lease to claim the reports with.
+    :type lease: Lease
     """
     if event.is_set():
         try:
             event.clear()
-            check_and_send(options)
+            check_and_send(options, lease=lease)
         finally:
             event.set()
     else:
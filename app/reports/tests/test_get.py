@@ -0,0 +1,763 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Get emails test module."""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import pymongo
+
+import reports.get
+import utils
+import utils.db
+import utils.emails
+import utils.journal
+import utils.maildir
+import utils.seen
+
+from utils.tests.test_publicinbox import add_message, init_epoch
+
+REQUEST_HEADERS = (
+    b"From: Greg KH <gregkh@example.org>\r\n"
+    b"To: linux-kernel@example.org\r\n"
+    b"Subject: [PATCH 4.1 00/45] 4.1.15-stable review\r\n"
+    b"Message-Id: <20160101000000.000000000@example.org>\r\n"
+    b"Date: Fri, 01 Jan 2016 00:00:00 +0000\r\n"
+    b"\r\n"
+)
+
+REPLY_HEADERS = (
+    b"From: Someone <someone@example.org>\r\n"
+    b"Subject: Re: [PATCH 4.1 00/45] 4.1.15-stable review\r\n"
+    b"Message-Id: <20160101000001.000000000@example.org>\r\n"
+    b"In-Reply-To: <20160101000000.000000000@example.org>\r\n"
+    b"References: <20160101000000.000000000@example.org>\r\n"
+    b"Date: Fri, 01 Jan 2016 00:00:01 +0000\r\n"
+    b"\r\n"
+)
+
+
+def _collect(batches):
+    """Consume all the batches and return the parsed emails."""
+    return [email_data for batch in batches for email_data in batch]
+
+
+class TestGet(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        self.options = {
+            utils.MAIL_SERVER: "imap.example.org",
+            utils.MAIL_SERVER_PORT: 993,
+            utils.MAIL_USERNAME: "user",
+            utils.MAIL_PASSWORD: "password"
+        }
+
+        patcher = unittest.mock.patch("imaplib.IMAP4_SSL")
+        self.addCleanup(patcher.stop)
+        self.server = patcher.start().return_value
+
+        self.server.search.return_value = ("OK", [b"1 2 3 7"])
+        self.server.fetch.return_value = (
+            "OK",
+            [
+                (b"1 (BODY[HEADER] {251}", REQUEST_HEADERS), b")",
+                (b"2 (BODY[HEADER] {301}", REPLY_HEADERS), b")"
+            ]
+        )
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_message_set(self):
+        self.assertEqual(
+            "1:3,5,7:8",
+            reports.get._message_set([b"8", b"1", b"2", b"3", b"5", b"7"]))
+
+    def test_message_set_single(self):
+        self.assertEqual("4", reports.get._message_set([b"4"]))
+
+    def test_check_from_server_headers(self):
+        parsed = _collect(reports.get.check_from_server(self.options))
+
+        self.server.fetch.assert_called_once_with(
+            "1:3,7", "(BODY.PEEK[HEADER])")
+        # Only the messages retrieved are flagged.
+        self.server.store.assert_called_once_with(
+            "1:2", "+FLAGS", "\\Seen")
+        self.assertEqual(1, len(parsed))
+        self.assertEqual(
+            "[PATCH 4.1 00/45] 4.1.15-stable review", parsed[0]["subject"])
+
+    def test_check_from_server_search(self):
+        _collect(reports.get.check_from_server(self.options))
+
+        self.server.search.assert_called_once_with(
+            None, "UNSEEN", utils.emails.SEARCH_CRITERIA)
+
+    def test_check_from_server_search_disabled(self):
+        self.options[utils.MAIL_SEARCH] = ""
+        _collect(reports.get.check_from_server(self.options))
+
+        self.server.search.assert_called_once_with(None, "UNSEEN")
+
+    def test_check_from_server_no_messages(self):
+        self.server.search.return_value = ("OK", [b""])
+
+        self.assertListEqual(
+            [], _collect(reports.get.check_from_server(self.options)))
+        self.server.fetch.assert_not_called()
+        self.server.store.assert_not_called()
+
+    def test_check_from_server_fetch_error(self):
+        self.server.fetch.return_value = ("NO", [b"server error"])
+
+        self.assertListEqual(
+            [], _collect(reports.get.check_from_server(self.options)))
+        self.server.store.assert_not_called()
+
+    def test_check_from_server_batches(self):
+        self.options[utils.BATCH_SIZE] = 3
+        self.server.fetch.side_effect = [
+            (
+                "OK",
+                [
+                    (b"1 (BODY[HEADER] {251}", REQUEST_HEADERS), b")",
+                    (b"2 (BODY[HEADER] {301}", REPLY_HEADERS), b")",
+                    (b"3 (BODY[HEADER] {301}", REPLY_HEADERS), b")"
+                ]
+            ),
+            ("OK", [(b"7 (BODY[HEADER] {251}", REQUEST_HEADERS), b")"])
+        ]
+        batches = reports.get.check_from_server(self.options)
+
+        next(batches)
+        self.server.fetch.assert_called_once_with(
+            "1:3", "(BODY.PEEK[HEADER])")
+        self.server.store.assert_not_called()
+
+        next(batches)
+        self.server.store.assert_called_once_with("1:3", "+FLAGS", "\\Seen")
+        self.server.fetch.assert_called_with("7", "(BODY.PEEK[HEADER])")
+
+        self.assertRaises(StopIteration, next, batches)
+        self.server.store.assert_called_with("7", "+FLAGS", "\\Seen")
+
+    def test_check_from_server_batch_not_saved(self):
+        batches = reports.get.check_from_server(self.options)
+
+        next(batches)
+        batches.close()
+
+        self.server.store.assert_not_called()
+        self.server.logout.assert_called_once_with()
+
+    def test_check_from_server_full(self):
+        self.options[utils.MAIL_FETCH_MODE] = reports.get.FETCH_MODE_FULL
+        self.server.fetch.return_value = (
+            "OK", [(b"1 (BODY[] {251}", REQUEST_HEADERS), b")"])
+
+        parsed = _collect(reports.get.check_from_server(self.options))
+
+        self.assertEqual(4, self.server.fetch.call_count)
+        self.server.fetch.assert_called_with(b"7", "(BODY.PEEK[])")
+        self.server.store.assert_called_once_with(
+            "1:3,7", "+FLAGS", "\\Seen")
+        self.assertEqual(4, len(parsed))
+
+
+class TestGetUid(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        self.options = {
+            utils.MAIL_SERVER: "imap.example.org",
+            utils.MAIL_USERNAME: "user"
+        }
+
+        self.server = unittest.mock.Mock()
+        self.server.response.side_effect = lambda code: (
+            code, {"UIDVALIDITY": [b"42"], "UIDNEXT": [b"15"]}[code])
+        self.server.uid.side_effect = self._uid
+
+        patcher = unittest.mock.patch("reports.get.load_sync_state")
+        self.addCleanup(patcher.stop)
+        self.load_state = patcher.start()
+
+        patcher = unittest.mock.patch("reports.get.save_sync_state")
+        self.addCleanup(patcher.stop)
+        self.save_state = patcher.start()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    @staticmethod
+    def _uid(command, *args):
+        if command == "SEARCH":
+            return "OK", [b"12 14"]
+        return "OK", [(b"1 (UID 12 BODY[HEADER] {251}", REQUEST_HEADERS)]
+
+    def test_sync_uid_incremental(self):
+        self.load_state.return_value = {"uidvalidity": 42, "last_uid": 10}
+
+        parsed = _collect(reports.get._sync_uid(self.options, self.server))
+
+        self.server.uid.assert_any_call(
+            "SEARCH", "UID", "11:14", utils.emails.SEARCH_CRITERIA)
+        self.server.uid.assert_any_call(
+            "FETCH", "12,14", "(BODY.PEEK[HEADER])")
+        self.server.store.assert_not_called()
+        self.save_state.assert_called_with(
+            self.options, "user@imap.example.org/INBOX", 42, 14)
+        self.assertEqual(1, len(parsed))
+
+    def test_sync_uid_batches(self):
+        self.options[utils.BATCH_SIZE] = 1
+        self.load_state.return_value = {"uidvalidity": 42, "last_uid": 10}
+        batches = reports.get._sync_uid(self.options, self.server)
+
+        next(batches)
+        self.save_state.assert_not_called()
+
+        next(batches)
+        self.save_state.assert_called_once_with(
+            self.options, "user@imap.example.org/INBOX", 42, 12)
+
+        self.assertRaises(StopIteration, next, batches)
+        self.save_state.assert_called_with(
+            self.options, "user@imap.example.org/INBOX", 42, 14)
+
+    def test_sync_uid_up_to_date(self):
+        self.load_state.return_value = {"uidvalidity": 42, "last_uid": 14}
+
+        self.assertListEqual(
+            [], _collect(reports.get._sync_uid(self.options, self.server)))
+        self.server.uid.assert_not_called()
+
+    def test_sync_uid_validity_changed(self):
+        self.load_state.return_value = {"uidvalidity": 41, "last_uid": 100}
+
+        _collect(reports.get._sync_uid(self.options, self.server))
+
+        self.server.uid.assert_any_call(
+            "SEARCH", "UNSEEN", "UID", "1:14", utils.emails.SEARCH_CRITERIA)
+        self.save_state.assert_called_with(
+            self.options, "user@imap.example.org/INBOX", 42, 14)
+
+    def test_sync_uid_status_fallback(self):
+        self.load_state.return_value = None
+        self.server.response.side_effect = lambda code: (code, [None])
+        self.server.status.return_value = (
+            "OK", [b"INBOX (UIDNEXT 15 UIDVALIDITY 42)"])
+
+        _collect(reports.get._sync_uid(self.options, self.server))
+
+        self.server.uid.assert_any_call(
+            "SEARCH", "UNSEEN", "UID", "1:14", utils.emails.SEARCH_CRITERIA)
+
+
+class TestGetSources(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        self.options = {
+            utils.MAIL_SERVER: "imap.example.org",
+            utils.MAIL_USERNAME: "user",
+            utils.MAIL_FOLDERS: "INBOX, stable-rc",
+            utils.MAIL_ACCOUNTS: [
+                {
+                    utils.MAIL_SERVER: "imap.vendor.org",
+                    utils.MAIL_USERNAME: "vendor",
+                    utils.MAIL_FOLDERS: ""
+                }
+            ]
+        }
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_mail_sources(self):
+        sources = reports.get.mail_sources(self.options)
+
+        self.assertListEqual(
+            [
+                "user@imap.example.org/INBOX",
+                "user@imap.example.org/stable-rc",
+                "vendor@imap.vendor.org/INBOX"
+            ],
+            [reports.get.source_id(source) for source in sources]
+        )
+
+    def test_mail_sources_account_options(self):
+        self.options[utils.MAIL_PASSWORD] = "secret"
+        self.options[utils.MAIL_SERVER_PORT] = 1993
+        self.options[utils.DB_SERVER] = "db.example.org"
+        self.options[utils.BATCH_SIZE] = 10
+
+        vendor = reports.get.mail_sources(self.options)[-1]
+
+        # The main account options are not inherited, the others are.
+        self.assertNotIn(utils.MAIL_PASSWORD, vendor)
+        self.assertEqual(
+            utils.DEFAULT_IMAP_PORT, vendor[utils.MAIL_SERVER_PORT])
+        self.assertEqual("INBOX", vendor[utils.MAIL_FOLDER])
+        self.assertEqual("db.example.org", vendor[utils.DB_SERVER])
+        self.assertEqual(10, vendor[utils.BATCH_SIZE])
+
+    def test_mail_sources_account_no_server(self):
+        self.options[utils.MAIL_ACCOUNTS] = [{utils.MAIL_USERNAME: "vendor"}]
+
+        sources = reports.get.mail_sources(self.options)
+
+        self.assertEqual(
+            "vendor@imap.gmail.com/INBOX", reports.get.source_id(sources[-1]))
+        self.assertEqual(
+            utils.DEFAULT_IMAP_PORT, sources[-1][utils.MAIL_SERVER_PORT])
+
+    def test_mail_sources_no_account(self):
+        self.assertListEqual([], reports.get.mail_sources({}))
+
+    def test_supports_idle_no_account(self):
+        sessions = {}
+
+        self.assertFalse(reports.get.supports_idle({}, sessions))
+        self.assertDictEqual({}, sessions)
+
+    @unittest.mock.patch("reports.get.check_from_server")
+    def test_check_from_servers_isolation(self, mock_check):
+        def check(source, session):
+            if source[utils.MAIL_FOLDER] == "stable-rc":
+                raise ValueError("Broken mail box")
+            return iter([[{"message_id": reports.get.source_id(source)}]])
+
+        mock_check.side_effect = check
+        sessions = {}
+
+        parsed = _collect(
+            reports.get.check_from_servers(self.options, sessions))
+
+        self.assertListEqual(
+            ["user@imap.example.org/INBOX", "vendor@imap.vendor.org/INBOX"],
+            sorted(data["message_id"] for data in parsed))
+        self.assertEqual(3, len(sessions))
+
+
+class TestGetSystem(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.options = {utils.MAIL_DIRECTORY: self.path}
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def _write(self, path, content):
+        with open(path, "wb") as write_file:
+            write_file.write(content)
+
+    def test_check_from_system(self):
+        self._write(os.path.join(self.path, "1"), REQUEST_HEADERS)
+        self._write(os.path.join(self.path, "2"), REPLY_HEADERS)
+
+        parsed = _collect(reports.get.check_from_system(self.options))
+
+        self.assertEqual(1, len(parsed))
+        self.assertListEqual([], os.listdir(self.path))
+
+    def test_check_from_system_maildir(self):
+        utils.maildir.create(self.path)
+        self._write(os.path.join(self.path, "tmp", "1.host"), REQUEST_HEADERS)
+        self._write(os.path.join(self.path, "new", "2.host"), REQUEST_HEADERS)
+        self._write(os.path.join(self.path, "new", "3.host"), REPLY_HEADERS)
+
+        parsed = _collect(reports.get.check_from_system(self.options))
+
+        self.assertEqual(1, len(parsed))
+        self.assertListEqual([], os.listdir(os.path.join(self.path, "new")))
+        self.assertListEqual(
+            ["1.host"], os.listdir(os.path.join(self.path, "tmp")))
+        self.assertListEqual(
+            ["2.host:2,S", "3.host:2,S"],
+            sorted(os.listdir(os.path.join(self.path, "cur"))))
+
+
+class TestGetSave(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        patcher = unittest.mock.patch("utils.db.get_connection")
+        self.addCleanup(patcher.stop)
+        connection = patcher.start().return_value
+
+        self.collection = unittest.mock.MagicMock()
+        database = unittest.mock.MagicMock()
+        database.__getitem__.return_value = self.collection
+        connection.__getitem__.return_value = database
+
+        self.data = [
+            {"message_id": "<{0:d}@example.org>".format(idx), "subject": "s"}
+            for idx in range(3)
+        ]
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_ensure_indexes_replace(self):
+        self.collection.create_index.side_effect = [
+            pymongo.errors.OperationFailure(
+                "index options conflict",
+                code=reports.get.INDEX_OPTIONS_CONFLICT),
+            None
+        ]
+
+        reports.get.ensure_indexes({})
+
+        self.collection.drop_index.assert_called_once()
+        self.assertDictEqual(
+            {"unique": True, "background": True},
+            self.collection.create_index.call_args[1])
+
+    def test_ensure_indexes_duplicates(self):
+        self.collection.create_index.side_effect = [
+            pymongo.errors.DuplicateKeyError(
+                "duplicate key", code=reports.get.DUPLICATE_KEY_ERROR),
+            None
+        ]
+        self.collection.aggregate.return_value = [
+            {"_id": {}, "ids": [1, 2, 3], "count": 3}]
+
+        reports.get.ensure_indexes({})
+
+        self.collection.drop_index.assert_not_called()
+        self.collection.delete_many.assert_called_once_with(
+            {"_id": {"$in": [2, 3]}})
+        self.assertEqual(2, self.collection.create_index.call_count)
+        self.assertDictEqual(
+            {"unique": True, "background": True},
+            self.collection.create_index.call_args[1])
+
+    def test_save_single_bulk_write(self):
+        self.collection.bulk_write.return_value.upserted_ids = {0: 1, 2: 3}
+
+        outcomes = reports.get.save({}, self.data)
+
+        self.assertEqual(1, self.collection.bulk_write.call_count)
+        requests = self.collection.bulk_write.call_args[0][0]
+        self.assertEqual(3, len(requests))
+        self.assertIsInstance(requests[0], pymongo.UpdateOne)
+        self.assertDictEqual(
+            {"ordered": False}, self.collection.bulk_write.call_args[1])
+        self.collection.find_one.assert_not_called()
+        self.assertListEqual(
+            [
+                reports.get.SAVE_NEW,
+                reports.get.SAVE_DUPLICATE,
+                reports.get.SAVE_NEW
+            ],
+            outcomes
+        )
+
+    def test_save_bulk_write_errors(self):
+        self.collection.bulk_write.side_effect = \
+            pymongo.errors.BulkWriteError({
+                "upserted": [{"index": 0, "_id": 1}],
+                "writeErrors": [
+                    {"index": 1, "code": 11000, "errmsg": "duplicate key"},
+                    {"index": 2, "code": 2, "errmsg": "bad value"}
+                ]
+            })
+
+        self.assertListEqual(
+            [
+                reports.get.SAVE_NEW,
+                reports.get.SAVE_DUPLICATE,
+                reports.get.SAVE_ERROR
+            ],
+            reports.get.save({}, self.data)
+        )
+
+    def test_save_no_data(self):
+        self.assertListEqual([], reports.get.save({}, []))
+        self.collection.bulk_write.assert_not_called()
+
+    def test_deliver(self):
+        self.collection.bulk_write.return_value.upserted_ids = {0: 1}
+
+        self.assertTrue(
+            reports.get.deliver({}, REQUEST_HEADERS + b"body\r\n"))
+        self.assertEqual(1, self.collection.bulk_write.call_count)
+
+    def test_deliver_not_a_request(self):
+        self.assertTrue(reports.get.deliver({}, REPLY_HEADERS))
+        self.collection.bulk_write.assert_not_called()
+
+    def test_deliver_error(self):
+        self.collection.bulk_write.side_effect = \
+            pymongo.errors.BulkWriteError({
+                "writeErrors": [{"index": 0, "code": 2, "errmsg": "bad"}]
+            })
+
+        self.assertFalse(reports.get.deliver({}, REQUEST_HEADERS))
+
+
+class TestGetSeen(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.options = {utils.MAIL_DIRECTORY: self.path}
+
+        patcher = unittest.mock.patch.object(
+            reports.get, "SEEN", utils.seen.SeenSet())
+        self.addCleanup(patcher.stop)
+        self.seen = patcher.start()
+
+        patcher = unittest.mock.patch("utils.db.get_connection")
+        self.addCleanup(patcher.stop)
+        connection = patcher.start().return_value
+
+        self.queued = unittest.mock.MagicMock()
+        self.processed = unittest.mock.MagicMock()
+        self.queued.find.return_value = []
+        self.processed.find.return_value = []
+        collections = {
+            utils.db.DB_CHECK_QUEUE: self.queued,
+            utils.db.DB_PROCESSED: self.processed
+        }
+        database = unittest.mock.MagicMock()
+        database.__getitem__.side_effect = collections.__getitem__
+        connection.__getitem__.return_value = database
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def _write(self, name, content):
+        with open(os.path.join(self.path, name), "wb") as write_file:
+            write_file.write(content)
+
+    def test_unseen_disabled(self):
+        self._write("1", REQUEST_HEADERS)
+
+        parsed = _collect(reports.get.check_from_system(self.options))
+
+        self.assertEqual(1, len(parsed))
+        self.queued.find.assert_not_called()
+
+    def test_unseen_not_in_filter(self):
+        self.seen.rebuild(["<foo@example.org>"], capacity=100)
+        self._write("1", REQUEST_HEADERS)
+
+        parsed = _collect(reports.get.check_from_system(self.options))
+
+        self.assertEqual(1, len(parsed))
+        self.queued.find.assert_not_called()
+        self.processed.find.assert_not_called()
+
+    def test_unseen_already_handled(self):
+        self.seen.rebuild(
+            ["<20160101000000.000000000@example.org>"], capacity=100)
+        self.processed.find.return_value = [
+            {"_id": "<20160101000000.000000000@example.org>"}]
+        self._write("1", REQUEST_HEADERS)
+
+        parsed = _collect(reports.get.check_from_system(self.options))
+
+        self.assertListEqual([], parsed)
+        self.assertListEqual([], os.listdir(self.path))
+
+    def test_unseen_false_positive(self):
+        self.seen.rebuild(
+            ["<20160101000000.000000000@example.org>"], capacity=100)
+        self._write("1", REQUEST_HEADERS)
+
+        parsed = _collect(reports.get.check_from_system(self.options))
+
+        self.assertEqual(1, len(parsed))
+        self.assertEqual(1, self.queued.find.call_count)
+
+    def test_save_adds_to_seen(self):
+        self.seen.rebuild([], capacity=100)
+        self.queued.bulk_write.return_value.upserted_ids = {0: 1}
+
+        reports.get.save(
+            {}, [{"message_id": "<foo@example.org>", "subject": "s"}])
+
+        self.assertTrue(self.seen.might_contain("<foo@example.org>"))
+
+    def test_load_seen_from_database(self):
+        self.queued.estimated_document_count.return_value = 1
+        self.processed.estimated_document_count.return_value = 1
+        self.queued.find.return_value = [{"message_id": "<foo@example.org>"}]
+        self.processed.find.return_value = [{"_id": "<bar@example.org>"}]
+        self.options[utils.SEEN_FILE] = os.path.join(self.path, "seen.bloom")
+
+        reports.get.load_seen(self.options)
+
+        self.assertTrue(self.seen.enabled)
+        self.assertTrue(self.seen.might_contain("<foo@example.org>"))
+        self.assertTrue(self.seen.might_contain("<bar@example.org>"))
+
+        reports.get.store_seen(self.options)
+        self.assertTrue(os.path.isfile(self.options[utils.SEEN_FILE]))
+
+
+class TestGetPublicInbox(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.options = {utils.PUBLIC_INBOXES: self.path}
+
+        self.state = {}
+        for name, function in [
+                ("load_sync_state",
+                 lambda options, state_id: self.state.get(state_id)),
+                ("save_inbox_state", self._save_state)]:
+            patcher = unittest.mock.patch.object(reports.get, name, function)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def _save_state(self, options, state_id, last_commit):
+        self.state[state_id] = {"last_commit": last_commit}
+
+    def _check(self):
+        return _collect(reports.get.check_from_public_inbox(self.options))
+
+    def test_first_check_skips_archive(self):
+        repository = init_epoch(self.path, 0)
+        head = add_message(repository, REQUEST_HEADERS)
+
+        self.assertListEqual([], self._check())
+        self.assertListEqual(
+            [head], [state["last_commit"] for state in self.state.values()])
+
+    def test_new_messages(self):
+        repository = init_epoch(self.path, 0)
+        add_message(repository, REQUEST_HEADERS)
+        self._check()
+
+        add_message(repository, REPLY_HEADERS)
+        head = add_message(repository, REQUEST_HEADERS + b"body\n")
+
+        parsed = self._check()
+
+        self.assertEqual(1, len(parsed))
+        self.assertEqual(
+            "<20160101000000.000000000@example.org>",
+            parsed[0]["message_id"])
+        self.assertListEqual(
+            [head], [state["last_commit"] for state in self.state.values()])
+        self.assertListEqual([], self._check())
+
+    def test_new_epoch(self):
+        repository = init_epoch(self.path, 0)
+        add_message(repository, REPLY_HEADERS)
+        self._check()
+
+        repository = init_epoch(self.path, 1)
+        add_message(repository, REQUEST_HEADERS)
+
+        self.assertEqual(1, len(self._check()))
+        self.assertEqual(2, len(self.state))
+
+    def test_batches(self):
+        self.options[utils.BATCH_SIZE] = 1
+        repository = init_epoch(self.path, 0)
+        add_message(repository, REPLY_HEADERS)
+        self._check()
+
+        first = add_message(repository, REQUEST_HEADERS)
+        add_message(repository, REQUEST_HEADERS + b"body\n")
+
+        batches = reports.get.check_from_public_inbox(self.options)
+        self.assertEqual(1, len(next(batches)))
+        next(batches)
+        self.assertListEqual(
+            [first], [state["last_commit"] for state in self.state.values()])
+        batches.close()
+
+
+class TestGetJournal(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        patcher = unittest.mock.patch.object(
+            reports.get, "JOURNAL", utils.journal.Journal())
+        self.addCleanup(patcher.stop)
+        self.journal = patcher.start()
+        self.journal.open(os.path.join(path, "journal.sqlite"))
+        self.addCleanup(self.journal.close)
+
+        patcher = unittest.mock.patch("reports.get.save")
+        self.addCleanup(patcher.stop)
+        self.save = patcher.start()
+
+        self.data = [
+            {"message_id": "<{0:d}@example.org>".format(idx), "subject": "s"}
+            for idx in range(3)
+        ]
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_enqueue(self):
+        reports.get.enqueue({}, self.data)
+
+        self.save.assert_not_called()
+        self.assertEqual(3, self.journal.count())
+
+    def test_flush(self):
+        reports.get.enqueue({}, self.data)
+
+        self.assertEqual(3, reports.get.flush({utils.BATCH_SIZE: 2}))
+        self.assertEqual(2, self.save.call_count)
+        self.assertListEqual(
+            self.data,
+            [doc for call in self.save.call_args_list for doc in call[0][1]])
+        self.assertEqual(0, self.journal.count())
+
+    def test_flush_database_down(self):
+        self.save.side_effect = \
+            pymongo.errors.ServerSelectionTimeoutError("down")
+        reports.get.enqueue({}, self.data)
+
+        with self.assertRaises(pymongo.errors.PyMongoError):
+            reports.get.flush({})
+        self.assertEqual(3, self.journal.count())
+
+        self.save.side_effect = None
+        self.assertEqual(3, reports.get.flush({}))
+        self.assertEqual(0, self.journal.count())
@@ -0,0 +1,131 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""mbox import test module."""
+
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import reports.get
+import reports.importer
+import utils
+
+
+def _request(idx, deadline):
+    return (
+        "From gregkh@example.org Fri Jan  1 00:00:00 2016\n"
+        "From: Greg KH <gregkh@example.org>\n"
+        "To: linux-kernel@example.org\n"
+        "Subject: [PATCH 4.1 00/45] 4.1.{0:d}-stable review\n"
+        "Message-Id: <{0:d}@example.org>\n"
+        "Date: Fri, 01 Jan 2016 00:00:00 +0000\n"
+        "X-KernelTest-Deadline: {1:s}\n"
+        "\n"
+        "body\n"
+        "\n".format(idx, deadline)
+    ).encode()
+
+
+REPLY = (
+    b"From someone@example.org Fri Jan  1 00:00:00 2016\n"
+    b"Subject: Re: [PATCH 4.1 00/45] 4.1.1-stable review\n"
+    b"Message-Id: <reply@example.org>\n"
+    b"In-Reply-To: <1@example.org>\n"
+    b"Date: Fri, 01 Jan 2016 00:00:01 +0000\n"
+    b"\n"
+    b"body\n"
+    b"\n"
+)
+
+
+class TestImporter(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.mbox = os.path.join(path, "mbox")
+
+        patcher = unittest.mock.patch("reports.get.save")
+        self.addCleanup(patcher.stop)
+        self.save = patcher.start()
+        self.save.side_effect = lambda options, data: \
+            [reports.get.SAVE_NEW] * len(data)
+
+        self.now = datetime.datetime(
+            2016, 1, 2, tzinfo=datetime.timezone.utc)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def _write(self, content):
+        with open(self.mbox, "wb") as write_file:
+            write_file.write(content)
+
+    def test_import_mbox(self):
+        self._write(
+            _request(1, "2016-01-03T00:00+00:00") +
+            REPLY +
+            _request(2, "2016-01-01T12:00+00:00") +
+            _request(3, "2016-01-04T00:00+00:00"))
+
+        stats = reports.importer.import_mbox(
+            {utils.BATCH_SIZE: 2, utils.PARSE_WORKERS: 1},
+            self.mbox, now=self.now)
+
+        self.assertEqual(4, stats["messages"])
+        self.assertEqual(2, stats["queued"])
+        self.assertEqual(1, stats["expired"])
+        self.assertEqual(1, stats["ignored"])
+        self.assertEqual(2, self.save.call_count)
+        self.assertListEqual(
+            ["<1@example.org>", "<3@example.org>"],
+            [
+                email_data["message_id"]
+                for call in self.save.call_args_list
+                for email_data in call[0][1]
+            ])
+
+    def test_import_mbox_deadline_too_close(self):
+        # Sent by the backend after the deadline.
+        self._write(_request(1, "2016-01-02T02:00+00:00"))
+
+        stats = reports.importer.import_mbox(
+            {utils.PARSE_WORKERS: 1}, self.mbox, now=self.now)
+
+        self.assertEqual(0, stats["queued"])
+        self.assertEqual(1, stats["expired"])
+
+    def test_import_mbox_processes(self):
+        self._write(b"".join(
+            _request(idx, "2016-01-03T00:00+00:00") for idx in range(20)))
+
+        stats = reports.importer.import_mbox(
+            {utils.PARSE_WORKERS: 2, utils.PARSE_THRESHOLD: 1},
+            self.mbox, now=self.now)
+
+        self.assertEqual(20, stats["queued"])
+
+    def test_import_mbox_empty(self):
+        self._write(b"")
+
+        stats = reports.importer.import_mbox({}, self.mbox, now=self.now)
+
+        self.assertEqual(0, stats["messages"])
+        self.save.assert_not_called()
@@ -13,10 +13,21 @@
 
 """Email utilities test module."""
 
+import datetime
 import logging
+import os
+import threading
 import unittest
+import unittest.mock
+
+import pymongo
 
 import reports.send
+import utils
+import utils.db
+
+# A single node replica set to test the change streams with, as host:port.
+REPLICA_SET_ENV = "KERNELCI_REPORTS_TEST_REPLICA_SET"
 
 
 class TestEmails(unittest.TestCase):
@@ -59,3 +70,852 @@ class TestEmails(unittest.TestCase):
         }
 
         self.assertFalse(reports.send.is_valid_result(result, report))
+
+
+class QueueTestCase(unittest.TestCase):
+    """Mock the database collections and the backend."""
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        patcher = unittest.mock.patch("utils.db.get_connection")
+        self.addCleanup(patcher.stop)
+        connection = patcher.start().return_value
+
+        self.queued = unittest.mock.MagicMock()
+        self.processed = unittest.mock.MagicMock()
+        self.state = unittest.mock.MagicMock()
+        collections = {
+            utils.db.DB_CHECK_QUEUE: self.queued,
+            utils.db.DB_PROCESSED: self.processed,
+            utils.db.DB_MAIL_STATE: self.state
+        }
+        database = unittest.mock.MagicMock()
+        database.__getitem__.side_effect = collections.__getitem__
+        connection.__getitem__.return_value = database
+
+        patcher = unittest.mock.patch("utils.backend.get")
+        self.addCleanup(patcher.stop)
+        self.backend_get = patcher.start()
+        self.backend_get.return_value.status_code = 400
+
+        self.options = {
+            utils.BACKEND_URL: "https://api.example.org",
+            utils.BACKEND_TOKEN: "token"
+        }
+
+        reports.send.STATS.reset()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def _reports(self, count, days=1):
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(days=days)
+        return [
+            {
+                "_id": idx,
+                "message_id": "<{0:d}@example.org>".format(idx),
+                "tree": "stable",
+                "version": "4.4.{0:d}".format(idx),
+                "deadline": deadline
+            }
+            for idx in range(count)
+        ]
+
+    def _writes(self, collection, request_type):
+        """Get the bulk written requests of a type."""
+        return [
+            request
+            for call in collection.bulk_write.call_args_list
+            for request in call[0][0]
+            if isinstance(request, request_type)
+        ]
+
+    def _deleted(self):
+        """Get the IDs of the reports removed from the queue."""
+        return [
+            request._filter["_id"]  # pylint: disable=protected-access
+            for request in self._writes(self.queued, pymongo.DeleteOne)
+        ]
+
+    def _next_checks(self):
+        """Get the next check times written into the queue."""
+        return [
+            # pylint: disable=protected-access
+            request._doc["$set"]["next_check_at"]
+            for request in self._writes(self.queued, pymongo.UpdateOne)
+        ]
+
+
+class TestCheckAndSend(QueueTestCase):
+
+    def test_check_and_send_concurrent(self):
+        self.queued.find.return_value = self._reports(3)
+        self.options[utils.SEND_WORKERS] = 3
+        # All the requests must be in flight at the same time to pass.
+        barrier = threading.Barrier(3, timeout=5.0)
+
+        def backend_get(url, params):
+            barrier.wait()
+            return unittest.mock.DEFAULT
+        self.backend_get.side_effect = backend_get
+
+        reports.send.check_and_send(self.options)
+
+        self.assertEqual(3, self.backend_get.call_count)
+        # All the outcomes are written at once.
+        self.queued.bulk_write.assert_called_once()
+        self.processed.bulk_write.assert_called_once()
+        self.assertListEqual([0, 1, 2], sorted(self._deleted()))
+        self.assertEqual(
+            3, len(self._writes(self.processed, pymongo.UpdateOne)))
+
+    def test_check_and_send_sequential(self):
+        self.queued.find.return_value = self._reports(2)
+        self.options[utils.SEND_WORKERS] = 1
+
+        reports.send.check_and_send(self.options)
+
+        self.assertListEqual(
+            ["4.4.0", "4.4.1"],
+            [
+                dict(call[0][1])["kernel_version"]
+                for call in self.backend_get.call_args_list
+            ])
+
+    def test_check_and_send_report_error(self):
+        self.queued.find.return_value = self._reports(2)
+        self.backend_get.side_effect = [
+            OSError("connection reset"), self.backend_get.return_value]
+
+        reports.send.check_and_send(self.options)
+
+        self.assertEqual(2, self.backend_get.call_count)
+        self.assertListEqual([1], self._deleted())
+
+    def test_check_and_send_expired(self):
+        self.queued.delete_many.return_value.deleted_count = 3
+        self.queued.find.return_value = []
+        before = datetime.datetime.utcnow()
+
+        reports.send.check_and_send(self.options)
+
+        self.backend_get.assert_not_called()
+        pipeline = self.queued.aggregate.call_args[0][0]
+        limit = self.queued.delete_many.call_args[0][0]["deadline"]["$lte"]
+        self.assertDictEqual(
+            {"deadline": {"$lte": limit}, "message_id": {"$ne": None}},
+            pipeline[0]["$match"])
+        self.assertEqual(
+            utils.db.DB_PROCESSED, pipeline[-1]["$merge"]["into"])
+        self.assertGreaterEqual(
+            limit,
+            before + datetime.timedelta(seconds=reports.send.SEND_DELAY))
+
+    def test_check_and_send_deadline_order(self):
+        self.queued.find.return_value = []
+        self.options[utils.QUEUE_ORDER] = reports.send.QUEUE_ORDER_DEADLINE
+        before = datetime.datetime.utcnow()
+
+        reports.send.check_and_send(self.options)
+
+        spec, kwargs = self.queued.find.call_args
+        self.assertListEqual(
+            [("deadline", pymongo.ASCENDING)], kwargs["sort"])
+        self.assertGreaterEqual(
+            spec[0]["deadline"]["$gt"],
+            before + datetime.timedelta(seconds=reports.send.SEND_DELAY))
+
+    def test_check_and_send_expired_pending_stats(self):
+        self.queued.delete_many.return_value.deleted_count = 2
+        self.queued.find.return_value = self._reports(1, days=0)
+
+        reports.send.check_and_send(self.options)
+
+        self.assertEqual(3, reports.send.queue_stats()["expired_pending"])
+        self.assertEqual(0, reports.send.queue_stats()["sent"])
+
+    def test_check_and_send_expired_while_checking(self):
+        self.queued.find.return_value = self._reports(1, days=0)
+
+        reports.send.check_and_send(self.options)
+
+        self.backend_get.assert_not_called()
+        self.assertListEqual([0], self._deleted())
+
+    def test_check_and_send_by_tree(self):
+        queued = self._reports(4)
+        queued[3]["tree"] = "stable-rc"
+        queued[3]["branch"] = "linux-4.4.y"
+        for report in queued:
+            report["patches"] = ["10"]
+        self.queued.find.return_value = queued
+        self.options[utils.JOB_FETCH_MODE] = reports.send.JOB_FETCH_MODE_TREE
+
+        self.backend_get.return_value.status_code = 200
+        self.backend_get.return_value.json.return_value = {
+            "count": 2,
+            "result": [
+                {
+                    "job": "stable",
+                    "kernel": "v4.4.0-10-gabc",
+                    "git_branch": "linux-4.4.y",
+                    "git_describe": "v4.4.0-10-gabc",
+                    "status": "FAIL"
+                },
+                {
+                    "job": "stable",
+                    "kernel": "v4.4.1-10-gdef",
+                    "git_branch": "linux-4.4.y",
+                    "git_describe": "v4.4.1-10-gdef",
+                    "status": "BUILD"
+                }
+            ]
+        }
+
+        reports.send.check_and_send(self.options)
+
+        self.assertListEqual(
+            [
+                [
+                    ("job", "stable"),
+                    ("kernel_version", "4.4.0"),
+                    ("kernel_version", "4.4.1"),
+                    ("kernel_version", "4.4.2")
+                ],
+                [
+                    ("job", "stable-rc"),
+                    ("kernel_version", "4.4.3"),
+                    ("git_branch", "linux-4.4.y")
+                ]
+            ],
+            sorted(call[0][1] for call in self.backend_get.call_args_list))
+        # Only the failed job is removed.
+        self.assertListEqual([0], self._deleted())
+
+    def test_check_and_send_by_tree_max_versions(self):
+        self.queued.find.return_value = self._reports(5)
+        self.options[utils.JOB_FETCH_MODE] = reports.send.JOB_FETCH_MODE_TREE
+
+        with unittest.mock.patch("reports.send.MAX_TREE_VERSIONS", 2):
+            reports.send.check_and_send(self.options)
+
+        self.assertEqual(3, self.backend_get.call_count)
+        # A bad request discards all the reports of the group.
+        self.assertEqual(5, len(self._deleted()))
+
+    def test_job_index(self):
+        index = reports.send.JobIndex([
+            {"git_describe": "v4.4.30-44-gb580d5c9a21f"},
+            {"git_describe_v": "v4.4.30-45-g0123456789ab"},
+            {"git_describe": "v4.4.31-44-gb580d5c9a21f"},
+            {"git_describe": None}
+        ])
+
+        results = index.lookup({"version": "4.4.30", "patches": ["44", "45"]})
+
+        self.assertListEqual(
+            ["v4.4.30-44-gb580d5c9a21f", "v4.4.30-45-g0123456789ab"],
+            [
+                result.get("git_describe") or result.get("git_describe_v")
+                for result in results
+            ])
+        self.assertListEqual(
+            [], index.lookup({"version": "4.4.3", "patches": ["44"]}))
+
+    def test_check_and_send_due_only(self):
+        self.queued.find.return_value = []
+
+        reports.send.check_and_send(self.options)
+
+        spec, kwargs = self.queued.find.call_args
+        self.assertIn({"next_check_at": None}, spec[0]["$or"])
+        self.assertListEqual(reports.send.QUEUE_FIELDS, kwargs["projection"])
+
+    def test_check_and_send_building(self):
+        queued = self._reports(1, days=2)
+        queued[0]["patches"] = ["10"]
+        queued[0]["attempts"] = 2
+        self.queued.find.return_value = queued
+
+        self.backend_get.return_value.status_code = 200
+        self.backend_get.return_value.json.return_value = {
+            "count": 1,
+            "result": [
+                {
+                    "job": "stable",
+                    "kernel": "v4.4.0-10-gabc",
+                    "git_branch": "linux-4.4.y",
+                    "git_describe": "v4.4.0-10-gabc",
+                    "status": "BUILD"
+                }
+            ]
+        }
+
+        before = datetime.datetime.utcnow()
+        reports.send.check_and_send(self.options)
+
+        self.assertListEqual([], self._deleted())
+        request = self._writes(self.queued, pymongo.UpdateOne)[0]
+        # pylint: disable=protected-access
+        self.assertDictEqual({"_id": 0}, request._filter)
+        self.assertDictEqual({"attempts": 1}, request._doc["$inc"])
+        delay = request._doc["$set"]["next_check_at"] - before
+        self.assertAlmostEqual(1200, delay.total_seconds(), delta=5)
+
+    def test_reschedule_backoff(self):
+        outcomes = reports.send.Outcomes()
+        report = self._reports(1, days=30)[0]
+        first, maximum = reports.send.RETRY_BACKOFFS[
+            reports.send.RETRY_MAINTENANCE]
+
+        before = []
+        for attempts in range(5):
+            report["attempts"] = attempts
+            before.append(datetime.datetime.utcnow())
+            reports.send.reschedule(
+                outcomes, report, reports.send.RETRY_MAINTENANCE)
+        outcomes.write(utils.db.get_connection({})[utils.db.DB_NAME])
+
+        self.assertListEqual(
+            [first, first * 2, first * 4, maximum, maximum],
+            [
+                round((next_check - start).total_seconds())
+                for next_check, start in zip(self._next_checks(), before)
+            ])
+
+    def test_handle_result_status_codes(self):
+        outcomes = reports.send.Outcomes()
+        response = unittest.mock.MagicMock()
+
+        for report, status_code in zip(self._reports(3), [502, 504, 404]):
+            response.status_code = status_code
+            reports.send.handle_result(response, report, outcomes, {})
+
+        self.assertSetEqual(set([0, 1]), set(outcomes.next_checks))
+        self.assertSetEqual(set([2]), outcomes.done)
+        self.assertEqual(
+            1, outcomes.counters[reports.send.OUTCOME_COUNTERS[
+                reports.send.OUTCOME_DISCARDED]])
+
+    def test_reschedule_before_deadline(self):
+        outcomes = reports.send.Outcomes()
+        report = self._reports(1)[0]
+        report["deadline"] = datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=reports.send.SEND_DELAY + reports.send.RETRY_MARGIN + 60)
+
+        reports.send.reschedule(
+            outcomes, report, reports.send.RETRY_NO_RESULTS)
+        outcomes.write(utils.db.get_connection({})[utils.db.DB_NAME])
+
+        self.assertListEqual(
+            [
+                report["deadline"] - datetime.timedelta(
+                    seconds=(
+                        reports.send.SEND_DELAY + reports.send.RETRY_MARGIN))
+            ],
+            self._next_checks())
+
+    def test_reschedule_at_expiry(self):
+        outcomes = reports.send.Outcomes()
+        report = self._reports(1)[0]
+        report["deadline"] = datetime.datetime.utcnow() + datetime.timedelta(
+            seconds=reports.send.SEND_DELAY + reports.send.RETRY_MARGIN / 2)
+
+        reports.send.reschedule(
+            outcomes, report, reports.send.RETRY_BUILD)
+
+        self.assertEqual(
+            report["deadline"] - datetime.timedelta(
+                seconds=reports.send.SEND_DELAY),
+            outcomes.next_checks[0])
+
+    def test_outcomes_duplicate_processed(self):
+        self.processed.bulk_write.side_effect = \
+            pymongo.errors.BulkWriteError({
+                "writeErrors": [
+                    {
+                        "index": 1,
+                        "code": reports.send.DUPLICATE_KEY_ERROR,
+                        "errmsg": "duplicate key"
+                    }
+                ]
+            })
+        outcomes = reports.send.Outcomes()
+
+        for report_id in [1, 2]:
+            outcomes.remove(
+                {"_id": report_id, "message_id": "<1@example.org>"},
+                reports.send.OUTCOME_SENT)
+        outcomes.write(utils.db.get_connection({})[utils.db.DB_NAME])
+
+        self.assertListEqual([1, 2], self._deleted())
+        self.assertEqual(0, outcomes.rescheduled)
+        self.assertEqual(2, outcomes.removed)
+
+    def test_outcomes_sent_written_at_once(self):
+        database = utils.db.get_connection({})[utils.db.DB_NAME]
+        outcomes = reports.send.Outcomes(database=database)
+        sent, failed = self._reports(2)
+
+        outcomes.remove(sent, reports.send.OUTCOME_SENT)
+        outcomes.remove(failed, reports.send.OUTCOME_FAILED)
+
+        # The sent report is removed before the end of the cycle.
+        self.assertListEqual([0], self._deleted())
+        self.assertEqual(
+            1, len(self._writes(self.processed, pymongo.UpdateOne)))
+
+        outcomes.write(database)
+
+        self.assertListEqual([0, 1], self._deleted())
+        self.assertEqual(2, outcomes.removed)
+        self.assertSetEqual(set([0, 1]), outcomes.done)
+
+    def test_outcomes_sent_write_error(self):
+        database = utils.db.get_connection({})[utils.db.DB_NAME]
+        outcomes = reports.send.Outcomes(database=database)
+        self.processed.bulk_write.side_effect = [
+            pymongo.errors.AutoReconnect("connection reset"), None]
+
+        outcomes.remove(self._reports(1)[0], reports.send.OUTCOME_SENT)
+
+        self.assertListEqual([], self._deleted())
+
+        outcomes.write(database)
+
+        # Written again with the other outcomes.
+        self.assertListEqual([0], self._deleted())
+        self.assertEqual(2, self.processed.bulk_write.call_count)
+
+
+class TestScheduler(QueueTestCase):
+
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+        self.scheduler = reports.send.Scheduler(self.options)
+        self.now = datetime.datetime.utcnow()
+
+    def test_load(self):
+        self.queued.find.return_value = [
+            {"_id": 1, "next_check_at": self.now + datetime.timedelta(1)},
+            {"_id": 2}
+        ]
+
+        self.assertEqual(2, self.scheduler.load())
+
+        self.queued.delete_many.assert_called_once()
+        self.assertListEqual(
+            [2], self.scheduler.timers.pop_due(datetime.datetime.utcnow()))
+        self.assertIn(1, self.scheduler.timers)
+
+    def test_load_keeps_heap(self):
+        timers = self.scheduler.timers
+        timers.schedule(3, self.now)
+
+        def find(projection):
+            # A report scheduled by another thread during the load.
+            timers.schedule(4, self.now)
+            return [{"_id": 1}]
+        self.queued.find.side_effect = find
+
+        self.assertEqual(2, self.scheduler.load())
+
+        self.assertIs(timers, self.scheduler.timers)
+        self.assertNotIn(3, timers)
+        self.assertListEqual(
+            [1, 4], sorted(timers.pop_due(datetime.datetime.utcnow())))
+
+    def test_add_new(self):
+        self.scheduler.timers.schedule(1, self.now + datetime.timedelta(1))
+        self.queued.find.return_value = [{"_id": 1}, {"_id": 2}]
+
+        self.assertEqual(1, self.scheduler.add_new())
+
+        self.assertDictEqual(
+            {"next_check_at": None}, self.queued.find.call_args[0][0])
+        self.assertListEqual(
+            [2],
+            self.scheduler.timers.pop_due(datetime.datetime.utcnow()))
+
+    def test_check_due(self):
+        queued = self._reports(3, days=2)
+        for report in queued:
+            report["patches"] = ["10"]
+            self.scheduler.timers.schedule(report["_id"], self.now)
+        not_due = self.now + datetime.timedelta(hours=1)
+        self.scheduler.timers.schedule(3, not_due)
+        self.queued.find.return_value = queued
+
+        self.backend_get.return_value.status_code = 200
+        self.backend_get.return_value.json.return_value = {
+            "count": 2,
+            "result": [
+                {
+                    "job": "stable",
+                    "kernel": "v4.4.0-10-gabc",
+                    "git_branch": "linux-4.4.y",
+                    "git_describe": "v4.4.0-10-gabc",
+                    "status": "FAIL"
+                },
+                {
+                    "job": "stable",
+                    "kernel": "v4.4.1-10-gdef",
+                    "git_branch": "linux-4.4.y",
+                    "git_describe": "v4.4.1-10-gdef",
+                    "status": "BUILD"
+                }
+            ]
+        }
+        error = OSError("connection reset")
+
+        def backend_get(url, params):
+            if ("kernel_version", "4.4.2") in params:
+                raise error
+            return unittest.mock.DEFAULT
+        self.backend_get.side_effect = backend_get
+
+        self.assertEqual(3, self.scheduler.check_due(self.now))
+
+        self.assertListEqual(
+            [0, 1, 2], self.queued.find.call_args[0][0]["_id"]["$in"])
+        self.assertListEqual([0], self._deleted())
+        # The building job and the failed check are scheduled again, the
+        # failed job is done.
+        timers = self.scheduler.timers
+        self.assertNotIn(0, timers)
+        self.assertEqual(self._next_checks()[0], timers.due_time(1))
+        self.assertEqual(
+            self.now + datetime.timedelta(
+                seconds=reports.send.RETRY_BACKOFFS[
+                    reports.send.RETRY_BACKEND_ERROR][0]),
+            timers.due_time(2))
+        self.assertEqual(not_due, timers.due_time(3))
+
+    def test_check_due_error(self):
+        for report_id in range(2):
+            self.scheduler.timers.schedule(report_id, self.now)
+        self.queued.find.side_effect = OSError("connection reset")
+
+        self.assertRaises(OSError, self.scheduler.check_due, self.now)
+
+        retry = self.now + datetime.timedelta(
+            seconds=reports.send.RETRY_BACKOFFS[
+                reports.send.RETRY_BACKEND_ERROR][0])
+        self.assertEqual(retry, self.scheduler.timers.due_time(0))
+        self.assertEqual(retry, self.scheduler.timers.due_time(1))
+
+    def test_check_due_nothing_due(self):
+        self.scheduler.timers.schedule(1, self.now + datetime.timedelta(1))
+
+        self.assertEqual(0, self.scheduler.check_due(self.now))
+
+        self.queued.find.assert_not_called()
+
+    def test_run_period(self):
+        self.queued.find.return_value = []
+        stop = unittest.mock.MagicMock()
+        stop.is_set.return_value = False
+
+        self.scheduler.run(stop, 0)
+
+        stop.wait.assert_not_called()
+        self.queued.delete_many.assert_called_once()
+
+    def test_run_stop(self):
+        self.queued.find.return_value = []
+        stop = threading.Event()
+        stop.set()
+
+        self.scheduler.run(stop, 3600)
+
+        self.backend_get.assert_not_called()
+
+
+class TestLease(QueueTestCase):
+
+    def setUp(self):
+        super(TestLease, self).setUp()
+        self.lease = reports.send.Lease(
+            self.options, duration=60.0, owner="host:1")
+
+        patcher = unittest.mock.patch("utils.backend.post")
+        self.addCleanup(patcher.stop)
+        self.backend_post = patcher.start()
+        self.backend_post.return_value.status_code = 202
+
+    def _claims(self, queued, owners=None):
+        owners = owners or [None] * len(queued)
+        for report, owner in zip(queued, owners):
+            if owner:
+                report["lease_owner"] = owner
+        self.queued.find_one_and_update.side_effect = queued + [None]
+
+    def test_claim(self):
+        queued = self._reports(2)
+        self._claims(queued, [None, "host:2"])
+        before = datetime.datetime.utcnow()
+
+        claimed = self.lease.claim()
+
+        self.assertListEqual([0, 1], [report["_id"] for report in claimed])
+        self.assertNotIn("lease_owner", claimed[1])
+        self.assertSetEqual({0, 1}, self.lease.held)
+        self.assertEqual(1, reports.send.queue_stats()["taken_over"])
+
+        args, kwargs = self.queued.find_one_and_update.call_args
+        self.assertEqual("host:1", args[1]["$set"]["lease_owner"])
+        self.assertGreaterEqual(
+            args[1]["$set"]["next_check_at"],
+            before + datetime.timedelta(seconds=60))
+        self.assertEqual(
+            pymongo.ReturnDocument.BEFORE, kwargs["return_document"])
+
+    def test_claim_limit(self):
+        self._claims(self._reports(3))
+
+        self.assertEqual(2, len(self.lease.claim(limit=2)))
+        self.assertEqual(2, self.queued.find_one_and_update.call_count)
+
+    def test_renew(self):
+        self.lease.held.update([1, 2])
+        self.queued.update_many.return_value.matched_count = 1
+
+        self.assertEqual(1, self.lease.renew())
+
+        spec = self.queued.update_many.call_args[0][0]
+        self.assertEqual("host:1", spec["lease_owner"])
+        self.assertListEqual([1, 2], sorted(spec["_id"]["$in"]))
+
+    def test_check_and_send(self):
+        queued = self._reports(2)
+        self._claims(queued)
+        self.backend_get.return_value.status_code = 503
+
+        reports.send.check_and_send(self.options, lease=self.lease)
+
+        requests = self._writes(self.queued, pymongo.UpdateOne)
+        self.assertEqual(2, len(requests))
+        for request in requests:
+            # pylint: disable=protected-access
+            self.assertEqual("host:1", request._filter["lease_owner"])
+            self.assertDictEqual(
+                {"lease_owner": ""}, request._doc["$unset"])
+        self.assertSetEqual(set(), self.lease.held)
+
+    def _passed_report(self):
+        queued = self._reports(1, days=2)
+        queued[0]["patches"] = ["10"]
+        queued[0]["from"] = ("Greg KH", "gregkh@example.org")
+        self._claims(queued)
+
+        job = unittest.mock.MagicMock(status_code=200)
+        job.json.return_value = {
+            "count": 1,
+            "result": [
+                {
+                    "job": "stable",
+                    "kernel": "v4.4.0-10-gabc",
+                    "git_branch": "linux-4.4.y",
+                    "git_describe": "v4.4.0-10-gabc",
+                    "status": "PASS"
+                }
+            ]
+        }
+        boots = unittest.mock.MagicMock(status_code=200)
+        boots.json.return_value = {"result": [{"count": 1}]}
+        self.backend_get.side_effect = [job, boots]
+
+    def test_check_and_send_lease_held(self):
+        self._passed_report()
+        self.queued.update_one.return_value.matched_count = 1
+
+        reports.send.check_and_send(self.options, lease=self.lease)
+
+        self.backend_post.assert_called_once()
+        self.assertListEqual([0], self._deleted())
+        # pylint: disable=protected-access
+        self.assertEqual(
+            "host:1",
+            self._writes(self.queued, pymongo.DeleteOne)[0]._filter[
+                "lease_owner"])
+
+    def test_check_and_send_lease_lost(self):
+        self._passed_report()
+        self.queued.update_one.return_value.matched_count = 0
+
+        reports.send.check_and_send(self.options, lease=self.lease)
+
+        self.backend_post.assert_not_called()
+        self.assertListEqual([], self._deleted())
+
+
+class TestSchedulerWatch(QueueTestCase):
+
+    def setUp(self):
+        super(TestSchedulerWatch, self).setUp()
+        self.scheduler = reports.send.Scheduler(self.options)
+        self.now = datetime.datetime.utcnow()
+
+    def _change(self, operation, report_id, **kwargs):
+        change = {
+            "operationType": operation,
+            "documentKey": {"_id": report_id}
+        }
+        change.update(kwargs)
+        return change
+
+    def test_handle_change_insert(self):
+        self.scheduler.handle_change(
+            self._change("insert", 1, fullDocument={"_id": 1}))
+
+        self.assertTrue(self.scheduler.wakeup.is_set())
+        self.assertIn(1, self.scheduler.timers)
+
+    def test_handle_change_update(self):
+        later = self.now + datetime.timedelta(hours=1)
+
+        self.scheduler.handle_change(self._change(
+            "update", 1,
+            updateDescription={"updatedFields": {"next_check_at": later}}))
+        self.scheduler.handle_change(self._change(
+            "update", 2,
+            updateDescription={"updatedFields": {"attempts": 1}}))
+
+        self.assertFalse(self.scheduler.wakeup.is_set())
+        self.assertEqual(later, self.scheduler.timers.next_due())
+        self.assertEqual(1, len(self.scheduler.timers))
+
+    def test_handle_change_delete(self):
+        self.scheduler.timers.schedule(1, self.now)
+
+        self.scheduler.handle_change(self._change("delete", 1))
+
+        self.assertNotIn(1, self.scheduler.timers)
+
+    def test_watch_not_supported(self):
+        self.state.find_one.return_value = None
+        self.queued.watch.side_effect = pymongo.errors.OperationFailure(
+            "not a replica set", code=40573)
+
+        self.assertFalse(self.scheduler.watch(threading.Event()))
+        self.assertFalse(self.scheduler.streaming.is_set())
+
+    def test_watch_resume(self):
+        stop = threading.Event()
+        self.state.find_one.return_value = {"resume_token": {"_data": "1"}}
+
+        stream = self.queued.watch.return_value.__enter__.return_value
+        stream.alive = True
+        stream.resume_token = {"_data": "2"}
+
+        def try_next():
+            stop.set()
+            return self._change("insert", 1, fullDocument={"_id": 1})
+        stream.try_next.side_effect = try_next
+
+        self.assertTrue(self.scheduler.watch(stop))
+
+        self.assertEqual(
+            {"_data": "1"}, self.queued.watch.call_args[1]["resume_after"])
+        self.assertIn(1, self.scheduler.timers)
+        self.state.update_one.assert_called_once_with(
+            {"_id": reports.send.STREAM_STATE_ID},
+            {"$set": {"resume_token": {"_data": "2"}}},
+            upsert=True)
+
+    def test_watch_resume_token_lost(self):
+        stop = threading.Event()
+        self.state.find_one.return_value = {"resume_token": {"_data": "1"}}
+
+        stream = unittest.mock.MagicMock(alive=False)
+        context = unittest.mock.MagicMock()
+        context.__enter__.side_effect = [
+            pymongo.errors.OperationFailure("history lost", code=286),
+            stream
+        ]
+
+        def watch(pipeline, resume_after=None, max_await_time_ms=None):
+            if resume_after is None:
+                stop.set()
+            return context
+        self.queued.watch.side_effect = watch
+
+        self.assertTrue(self.scheduler.watch(stop))
+
+        self.assertListEqual(
+            [{"_data": "1"}, None],
+            [
+                call[1]["resume_after"]
+                for call in self.queued.watch.call_args_list
+            ])
+
+
+@unittest.skipUnless(
+    os.environ.get(REPLICA_SET_ENV, None),
+    "set {0:s} to a replica set to run".format(REPLICA_SET_ENV))
+class TestSchedulerWatchReplicaSet(unittest.TestCase):
+    """Follow the changes on a real replica set.
+
+    A local single node replica set can be started with:
+
+        mongod --replSet rs0 --dbpath <dir>
+        mongosh --eval "rs.initiate()"
+    """
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        host, _, port = os.environ[REPLICA_SET_ENV].partition(":")
+        self.options = {
+            utils.DB_SERVER: host,
+            utils.DB_SERVER_PORT: port or None
+        }
+
+        patcher = unittest.mock.patch.object(
+            utils.db, "DB_NAME", "kernelci-reports-test")
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+        self.addCleanup(utils.db.close_connection)
+        connection = utils.db.get_connection(self.options)
+        connection.drop_database(utils.db.DB_NAME)
+        self.addCleanup(connection.drop_database, utils.db.DB_NAME)
+        self.queue = connection[utils.db.DB_NAME][utils.db.DB_CHECK_QUEUE]
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def _watch(self, scheduler):
+        stop = threading.Event()
+        thread = threading.Thread(target=scheduler.watch, args=(stop,))
+        thread.start()
+
+        def _stop():
+            stop.set()
+            thread.join()
+        self.addCleanup(_stop)
+
+        self.assertTrue(scheduler.streaming.wait(10.0))
+        return _stop
+
+    def test_watch(self):
+        scheduler = reports.send.Scheduler(self.options)
+        stop = self._watch(scheduler)
+
+        self.queue.insert_one({"_id": 1})
+        self.assertTrue(scheduler.wakeup.wait(10.0))
+        self.assertIn(1, scheduler.timers)
+        stop()
+
+        self.assertIsNotNone(reports.send.load_resume_token(self.options))
+
+        # Changes while not watching are read after a restart.
+        self.queue.insert_one({"_id": 2})
+        scheduler = reports.send.Scheduler(self.options)
+        self._watch(scheduler)
+
+        self.assertTrue(scheduler.wakeup.wait(10.0))
+        self.assertIn(2, scheduler.timers)
+        self.assertNotIn(1, scheduler.timers)
+
@@ -16,7 +16,19 @@
 import unittest
 
 TEST_MODULES = [
+    "utils.tests.test_backend",
+    "utils.tests.test_db",
     "utils.tests.test_emails",
+    "utils.tests.test_imap",
+    "utils.tests.test_journal",
+    "utils.tests.test_lmtp",
+    "utils.tests.test_maildir",
+    "utils.tests.test_mbox",
+    "utils.tests.test_publicinbox",
+    "utils.tests.test_seen",
+    "utils.tests.test_timers",
+    "reports.tests.test_get",
+    "reports.tests.test_importer",
     "reports.tests.test_send"
 ]
 
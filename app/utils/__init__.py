@@ -16,9 +16,17 @@
 # Where to read the configuration from by default.
 DEFAULT_CONFIG_FILE = "/etc/linaro/kernelci-reports.cfg"
 CONFIG_SECTION = "kernelci"
+# Configuration sections with more mail accounts: [mail:<name>].
+CONFIG_MAIL_SECTION_PREFIX = "mail:"
+# Default IMAP server parameter to connect to.
+DEFAULT_IMAP_SERVER = "imap.gmail.com"
+DEFAULT_IMAP_PORT = 993
 
+BACKEND_CACHE_FILE = "backend_cache_file"
+BACKEND_CACHE_SIZE = "backend_cache_size"
 BACKEND_TOKEN = "backend_token"
 BACKEND_URL = "backend_url"
+BATCH_SIZE = "batch_size"
 CHECK_EVERY = "check_every"
 DB_PASSWORD = "database_password"
 DB_POOL = "database_pool"
@@ -26,7 +34,28 @@ DB_SERVER = "database_server"
 DB_SERVER_PORT = "database_server_port"
 DB_USERNAME = "database_username"
 DEBUG = "debug"
+JOB_FETCH_MODE = "job_fetch_mode"
+JOURNAL_FILE = "journal_file"
+LEASE_TIME = "lease_time"
+LMTP_LISTEN = "lmtp_listen"
+MAILDIR_WATCH = "maildir_watch"
+MAIL_ACCOUNTS = "mail_accounts"
+MAIL_DIRECTORY = "mail_directory"
+MAIL_FETCH_MODE = "mail_fetch_mode"
+MAIL_FOLDER = "mail_folder"
+MAIL_FOLDERS = "mail_folders"
+MAIL_IDLE = "mail_idle"
 MAIL_PASSWORD = "mail_password"
+MAIL_SEARCH = "mail_search"
 MAIL_SERVER = "mail_server"
 MAIL_SERVER_PORT = "mail_server_port"
+MAIL_SYNC_MODE = "mail_sync_mode"
 MAIL_USERNAME = "mail_username"
+MAIL_WORKERS = "mail_workers"
+PARSE_THRESHOLD = "parse_threshold"
+PARSE_WORKERS = "parse_workers"
+PUBLIC_INBOXES = "public_inboxes"
+QUEUE_ORDER = "queue_order"
+SEEN_FILE = "seen_file"
+SEND_MODE = "send_mode"
+SEND_WORKERS = "send_workers"
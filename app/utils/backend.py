@@ -11,14 +11,42 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Module to interact with the backend API."""
+"""Module to interact with the backend API.
 
+GET responses are cached: a fresh cached response is returned without asking
+the backend, an expired one is revalidated with a conditional request when
+the backend provided an ETag or a Last-Modified header.
+"""
+
+import collections
+import io
+import json
 import logging
+import os
+import threading
+import time
+import urllib.parse
+
 import requests
+import requests.structures
 
 # pylint: disable=invalid-name
 log = logging.getLogger("kernelci-reports")
 
+# Seconds a cached response is fresh, for each endpoint: while its results
+# can still change, and once they cannot. Job lists are never final, new
+# jobs can be added for the same kernel version: they are always revalidated.
+# The other times are shorter than the smallest retry delay of the reports.
+CACHE_TTLS = {
+    "job": (0.0, 0.0),
+    "count/boot": (30.0, 86400.0)
+}
+DEFAULT_CACHE_TTL = 300.0
+# Maximum number of cached responses.
+DEFAULT_CACHE_SIZE = 10000
+# The headers kept with the cached responses.
+CACHED_HEADERS = ["Content-Type", "ETag", "Last-Modified"]
+
 # The requests session object.
 req = requests.Session()
 http_adapter = requests.adapters.HTTPAdapter(
@@ -27,8 +55,185 @@ req.mount("http://", http_adapter)
 req.mount("https://", http_adapter)
 
 
+class ResponseCache(object):
+    """A thread safe LRU cache of responses, that can be stored in a file."""
+
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Set the counters to zero."""
+        with self.lock:
+            self.counters = {
+                "hits": 0,
+                "revalidated": 0,
+                "misses": 0,
+                "evicted": 0
+            }
+
+    def count(self, counter):
+        """Increase a counter."""
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        """Get the counters.
+
+        :return dict The counters, with the rate of requests that did not
+        need a complete response from the backend.
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self.entries)
+
+        requests_count = stats["hits"] + stats["revalidated"] + stats["misses"]
+        stats["hit_rate"] = (
+            (stats["hits"] + stats["revalidated"]) / requests_count
+            if requests_count else 0.0)
+
+        return stats
+
+    def lookup(self, key):
+        """Get a cached entry, expired or not.
+
+        :param key: The cache key.
+        :type key: str
+        :return dict The entry, or None if not cached.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def store(self, key, entry):
+        """Cache an entry, evicting the least recently used ones if full.
+
+        :param key: The cache key.
+        :type key: str
+        :param entry: The entry.
+        :type entry: dict
+        """
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters["evicted"] += 1
+
+    def load(self, path):
+        """Load the entries stored with dump().
+
+        :param path: The file path.
+        :type path: str
+        """
+        try:
+            with io.open(path, mode="r", encoding="utf-8") as read_file:
+                entries = json.load(read_file)
+        except (OSError, ValueError):
+            log.warning("Cannot load the backend cache from '%s'", path)
+            return
+
+        now = time.time()
+        with self.lock:
+            for key, entry in entries:
+                headers = entry["headers"]
+                # Expired entries without validators are of no use.
+                if entry["expires"] > now or \
+                        headers.get("ETag") or headers.get("Last-Modified"):
+                    self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def dump(self, path):
+        """Store the entries into a file, atomically.
+
+        :param path: The file path.
+        :type path: str
+        """
+        with self.lock:
+            entries = list(self.entries.items())
+
+        tmp_path = path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with io.open(tmp_path, mode="w", encoding="utf-8") as write_file:
+                json.dump(entries, write_file)
+            os.replace(tmp_path, path)
+        except OSError:
+            log.warning("Cannot save the backend cache into '%s'", path)
+
+
+# The cache of the GET responses.
+CACHE = ResponseCache()
+DEFAULT_CACHE_FILE = "/var/cache/kernelci-reports/backend-cache.json"
+
+
+def _cache_key(url, params):
+    """Build the cache key of a request."""
+    return url + "?" + urllib.parse.urlencode(sorted(params))
+
+
+def _is_final(endpoint, data):
+    """Check if the results of an endpoint cannot change anymore.
+
+    :param endpoint: The API endpoint, as "job" or "count/boot".
+    :type endpoint: str
+    :param data: The JSON response.
+    :type data: dict
+    :return bool
+    """
+    results = data.get("result", None) or []
+
+    if endpoint == "count/boot":
+        return bool(results) and results[0].get("count", 0) > 0
+
+    return False
+
+
+def _ttl(url, content):
+    """Get how many seconds a response is fresh.
+
+    :param url: The request URL.
+    :type url: str
+    :param content: The response body.
+    :type content: str
+    :return float The number of seconds, 0 if it must always be
+    revalidated.
+    """
+    path = urllib.parse.urlparse(url).path.strip("/")
+
+    for endpoint, (pending_ttl, final_ttl) in CACHE_TTLS.items():
+        if path == endpoint or path.endswith("/" + endpoint):
+            try:
+                data = json.loads(content)
+            except ValueError:
+                return 0.0
+            return final_ttl if _is_final(endpoint, data) else pending_ttl
+
+    return DEFAULT_CACHE_TTL
+
+
+def _cached_response(url, entry):
+    """Build a Response object out of a cached entry."""
+    response = requests.Response()
+    response.status_code = entry["status_code"]
+    response.headers = requests.structures.CaseInsensitiveDict(
+        entry["headers"])
+    response.encoding = "utf-8"
+    response.url = url
+    # pylint: disable=protected-access
+    response._content = entry["content"].encode("utf-8")
+
+    return response
+
+
 def get(url, params):
-    """Perform a GET request.
+    """Perform a GET request, or get its response from the cache.
 
     :param url: The URL where to perform the request.
     :type url: str
@@ -36,8 +241,49 @@ def get(url, params):
     :type params: list
     :return A Response object.
     """
+    key = _cache_key(url, params)
+    entry = CACHE.lookup(key)
+    now = time.time()
+
+    if entry is not None and entry["expires"] > now:
+        CACHE.count("hits")
+        log.debug("Cached response for '%s' and %s", url, params)
+        return _cached_response(url, entry)
+
+    headers = {}
+    if entry is not None:
+        if entry["headers"].get("ETag"):
+            headers["If-None-Match"] = entry["headers"]["ETag"]
+        if entry["headers"].get("Last-Modified"):
+            headers["If-Modified-Since"] = entry["headers"]["Last-Modified"]
+
     log.debug("GET request to '%s' for %s", url, params)
-    return req.get(url, params=params, timeout=(3.0, 7.0))
+    response = req.get(
+        url, params=params, headers=headers, timeout=(3.0, 7.0))
+
+    if response.status_code == 304 and entry is not None:
+        CACHE.count("revalidated")
+        entry = dict(entry, expires=now + _ttl(url, entry["content"]))
+        CACHE.store(key, entry)
+        return _cached_response(url, entry)
+
+    CACHE.count("misses")
+    if response.status_code == 200:
+        ttl = _ttl(url, response.text)
+        cached_headers = dict(
+            (header, response.headers[header])
+            for header in CACHED_HEADERS if header in response.headers)
+        # Responses never fresh are only useful to revalidate.
+        if ttl > 0 or "ETag" in cached_headers or \
+                "Last-Modified" in cached_headers:
+            CACHE.store(key, {
+                "status_code": response.status_code,
+                "headers": cached_headers,
+                "content": response.text,
+                "expires": now + ttl
+            })
+
+    return response
 
 
 def post(url, data):
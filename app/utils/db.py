@@ -11,45 +11,205 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Database connection."""
+"""Database connection.
+
+A single client, with its connection pool, is shared by the whole process.
+It is created the first time it is needed, and again in child processes
+after a fork. It is never closed while the process runs: pymongo reconnects
+by itself when the server comes back.
+"""
 
 import logging
+import os
 import pymongo
-import sys
+import pymongo.monitoring
+import threading
+import time
+
+import utils
 
 DB_NAME = "kernelci-reports"
 DB_CHECK_QUEUE = "check_queue"
+DB_MAIL_STATE = "mail_state"
+# Message-Ids of the reports that have left the check queue.
+DB_PROCESSED = "processed"
+
+DEFAULT_HOST = "localhost"
+DEFAULT_PORT = 27017
+DEFAULT_POOL_SIZE = 100
+# Seconds between health checks of the shared client.
+HEALTH_CHECK_INTERVAL = 30.0
 
 # pylint: disable=invalid-name
 log = logging.getLogger("kernelci-reports")
 
 
+class PoolStats(pymongo.monitoring.ConnectionPoolListener):
+    """Count the connection pool events of the shared client."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.reset()
+
+    def reset(self):
+        """Set all the counters to zero."""
+        with self.lock:
+            self.counters = {
+                "created": 0,
+                "closed": 0,
+                "checked_out": 0,
+                "checked_in": 0,
+                "check_out_failed": 0,
+                "cleared": 0
+            }
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def snapshot(self):
+        """Get the current counters.
+
+        :return dict The counters, plus the number of open connections and
+        of check outs that reused an existing connection.
+        """
+        with self.lock:
+            stats = dict(self.counters)
+
+        stats["open"] = stats["created"] - stats["closed"]
+        stats["reused"] = max(stats["checked_out"] - stats["created"], 0)
+
+        return stats
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._count("cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._count("created")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._count("closed")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._count("check_out_failed")
+
+    def connection_checked_out(self, event):
+        self._count("checked_out")
+
+    def connection_checked_in(self, event):
+        self._count("checked_in")
+
+
+POOL_STATS = PoolStats()
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+_last_check = 0.0
+
+
+def _create_client(options):
+    """Create a new client out of the connection options."""
+    options_get = options.get
+
+    kwargs = {
+        "host": options_get(utils.DB_SERVER, None) or DEFAULT_HOST,
+        "port": int(options_get(utils.DB_SERVER_PORT, None) or DEFAULT_PORT),
+        "maxPoolSize": int(
+            options_get(utils.DB_POOL, None) or DEFAULT_POOL_SIZE),
+        "w": "majority",
+        "event_listeners": [POOL_STATS]
+    }
+
+    db_user = options_get(utils.DB_USERNAME, None)
+    db_pwd = options_get(utils.DB_PASSWORD, None)
+    if all([db_user, db_pwd]):
+        kwargs["username"] = db_user
+        kwargs["password"] = db_pwd
+
+    log.debug("Creating database client...")
+    return pymongo.MongoClient(**kwargs)
+
+
+def _is_healthy(client):
+    """Check that the server answers to the client."""
+    try:
+        client.admin.command("ping")
+        return True
+    except pymongo.errors.PyMongoError:
+        return False
+
+
 def get_connection(options):
-    """Get connection to the database.
+    """Get the shared connection to the database.
+
+    The connection must not be closed by the caller.
 
     :param options: The database connection parameters.
     :type options: dict
-    :return A database connection instance.
+    :return A pymongo.MongoClient instance.
     """
-    options_get = options.get
+    # pylint: disable=global-statement
+    global _client, _client_pid, _last_check
 
-    db_host = options_get("database_host", "localhost")
-    db_port = options_get("database_port", 27017)
-    db_pool = options_get("database_pool", 100)
+    with _lock:
+        if _client is not None and _client_pid != os.getpid():
+            # Clients cannot be used across a fork: the child process needs
+            # its own, leaving the parent one untouched.
+            log.debug("Process forked, creating a new database client")
+            _client = None
 
-    db_user = options_get("database_user", "")
-    db_pwd = options_get("database_password", "")
+        now = time.monotonic()
+        check = _client is not None and \
+            now - _last_check > HEALTH_CHECK_INTERVAL
+        if check:
+            _last_check = now
 
-    try:
-        log.debug("Retrieving database connection...")
-        db_connection = pymongo.MongoClient(
-            host=db_host, port=db_port, maxPoolSize=db_pool, w="majority")
-
-        if all([db_user, db_pwd]):
-            log.debug("Authenticating to the database...")
-            db_connection.authenticate(db_user, password=db_pwd)
-    except pymongo.errors.ConnectionFailure:
-        log.error("Cannot connect to the database, aborting")
-        sys.exit(1)
-
-    return db_connection
+        if _client is None:
+            _client = _create_client(options)
+            _client_pid = os.getpid()
+            _last_check = now
+
+        client = _client
+
+    # The client reconnects by itself, and other threads are using it: the
+    # check only reports the problem, outside of the lock not to block them.
+    if check and not _is_healthy(client):
+        log.warning("Database server not reachable")
+
+    return client
+
+
+def close_connection():
+    """Close the shared connection, if open."""
+    # pylint: disable=global-statement
+    global _client
+
+    with _lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+
+
+def pool_stats():
+    """Get the connection pool statistics of the shared connection.
+
+    :return dict The pool counters.
+    """
+    return POOL_STATS.snapshot()
@@ -13,11 +13,14 @@
 
 """Email parsing logic."""
 
+import concurrent.futures
 import datetime
 import email
+import email.parser
 import email.utils
 import io
 import logging
+import multiprocessing
 import os
 import re
 
@@ -40,6 +43,22 @@ TREE_RGX = re.compile(r"(?<=/)(?P<tree>[\w-]*(?=\.git))")
 # Is the kernel being tested a -rc one?
 RC_VERSION_RGX = re.compile(r"(?P<version>[0-9.]*(?=-rc[0-9]{1,}))")
 
+# Maximum size of the header block that is read from a message.
+MAX_HEADER_SIZE = 1024 * 1024
+# The end of the last header line, followed by the empty line that separates
+# the headers from the body.
+HEADERS_END_RGX = re.compile(br"\r?\n(?=\r?\n)")
+# The Message-Id value in a raw header block, possibly on a folded line.
+MESSAGE_ID_RGX = re.compile(
+    br"^Message-Id:\s*(<[^>\r\n]*>)", re.IGNORECASE | re.MULTILINE)
+
+# Below this number of messages, parsing is done without a process pool.
+PARSE_POOL_THRESHOLD = 200
+# How the parsing processes are started. Forking a process with more
+# threads can deadlock on the locks held by the other threads (logging,
+# database pool): the processes are forked from a clean server instead.
+PARSE_POOL_START_METHOD = "forkserver"
+
 DEADLINE_FORMATS = [
     r"%Y%m%dT%H%M%z",
     r"%Y%m%dT%H%M%S%z",
@@ -52,6 +71,49 @@ X_KERNEL_VERSION_HEADER = "X-KernelTest-Version"
 X_TREE_HEADER = "X-KernelTest-Tree"
 X_DEADLINE_HEDEAR = "X-KernelTest-Deadline"
 X_PATCHES_HEADER = "X-KernelTest-PatchCount"
+# Any of these headers can make a message a report request.
+X_HEADERS = [
+    X_GIT_BRANCH_HEADER,
+    X_KERNEL_VERSION_HEADER,
+    X_TREE_HEADER,
+    X_PATCHES_HEADER
+]
+
+
+def build_search_criteria():
+    """Build the IMAP SEARCH criteria that match the report requests.
+
+    The criteria are used to filter messages on the IMAP server, and must
+    match at least all the messages that extract_mail_values() accepts:
+
+    . one of the custom headers is present, or the subject contains
+      "[PATCH" (SUBJECT_PATCH_RGX needs it at the beginning)
+    . the message does not have both the In-Reply-To and References headers
+
+    IMAP only checks for substrings, and a header searched with an empty
+    string matches even if it has no value: messages with an empty
+    In-Reply-To header would be discarded, while extract_mail_values() does
+    accept them. Message IDs always contain "@", and that is used instead.
+
+    The subject prefix check done with SUBJECT_RE_RGX cannot be expressed in
+    IMAP, and is left to extract_mail_values().
+
+    :return str The search criteria.
+    """
+    keys = ['HEADER {0:s} ""'.format(header) for header in X_HEADERS]
+    keys.append('SUBJECT "[PATCH"')
+
+    # OR takes only two keys: nest them.
+    criteria = keys[0]
+    for key in keys[1:]:
+        criteria = "OR {0:s} {1:s}".format(criteria, key)
+
+    return '{0:s} NOT (HEADER In-Reply-To "@" HEADER References "@")'.format(
+        criteria)
+
+
+# Default IMAP SEARCH criteria to filter messages on the server.
+SEARCH_CRITERIA = build_search_criteria()
 
 
 def hack_patches_count(count):
@@ -307,30 +369,92 @@ def extract_mail_values(mail):
     return data
 
 
-def parse_from_file(path):
-    """Parse a single message from a file.
+def read_headers(path):
+    """Read only the header block of an email file.
+
+    The file is read line by line up to the first empty line, and at most
+    MAX_HEADER_SIZE bytes are read: the message body is never loaded.
 
     :param path: The full path the the email file.
     :type path: str
-    :return dict A dictionary with all the necessary data.
+    :return bytes The header block, or None if the file cannot be accessed.
     """
-    data = None
+    headers = None
 
     # Although we don't write anything into the file, we need to make
     # sure we can remove it.
     if os.access(path, os.R_OK | os.W_OK):
+        headers = bytearray()
+
         with io.open(path, mode="rb") as read_file:
-            mail = email.message_from_binary_file(read_file)
+            for line in read_file:
+                if line in (b"\n", b"\r\n"):
+                    break
 
-        data = extract_mail_values(mail)
+                headers.extend(line)
+                if len(headers) > MAX_HEADER_SIZE:
+                    log.warning("Headers too big, truncated: %s", path)
+                    break
 
-        try:
-            os.unlink(path)
-        except PermissionError:
-            log.error("Error removing file at '%s'", path)
+        headers = bytes(headers)
     else:
         log.warning("Cannot access in 'rw' mode the file at '%s'", path)
 
+    return headers
+
+
+def split_headers(raw):
+    """Get the header block out of a complete email message.
+
+    :param raw: The complete email message.
+    :type raw: bytes
+    :return bytes The header block.
+    """
+    match = HEADERS_END_RGX.search(raw, 0, MAX_HEADER_SIZE)
+    if match:
+        return raw[:match.end()]
+    return raw[:MAX_HEADER_SIZE]
+
+
+def message_id(headers):
+    """Get the Message-Id out of a raw header block, without parsing it.
+
+    :param headers: The header block.
+    :type headers: bytes
+    :return str The Message-Id, or None if not found.
+    """
+    match = MESSAGE_ID_RGX.search(headers)
+    if match:
+        return match.group(1).decode("utf-8", errors="replace")
+    return None
+
+
+def remove_file(path):
+    """Remove an email file that has been parsed.
+
+    :param path: The full path the the email file.
+    :type path: str
+    """
+    try:
+        os.unlink(path)
+    except PermissionError:
+        log.error("Error removing file at '%s'", path)
+
+
+def parse_from_file(path):
+    """Parse a single message from a file.
+
+    :param path: The full path the the email file.
+    :type path: str
+    :return dict A dictionary with all the necessary data.
+    """
+    data = None
+
+    headers = read_headers(path)
+    if headers is not None:
+        data = parse_headers(headers)
+        remove_file(path)
+
     return data
 
 
@@ -341,4 +465,83 @@ def parse(message):
     :type message: str
     :return dict A dictionary with all the necessary data.
     """
-    return extract_mail_values(email.message_from_bytes(message[0][1]))
+    return parse_bytes(message[0][1])
+
+
+def parse_bytes(raw):
+    """Parse a single raw email message.
+
+    Only the header block is parsed, the body is not needed.
+
+    :param raw: The complete email message.
+    :type raw: bytes
+    :return dict A dictionary with all the necessary data.
+    """
+    return parse_headers(split_headers(raw))
+
+
+def parse_headers(headers):
+    """Parse the header block of a single email message.
+
+    :param headers: The raw header block as retrieved from the IMAP server.
+    :type headers: bytes
+    :return dict A dictionary with all the necessary data.
+    """
+    return extract_mail_values(
+        email.parser.BytesHeaderParser().parsebytes(headers))
+
+
+def parse_pool(workers):
+    """Start a pool of processes to parse emails.
+
+    :param workers: The number of processes.
+    :type workers: int
+    :return concurrent.futures.ProcessPoolExecutor
+    """
+    return concurrent.futures.ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context(PARSE_POOL_START_METHOD))
+
+
+def parse_many(
+        messages, parser=parse_bytes, workers=None, threshold=None,
+        executor=None):
+    """Parse many raw email messages, in parallel if they are enough.
+
+    Parsing is CPU bound: when the number of messages reaches the threshold
+    they are parsed by a pool of processes, otherwise they are parsed in
+    this process, avoiding the cost of starting the pool.
+
+    :param messages: The raw email messages.
+    :type messages: list
+    :param parser: The function used to parse each message.
+    :type parser: function
+    :param workers: The number of processes, by default the number of CPUs.
+    :type workers: int
+    :param threshold: Minimum number of messages to use the processes.
+    :type threshold: int
+    :param executor: An already running process pool to use, instead of
+    starting a new one.
+    :type executor: concurrent.futures.ProcessPoolExecutor
+    :return list The parsed data of each message, in the same order.
+    """
+    workers = workers or os.cpu_count() or 1
+    if threshold is None:
+        threshold = PARSE_POOL_THRESHOLD
+
+    if workers == 1 or len(messages) < threshold:
+        parsed = [parser(message) for message in messages]
+    else:
+        log.debug(
+            "Parsing %d messages with %d processes", len(messages), workers)
+        chunk_size = max(1, len(messages) // (workers * 4))
+
+        if executor is not None:
+            parsed = list(
+                executor.map(parser, messages, chunksize=chunk_size))
+        else:
+            with parse_pool(workers) as executor:
+                parsed = list(
+                    executor.map(parser, messages, chunksize=chunk_size))
+
+    return parsed
@@ -0,0 +1,244 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""IMAP connection and IDLE handling."""
+
+import imaplib
+import logging
+import re
+import socket
+import time
+
+import utils
+
+# pylint: disable=invalid-name
+log = logging.getLogger("kernelci-reports")
+
+# RFC 2177 says that servers can drop an idling client after 30 minutes:
+# the IDLE command has to be re-issued before that happens.
+IDLE_RENEW = 1500.0
+# Seconds to wait for each read from the socket while idling.
+IDLE_POLL = 1.0
+# Seconds to wait for the server to acknowledge the IDLE and DONE commands.
+IDLE_ACK_TIMEOUT = 30.0
+
+# Socket timeout, so that an unresponsive server cannot block forever.
+TIMEOUT = 60.0
+
+EXISTS_RGX = re.compile(br"^\* \d+ EXISTS", re.IGNORECASE)
+
+
+def connect(options):
+    """Open an authenticated connection to the IMAP server.
+
+    :param options: The configuration options.
+    :type options: dict
+    :return An imaplib.IMAP4_SSL instance.
+    """
+    log.debug("Connecting to the IMAP server...")
+    server = imaplib.IMAP4_SSL(
+        host=options[utils.MAIL_SERVER],
+        port=options[utils.MAIL_SERVER_PORT],
+        timeout=TIMEOUT)
+    server.login(options[utils.MAIL_USERNAME], options[utils.MAIL_PASSWORD])
+
+    return server
+
+
+def quote(mailbox):
+    """Quote a mail box name to be used as a command argument.
+
+    :param mailbox: The mail box name.
+    :type mailbox: str
+    :return str The quoted mail box name.
+    """
+    mailbox = mailbox.replace("\\", "\\\\").replace('"', '\\"')
+    return '"{0:s}"'.format(mailbox)
+
+
+def has_idle(server):
+    """Check if the IMAP server supports the IDLE command.
+
+    :param server: The IMAP connection.
+    :type server: imaplib.IMAP4
+    :return bool
+    """
+    return "IDLE" in server.capabilities
+
+
+class Session(object):
+    """A persistent IMAP connection.
+
+    The connection is opened the first time it is needed and then kept open:
+    each time it is requested its health is checked with a NOOP command, and
+    it is opened again if it has been lost.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.server = None
+
+    def connect(self):
+        """Get the IMAP connection, opening it if necessary.
+
+        :return An authenticated imaplib.IMAP4 instance.
+        """
+        if self.server is not None:
+            try:
+                self.server.noop()
+            except (imaplib.IMAP4.abort, OSError):
+                log.warning("IMAP connection lost, reconnecting")
+                self.reset()
+
+        if self.server is None:
+            self.server = connect(self.options)
+
+        return self.server
+
+    def reset(self):
+        """Drop the current connection without talking to the server."""
+        if self.server is not None:
+            try:
+                self.server.shutdown()
+            except OSError:
+                pass
+            self.server = None
+
+    def close(self):
+        """Close the mail box and log out from the server."""
+        if self.server is not None:
+            try:
+                if self.server.state == "SELECTED":
+                    self.server.close()
+                self.server.logout()
+            finally:
+                self.server = None
+
+
+class _LineReader(object):
+    """Read CRLF terminated lines straight from the socket.
+
+    The file object imaplib reads from cannot be used after a socket
+    timeout, so while idling the socket is read directly.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def readline(self, timeout):
+        """Read a single line.
+
+        :param timeout: Seconds to wait for a complete line.
+        :type timeout: float
+        :return The line as bytes, or None if the timeout expired.
+        """
+        end = time.monotonic() + timeout
+
+        while True:
+            idx = self.buffer.find(b"\r\n")
+            if idx != -1:
+                line = bytes(self.buffer[:idx])
+                del self.buffer[:idx + 2]
+                return line
+
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return None
+
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(4096)
+            except socket.timeout:
+                return None
+
+            if not data:
+                raise imaplib.IMAP4.abort("Connection closed while idling")
+            self.buffer.extend(data)
+
+
+def _read_until(reader, prefix, timeout):
+    """Read lines until one starts with one of the provided prefixes.
+
+    :param prefix: The prefix, or a tuple of prefixes, to look for.
+    :return list All the lines read, the matching one included.
+    """
+    lines = []
+
+    while True:
+        line = reader.readline(timeout)
+        if line is None:
+            raise imaplib.IMAP4.abort("Timeout waiting for the server")
+        lines.append(line)
+        if line.startswith(prefix):
+            return lines
+
+
+def idle(server, timeout, stop=None):
+    """Wait for new messages in the selected mail box using IDLE.
+
+    The IDLE command is terminated as soon as the server notifies a new
+    message, when the timeout expires, or when the stop event is set.
+
+    :param server: The IMAP connection, with a mail box selected.
+    :type server: imaplib.IMAP4
+    :param timeout: Maximum number of seconds to wait.
+    :type timeout: float
+    :param stop: Optional event to interrupt the wait.
+    :type stop: threading.Event
+    :return bool True if the server notified new messages.
+    """
+    has_new = False
+    sock = server.sock
+    prev_timeout = sock.gettimeout()
+    reader = _LineReader(sock)
+
+    tag = server._new_tag()
+    try:
+        server.send(tag + b" IDLE" + imaplib.CRLF)
+
+        line = _read_until(reader, (b"+", tag), IDLE_ACK_TIMEOUT)[-1]
+        if line.startswith(tag):
+            raise imaplib.IMAP4.error(
+                "IDLE command rejected: {0!r}".format(line))
+
+        log.debug("Waiting for new messages with IDLE...")
+        end = time.monotonic() + min(timeout, IDLE_RENEW)
+
+        while not has_new and time.monotonic() < end:
+            if stop is not None and stop.is_set():
+                break
+
+            line = reader.readline(
+                min(IDLE_POLL, max(end - time.monotonic(), 0)))
+            if line is None:
+                continue
+
+            if EXISTS_RGX.match(line):
+                log.debug("New messages notified: %s", line)
+                has_new = True
+            elif line.startswith(b"* BYE"):
+                raise imaplib.IMAP4.abort(line.decode(errors="replace"))
+            elif line.startswith(tag):
+                # The server terminated the IDLE command on its own.
+                return has_new
+
+        server.send(b"DONE" + imaplib.CRLF)
+        # Untagged responses sent before the DONE was received are of no
+        # interest: the mail box is searched again anyway.
+        _read_until(reader, tag, IDLE_ACK_TIMEOUT)
+    finally:
+        server.tagged_commands.pop(tag, None)
+        sock.settimeout(prev_timeout)
+
+    return has_new
@@ -0,0 +1,143 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Durable local journal of the parsed emails waiting to be saved.
+
+The journal is an SQLite database in WAL mode: appending is a local, fsync'd
+write that does not depend on the database server being reachable. Entries
+are removed only once saved, so after a crash they are saved again: saving
+must be idempotent.
+"""
+
+import datetime
+import logging
+import os
+import sqlite3
+import threading
+
+import bson
+import bson.codec_options
+
+# pylint: disable=invalid-name
+log = logging.getLogger("kernelci-reports")
+
+CODEC_OPTIONS = bson.codec_options.CodecOptions(
+    tz_aware=True, tzinfo=datetime.timezone.utc)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    data BLOB NOT NULL
+)
+"""
+
+
+class Journal(object):
+    """An append-only queue of documents, stored on disk.
+
+    Until it is opened, the journal is disabled.
+    """
+
+    def __init__(self):
+        self.connection = None
+        self.lock = threading.Lock()
+        # Set each time entries are appended.
+        self.appended = threading.Event()
+
+    @property
+    def enabled(self):
+        """If the journal has been opened."""
+        return self.connection is not None
+
+    def open(self, path):
+        """Open the journal file, creating it if needed.
+
+        :param path: The journal file path.
+        :type path: str
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        connection = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # Each append is on disk once the transaction is committed.
+        connection.execute("PRAGMA synchronous=FULL")
+        connection.execute(SCHEMA)
+
+        with self.lock:
+            self.connection = connection
+
+        pending = self.count()
+        if pending:
+            log.info("%d journaled emails waiting to be saved", pending)
+            self.appended.set()
+
+    def close(self):
+        """Close the journal file."""
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def append(self, documents):
+        """Append documents to the journal, with a single transaction.
+
+        :param documents: The documents to append.
+        :type documents: list
+        """
+        with self.lock:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.executemany(
+                    "INSERT INTO entries (data) VALUES (?)",
+                    [(bson.encode(document),) for document in documents])
+
+        self.appended.set()
+
+    def peek(self, limit):
+        """Get the oldest entries.
+
+        :param limit: The maximum number of entries.
+        :type limit: int
+        :return list A list of (entry ID, document) tuples.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id, data FROM entries ORDER BY id LIMIT ?",
+                (limit,)).fetchall()
+
+        return [
+            (entry_id, bson.decode(data, codec_options=CODEC_OPTIONS))
+            for entry_id, data in rows
+        ]
+
+    def remove(self, entry_ids):
+        """Remove entries from the journal.
+
+        :param entry_ids: The IDs of the entries to remove.
+        :type entry_ids: list
+        """
+        with self.lock:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                self.connection.executemany(
+                    "DELETE FROM entries WHERE id = ?",
+                    [(entry_id,) for entry_id in entry_ids])
+
+    def count(self):
+        """Get the number of entries in the journal."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM entries").fetchone()[0]
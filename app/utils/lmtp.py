@@ -0,0 +1,271 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Minimal LMTP/SMTP listener the MTA can deliver the emails to.
+
+Both LMTP (RFC 2033) and plain SMTP are spoken, depending on the greeting
+command used by the client. A delivery is acknowledged only once the
+message has been handled: if that fails, or takes too long, a temporary
+failure is returned and the MTA retries later.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import socket
+import stat
+
+# pylint: disable=invalid-name
+log = logging.getLogger("kernelci-reports")
+
+# Seconds to wait for a message to be handled before asking the MTA to
+# retry later.
+DELIVERY_TIMEOUT = 10.0
+# Messages handled at the same time: further deliveries are temporarily
+# refused.
+MAX_PENDING = 8
+# Maximum size of a message, and of a single line, in bytes.
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+MAX_LINE_SIZE = 1024 * 1024
+# Seconds a client can stay idle before being disconnected.
+IDLE_TIMEOUT = 300.0
+# Seconds between checks of the stop event.
+STOP_POLL = 1.0
+
+CRLF = b"\r\n"
+
+
+class Server(object):
+    """The LMTP/SMTP listener.
+
+    :param deliver: The function called with the raw bytes of each message,
+    from a worker thread. It returns False, or raises, if the message could
+    not be handled.
+    :type deliver: function
+    """
+
+    def __init__(
+            self, deliver, timeout=DELIVERY_TIMEOUT, max_pending=MAX_PENDING,
+            max_size=MAX_MESSAGE_SIZE):
+        self.deliver = deliver
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_size = max_size
+        self.pending = 0
+        self.hostname = socket.getfqdn()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_pending)
+
+    async def start(self, address):
+        """Start listening.
+
+        :param address: A "host:port" string, or the path of a UNIX socket.
+        :type address: str
+        :return An asyncio.Server instance.
+        """
+        if address.startswith("/"):
+            try:
+                if stat.S_ISSOCK(os.stat(address).st_mode):
+                    os.unlink(address)
+            except FileNotFoundError:
+                pass
+            return await asyncio.start_unix_server(
+                self.handle, path=address, limit=MAX_LINE_SIZE)
+
+        host, port = address.rsplit(":", 1)
+        return await asyncio.start_server(
+            self.handle, host=host.strip("[]"), port=int(port),
+            limit=MAX_LINE_SIZE)
+
+    def _done(self, _):
+        """Called from the worker thread when a message has been handled."""
+        self.pending -= 1
+
+    @staticmethod
+    def _call_soon(loop, function, *args):
+        """Schedule a call in the event loop, unless it is gone."""
+        try:
+            loop.call_soon_threadsafe(function, *args)
+        except RuntimeError:
+            pass
+
+    async def _deliver(self, message):
+        """Hand a message to the deliver function.
+
+        :return bytes The reply to send to the client.
+        """
+        if self.pending >= self.max_pending:
+            return b"451 4.3.2 Too many pending deliveries, try again later"
+
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        future = self.executor.submit(self.deliver, message)
+        # The count is updated only once the worker is done, even if the
+        # client has already been told to retry.
+        future.add_done_callback(
+            lambda result: self._call_soon(loop, self._done, result))
+
+        try:
+            if await asyncio.wait_for(
+                    asyncio.wrap_future(future), self.timeout) is False:
+                return b"451 4.3.0 Message not saved, try again later"
+        except asyncio.TimeoutError:
+            log.warning("Delivery taking too long, asking to retry later")
+            return b"451 4.3.0 Timeout saving the message, try again later"
+        # pylint: disable=broad-except
+        except Exception:
+            log.exception("Error handling delivered message")
+            return b"451 4.3.0 Error saving the message, try again later"
+
+        return b"250 2.0.0 Message accepted"
+
+    async def _read_data(self, reader):
+        """Read the message up to the terminating dot line.
+
+        :return bytes The message, or None if it is too big.
+        """
+        message = bytearray()
+        too_big = False
+
+        while True:
+            line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+            if not line:
+                raise ConnectionResetError("Connection closed during DATA")
+            if line in (b".\r\n", b".\n"):
+                break
+            if line.startswith(b"."):
+                line = line[1:]
+
+            if not too_big:
+                message.extend(line)
+                if len(message) > self.max_size:
+                    too_big = True
+                    message = bytearray()
+
+        return None if too_big else bytes(message)
+
+    async def handle(self, reader, writer):
+        """Talk to a single client."""
+        def reply(*lines):
+            writer.write(CRLF.join(lines) + CRLF)
+
+        greeted = False
+        lmtp = False
+        sender = None
+        recipients = []
+
+        reply("220 {0:s} kernelci-reports ready".format(
+            self.hostname).encode())
+
+        try:
+            while True:
+                await writer.drain()
+
+                line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                if not line:
+                    break
+
+                command, _, argument = line.strip().partition(b" ")
+                command = command.upper()
+
+                if command in (b"LHLO", b"EHLO", b"HELO"):
+                    greeted = True
+                    lmtp = command == b"LHLO"
+                    sender, recipients = None, []
+                    reply(
+                        "250-{0:s}".format(self.hostname).encode(),
+                        b"250-PIPELINING",
+                        b"250-8BITMIME",
+                        b"250-ENHANCEDSTATUSCODES",
+                        "250 SIZE {0:d}".format(self.max_size).encode())
+                elif command == b"MAIL":
+                    if not greeted:
+                        reply(b"503 5.5.1 Send LHLO first")
+                    else:
+                        sender, recipients = argument, []
+                        reply(b"250 2.1.0 OK")
+                elif command == b"RCPT":
+                    if sender is None:
+                        reply(b"503 5.5.1 Need MAIL command")
+                    else:
+                        recipients.append(argument)
+                        reply(b"250 2.1.5 OK")
+                elif command == b"DATA":
+                    if not recipients:
+                        reply(b"503 5.5.1 No valid recipients")
+                        continue
+                    if self.pending >= self.max_pending:
+                        reply(b"451 4.3.2 Too many pending deliveries, "
+                              b"try again later")
+                        sender, recipients = None, []
+                        continue
+
+                    reply(b"354 Start mail input; end with <CRLF>.<CRLF>")
+                    await writer.drain()
+
+                    message = await self._read_data(reader)
+                    if message is None:
+                        status = b"552 5.3.4 Message too big"
+                    else:
+                        status = await self._deliver(message)
+
+                    # LMTP wants a reply for each recipient.
+                    reply(*([status] * (len(recipients) if lmtp else 1)))
+                    sender, recipients = None, []
+                elif command == b"RSET":
+                    sender, recipients = None, []
+                    reply(b"250 2.0.0 OK")
+                elif command == b"NOOP":
+                    reply(b"250 2.0.0 OK")
+                elif command == b"QUIT":
+                    reply(b"221 2.0.0 Bye")
+                    await writer.drain()
+                    break
+                else:
+                    reply(b"500 5.5.2 Command not recognized")
+        except (asyncio.TimeoutError, asyncio.LimitOverrunError, ValueError):
+            log.warning("Closing misbehaving LMTP client connection")
+        except ConnectionError:
+            log.debug("LMTP client connection lost")
+        finally:
+            writer.close()
+
+    async def serve(self, address, stop):
+        """Listen until the stop event is set."""
+        server = await self.start(address)
+        log.info("Listening for emails on %s", address)
+
+        async with server:
+            while not stop.is_set():
+                await asyncio.sleep(STOP_POLL)
+
+    def close(self):
+        """Release the worker threads."""
+        self.executor.shutdown(wait=False)
+
+
+def serve(address, deliver, stop, **kwargs):
+    """Listen for emails until the stop event is set.
+
+    :param address: A "host:port" string, or the path of a UNIX socket.
+    :type address: str
+    :param deliver: The function called with the raw bytes of each message.
+    :type deliver: function
+    :param stop: The event used to stop listening.
+    :type stop: threading.Event
+    """
+    server = Server(deliver, **kwargs)
+    try:
+        asyncio.run(server.serve(address, stop))
+    finally:
+        server.close()
@@ -0,0 +1,174 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Maildir handling and watching.
+
+Messages are delivered in the 'tmp' directory and then moved into 'new'
+once completely written: only 'new' is read, and parsed messages are moved
+into 'cur'.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import time
+
+# pylint: disable=invalid-name
+log = logging.getLogger("kernelci-reports")
+
+MAILDIR_SUBDIRS = ["tmp", "new", "cur"]
+# Flags added to the messages moved into 'cur': seen.
+READ_INFO = ":2,S"
+
+# Seconds between checks when inotify is not available.
+POLL_INTERVAL = 2.0
+
+# inotify constants, from <sys/inotify.h>.
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+
+def is_maildir(path):
+    """Check if a directory has the Maildir layout.
+
+    :param path: The directory path.
+    :type path: str
+    :return bool
+    """
+    return all(
+        os.path.isdir(os.path.join(path, subdir))
+        for subdir in MAILDIR_SUBDIRS
+    )
+
+
+def create(path):
+    """Create the Maildir layout in a directory, if not there.
+
+    :param path: The directory path.
+    :type path: str
+    """
+    for subdir in MAILDIR_SUBDIRS:
+        os.makedirs(os.path.join(path, subdir), exist_ok=True)
+
+
+def list_new(path):
+    """List the messages delivered in the 'new' directory.
+
+    :param path: The Maildir path.
+    :type path: str
+    :return list The full paths of the new messages.
+    """
+    new_dir = os.path.join(path, "new")
+
+    with os.scandir(new_dir) as entries:
+        return sorted(
+            entry.path for entry in entries
+            if not entry.name.startswith(".") and entry.is_file()
+        )
+
+
+def mark_read(path, message_path):
+    """Move a message from the 'new' directory into 'cur'.
+
+    :param path: The Maildir path.
+    :type path: str
+    :param message_path: The full path of the message in 'new'.
+    :type message_path: str
+    :return bool True if the message has been moved.
+    """
+    moved = False
+    name = os.path.basename(message_path).split(":", 1)[0]
+
+    try:
+        os.rename(message_path, os.path.join(path, "cur", name + READ_INFO))
+        moved = True
+    except FileNotFoundError:
+        log.debug("Message already moved: %s", message_path)
+    except OSError:
+        log.error("Error moving message '%s' into 'cur'", message_path)
+
+    return moved
+
+
+def _inotify_libc():
+    """Load the C library if it provides the inotify functions."""
+    libc = None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        libc = None
+
+    return libc
+
+
+class Watcher(object):
+    """Wait for messages delivered in the 'new' directory of a Maildir.
+
+    Uses Linux inotify when available, otherwise falls back to polling.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+        libc = _inotify_libc()
+        if libc is not None:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                new_dir = os.fsencode(os.path.join(path, "new"))
+                # Delivery agents either rename or link the messages.
+                if libc.inotify_add_watch(
+                        fd, new_dir, IN_MOVED_TO | IN_CREATE) >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+
+        if self.fd is None:
+            log.warning(
+                "inotify not available, polling the Maildir every %s seconds",
+                POLL_INTERVAL)
+
+    def wait(self, timeout):
+        """Wait for new messages.
+
+        :param timeout: Maximum number of seconds to wait.
+        :type timeout: float
+        :return bool True if new messages might have been delivered.
+        """
+        if self.fd is None:
+            time.sleep(min(timeout, POLL_INTERVAL))
+            return True
+
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            # Event details are not needed: the directory is listed anyway.
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+        return bool(ready)
+
+    def close(self):
+        """Release the inotify resources."""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
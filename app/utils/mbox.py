@@ -0,0 +1,71 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Split mbox files into messages."""
+
+import re
+
+import utils.emails
+
+# A From_ line starts each message: at the beginning of the file, or after
+# the empty line ending the previous message. Body lines starting with
+# "From " are escaped by the mbox writers.
+FROM_LINE_RGX = re.compile(br"(?:\A|(?<=\n\n)|(?<=\n\r\n))From ")
+
+
+def messages(mbox):
+    """Find the messages in an mbox, without copying them.
+
+    :param mbox: The mbox content, usually memory mapped.
+    :type mbox: mmap.mmap
+    :return A generator of (start, end) offsets of each message, its From_
+    line excluded.
+    """
+    previous = None
+
+    for match in FROM_LINE_RGX.finditer(mbox):
+        if previous is not None:
+            yield _skip_from_line(mbox, previous, match.start()), \
+                match.start()
+        previous = match.start()
+
+    if previous is not None:
+        yield _skip_from_line(mbox, previous, len(mbox)), len(mbox)
+
+
+def _skip_from_line(mbox, start, end):
+    """Get the offset of the line after the From_ line."""
+    line_end = mbox.find(b"\n", start, end)
+    if line_end == -1:
+        return end
+    return line_end + 1
+
+
+def headers(mbox, start, end):
+    """Copy the header block of a message.
+
+    :param mbox: The mbox content.
+    :type mbox: mmap.mmap
+    :param start: The offset of the message.
+    :type start: int
+    :param end: The offset of the end of the message.
+    :type end: int
+    :return bytes The header block.
+    """
+    end = min(end, start + utils.emails.MAX_HEADER_SIZE)
+
+    match = utils.emails.HEADERS_END_RGX.search(mbox, start, end)
+    if match:
+        end = match.end()
+
+    return mbox[start:end]
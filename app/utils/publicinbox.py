@@ -0,0 +1,169 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Read new messages out of public-inbox git archives.
+
+Each message is stored as a blob added by its own commit: in v1 archives at
+a path derived from the Message-Id hash, in v2 archives always as 'm', with
+the archive split in epoch repositories under 'git/'. Messages deleted from
+a v2 archive are moved into a 'd' file, ignored here.
+"""
+
+import logging
+import os
+import re
+import subprocess
+
+# pylint: disable=invalid-name
+log = logging.getLogger("kernelci-reports")
+
+# The epoch repositories of a v2 archive: git/0.git, git/1.git, ...
+EPOCH_RGX = re.compile(r"^(\d+)\.git$")
+# A line of the raw diff output: the new blob ID, and the file path.
+RAW_DIFF_RGX = re.compile(r"^:\d+ \d+ [0-9a-f]+ ([0-9a-f]+) [AM]\t(.+)$")
+DELETED_FILE = "d"
+
+
+class Error(Exception):
+    """Error running a git command."""
+
+
+def _git(repository, *args):
+    """Run a git command in a repository and get its output.
+
+    :return str The command output.
+    """
+    try:
+        return subprocess.run(
+            ["git", "--git-dir", repository] + list(args),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True
+        ).stdout.decode("utf-8", errors="replace")
+    except (OSError, subprocess.CalledProcessError) as ex:
+        raise Error(
+            "Error running git {0:s} in '{1:s}': {2!s}".format(
+                args[0], repository, ex))
+
+
+def repositories(path):
+    """Get the git repositories of an archive.
+
+    :param path: The path of a v1 archive or of a v2 archive directory.
+    :type path: str
+    :return list The repository paths, oldest epoch first.
+    """
+    epochs_dir = os.path.join(path, "git")
+
+    if os.path.isdir(epochs_dir):
+        epochs = []
+        for entry in os.listdir(epochs_dir):
+            match = EPOCH_RGX.match(entry)
+            if match:
+                epochs.append(
+                    (int(match.group(1)), os.path.join(epochs_dir, entry)))
+        return [epoch_path for _, epoch_path in sorted(epochs)]
+
+    return [path]
+
+
+def head(repository):
+    """Get the ID of the last commit of a repository.
+
+    :param repository: The repository path.
+    :type repository: str
+    :return str The commit ID, or None if the repository is empty.
+    """
+    try:
+        return _git(repository, "rev-parse", "--verify", "HEAD").strip()
+    except Error:
+        return None
+
+
+def has_commit(repository, commit):
+    """Check if a commit exists in a repository."""
+    try:
+        _git(repository, "cat-file", "-e", commit + "^{commit}")
+        return True
+    except Error:
+        return False
+
+
+def new_messages(repository, since, until):
+    """List the messages added after a commit.
+
+    :param repository: The repository path.
+    :type repository: str
+    :param since: The last commit already read, None to list all of them.
+    :type since: str
+    :param until: The last commit to read.
+    :type until: str
+    :return list A list of (commit ID, [blob IDs]) tuples, oldest first.
+    """
+    revisions = until if since is None else "{0:s}..{1:s}".format(
+        since, until)
+    output = _git(
+        repository, "log", "--reverse", "--raw", "--no-abbrev",
+        "--no-renames", "--diff-filter=AM", "--format=%x00%H", revisions)
+
+    commits = []
+    for chunk in output.split("\0")[1:]:
+        lines = chunk.splitlines()
+        blobs = []
+        for line in lines[1:]:
+            match = RAW_DIFF_RGX.match(line)
+            if match and match.group(2) != DELETED_FILE:
+                blobs.append(match.group(1))
+        commits.append((lines[0].strip(), blobs))
+
+    return commits
+
+
+class BlobReader(object):
+    """Read blobs with a single 'git cat-file --batch' process."""
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.process = None
+
+    def read(self, blob):
+        """Read a blob.
+
+        :param blob: The blob ID.
+        :type blob: str
+        :return bytes The blob content, or None if not found.
+        """
+        if self.process is None:
+            self.process = subprocess.Popen(
+                ["git", "--git-dir", self.repository, "cat-file", "--batch"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        self.process.stdin.write(blob.encode() + b"\n")
+        self.process.stdin.flush()
+
+        header = self.process.stdout.readline().split()
+        if len(header) != 3:
+            log.error("Blob %s not found in '%s'", blob, self.repository)
+            return None
+
+        content = self.process.stdout.read(int(header[2]))
+        # Each blob is followed by a new line.
+        self.process.stdout.read(1)
+
+        return content
+
+    def close(self):
+        """Stop the git process."""
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process.stdout.close()
+            self.process = None
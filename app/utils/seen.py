@@ -0,0 +1,201 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Probabilistic set of the already seen Message-Ids."""
+
+import hashlib
+import io
+import logging
+import math
+import os
+import struct
+import threading
+
+# pylint: disable=invalid-name
+log = logging.getLogger("kernelci-reports")
+
+# Number of Message-Ids the filter is sized for, and the false positive
+# rate when it holds that many.
+DEFAULT_CAPACITY = 1000000
+DEFAULT_ERROR_RATE = 0.001
+
+# Header of the persisted filter: magic, bits count, hashes count.
+FILE_MAGIC = b"KCIBLOOM"
+FILE_HEADER = struct.Struct("<8sQI")
+
+
+class BloomFilter(object):
+    """A Bloom filter of strings.
+
+    A key that has been added is always reported as present, a key that has
+    not been added is reported as present with the configured error rate.
+    """
+
+    def __init__(
+            self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        self.size = max(
+            8,
+            int(math.ceil(
+                -capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        """Get the bit positions of a key, with double hashing."""
+        digest = hashlib.blake2b(
+            key.encode("utf-8", errors="replace"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+
+        return [
+            (first + idx * second) % self.size for idx in range(self.hashes)
+        ]
+
+    def add(self, key):
+        """Add a key to the filter."""
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+    def dump(self, path):
+        """Write the filter into a file, atomically.
+
+        :param path: The file path.
+        :type path: str
+        """
+        tmp_path = path + ".tmp"
+
+        with io.open(tmp_path, mode="wb") as write_file:
+            write_file.write(
+                FILE_HEADER.pack(FILE_MAGIC, self.size, self.hashes))
+            write_file.write(self.bits)
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a filter written with dump().
+
+        :param path: The file path.
+        :type path: str
+        :return A BloomFilter instance.
+        """
+        with io.open(path, mode="rb") as read_file:
+            magic, size, hashes = FILE_HEADER.unpack(
+                read_file.read(FILE_HEADER.size))
+            bits = bytearray(read_file.read())
+
+        if magic != FILE_MAGIC or len(bits) != (size + 7) // 8:
+            raise ValueError("Not a valid filter file: {0:s}".format(path))
+
+        bloom = cls.__new__(cls)
+        bloom.size = size
+        bloom.hashes = hashes
+        bloom.bits = bits
+
+        return bloom
+
+
+class SeenSet(object):
+    """Thread safe set of the Message-Ids that have been handled.
+
+    Until it is loaded or rebuilt, the set is disabled and reports every
+    Message-Id as possibly seen.
+    """
+
+    def __init__(self):
+        self.bloom = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """If the set has been loaded or rebuilt."""
+        return self.bloom is not None
+
+    def load(self, path):
+        """Load the persisted set.
+
+        :param path: The file path.
+        :type path: str
+        :return bool True if the set has been loaded.
+        """
+        try:
+            bloom = BloomFilter.load(path)
+        except (OSError, ValueError, struct.error):
+            log.warning("Cannot load the seen messages from '%s'", path)
+            return False
+
+        with self.lock:
+            self.bloom = bloom
+
+        return True
+
+    def rebuild(self, message_ids, capacity=DEFAULT_CAPACITY):
+        """Rebuild the set from scratch.
+
+        :param message_ids: All the Message-Ids that have been handled.
+        :type message_ids: iterable
+        :param capacity: Number of Message-Ids the set is sized for.
+        :type capacity: int
+        """
+        bloom = BloomFilter(capacity=capacity)
+        for message_id in message_ids:
+            if message_id:
+                bloom.add(message_id)
+
+        with self.lock:
+            self.bloom = bloom
+
+    def dump(self, path):
+        """Persist the set into a file.
+
+        :param path: The file path.
+        :type path: str
+        """
+        if self.enabled:
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with self.lock:
+                    self.bloom.dump(path)
+            except OSError:
+                log.warning("Cannot save the seen messages into '%s'", path)
+
+    def add(self, message_ids):
+        """Add Message-Ids to the set.
+
+        :param message_ids: The Message-Ids.
+        :type message_ids: iterable
+        """
+        if self.enabled:
+            with self.lock:
+                for message_id in message_ids:
+                    if message_id:
+                        self.bloom.add(message_id)
+
+    def might_contain(self, message_id):
+        """Check if a Message-Id might have been seen.
+
+        :param message_id: The Message-Id.
+        :type message_id: str
+        :return bool False only if the Message-Id has never been seen.
+        """
+        if not self.enabled or not message_id:
+            return True
+
+        with self.lock:
+            return message_id in self.bloom
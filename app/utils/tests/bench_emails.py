@@ -0,0 +1,118 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Email parsing benchmark.
+
+Compare parsing the complete MIME tree of big patch emails with parsing only
+their headers. Run from the 'app' directory with:
+
+    python -m utils.tests.bench_emails [--size MB] [--count N]
+"""
+
+import argparse
+import email
+import io
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import utils.emails
+
+
+def _patch_email(size):
+    """Build a multi-part patch email of about the provided size in bytes."""
+    mail = MIMEMultipart()
+    mail["From"] = "Greg KH <gregkh@example.org>"
+    mail["To"] = "linux-kernel@example.org"
+    mail["Cc"] = "stable@example.org"
+    mail["Subject"] = "[PATCH 4.4 00/99] 4.4.30-stable review"
+    mail["Message-Id"] = "<20161101000000.000000000@example.org>"
+    mail["Date"] = "Tue, 01 Nov 2016 00:00:00 +0000"
+    mail["X-KernelTest-Patch"] = "http://kernel.org/pub/linux/kernel/v4.x/"
+    mail["X-KernelTest-Tree"] = (
+        "git://git.kernel.org/pub/scm/linux/kernel/git/stable/"
+        "linux-stable-rc.git")
+    mail["X-KernelTest-Branch"] = "linux-4.4.y"
+    mail["X-KernelTest-PatchCount"] = "99"
+    mail["X-KernelTest-Version"] = "4.4.30-rc1"
+    mail["X-KernelTest-Deadline"] = "2016-11-03T00:00+00:00"
+
+    hunk = "+\tstatic int foo(struct device *dev) { return 0; }\n" * 1000
+    parts = max(1, size // len(hunk))
+    for _ in range(parts):
+        mail.attach(MIMEText(hunk))
+
+    return mail.as_bytes()
+
+
+def _full_parse(path):
+    """Parse the complete message, as done before."""
+    with io.open(path, mode="rb") as read_file:
+        mail = email.message_from_binary_file(read_file)
+    return utils.emails.extract_mail_values(mail)
+
+
+def _headers_parse(path):
+    """Parse only the header block."""
+    return utils.emails.parse_headers(utils.emails.read_headers(path))
+
+
+def _measure(function, path, count):
+    """Measure time per call and peak memory of a parse function."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(count):
+        function(path)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed / count, peak
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--size", type=float, default=5.0, help="Email size in MB")
+    parser.add_argument(
+        "--count", type=int, default=20, help="Parses per measurement")
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+
+    raw = _patch_email(int(args.size * 1024 * 1024))
+    with tempfile.NamedTemporaryFile(delete=False) as write_file:
+        write_file.write(raw)
+
+    try:
+        print("Email size: {0:.2f} MB".format(len(raw) / 1024.0 / 1024.0))
+        for name, function in [
+                ("full MIME parse", _full_parse),
+                ("headers only", _headers_parse)]:
+            per_message, peak = _measure(
+                function, write_file.name, args.count)
+            print(
+                "{0:16s} {1:10.3f} ms/message {2:10.1f} KB peak".format(
+                    name, per_message * 1000.0, peak / 1024.0))
+    finally:
+        os.unlink(write_file.name)
+
+
+if __name__ == "__main__":
+    main()
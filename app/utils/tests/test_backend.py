@@ -0,0 +1,181 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Backend API test module."""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+import requests
+
+import utils.backend
+
+JOB_URL = "https://api.example.org/job"
+BOOT_URL = "https://api.example.org/count/boot"
+
+
+def _response(status_code, data=None, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response.encoding = "utf-8"
+    # pylint: disable=protected-access
+    response._content = json.dumps(data or {}).encode("utf-8")
+    return response
+
+
+class TestBackendCache(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        patcher = unittest.mock.patch.object(
+            utils.backend, "CACHE", utils.backend.ResponseCache())
+        self.addCleanup(patcher.stop)
+        self.cache = patcher.start()
+
+        patcher = unittest.mock.patch("utils.backend.req.get")
+        self.addCleanup(patcher.stop)
+        self.req_get = patcher.start()
+
+        patcher = unittest.mock.patch("time.time")
+        self.addCleanup(patcher.stop)
+        self.time = patcher.start()
+        self.time.return_value = 1000.0
+
+        self.params = [("job", "stable"), ("kernel_version", "4.4.30")]
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def _job(self, status, headers=None):
+        return _response(
+            200, {"count": 1, "result": [{"status": status}]}, headers)
+
+    def _boots(self, count):
+        return _response(200, {"result": [{"count": count}]})
+
+    def test_get_cached(self):
+        self.req_get.return_value = self._boots(1)
+
+        utils.backend.get(BOOT_URL, self.params)
+        response = utils.backend.get(BOOT_URL, list(reversed(self.params)))
+
+        self.assertEqual(1, self.req_get.call_count)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, response.json()["result"][0]["count"])
+        self.assertEqual(1, self.cache.stats()["hits"])
+        self.assertEqual(1, self.cache.stats()["misses"])
+        self.assertEqual(0.5, self.cache.stats()["hit_rate"])
+
+    def test_get_count_boot_ttl(self):
+        pending_ttl, final_ttl = utils.backend.CACHE_TTLS["count/boot"]
+        self.req_get.return_value = self._boots(0)
+        utils.backend.get(BOOT_URL, self.params)
+
+        self.time.return_value += pending_ttl
+        self.req_get.return_value = self._boots(1)
+        utils.backend.get(BOOT_URL, self.params)
+
+        self.time.return_value += final_ttl - 1
+        utils.backend.get(BOOT_URL, self.params)
+
+        self.assertEqual(2, self.req_get.call_count)
+
+    def test_get_job_not_cached_without_validators(self):
+        self.req_get.return_value = self._job("PASS")
+
+        utils.backend.get(JOB_URL, self.params)
+        utils.backend.get(JOB_URL, self.params)
+
+        self.assertEqual(2, self.req_get.call_count)
+        self.assertEqual(0, self.cache.stats()["size"])
+
+    def test_get_job_new_job(self):
+        self.req_get.return_value = self._job("PASS", {"ETag": '"abc"'})
+        utils.backend.get(JOB_URL, self.params)
+
+        # A new job, for the same kernel version, is added.
+        self.req_get.return_value = _response(
+            200,
+            {
+                "count": 2,
+                "result": [{"status": "PASS"}, {"status": "BUILD"}]
+            },
+            {"ETag": '"def"'})
+        response = utils.backend.get(JOB_URL, self.params)
+
+        self.assertEqual(2, response.json()["count"])
+        self.assertDictEqual(
+            {"If-None-Match": '"abc"'}, self.req_get.call_args[1]["headers"])
+        self.assertEqual(0, self.cache.stats()["hits"])
+
+    def test_get_revalidate(self):
+        self.req_get.return_value = self._job(
+            "BUILD", {"ETag": '"abc"', "Last-Modified": "yesterday"})
+        utils.backend.get(JOB_URL, self.params)
+
+        self.req_get.return_value = _response(304)
+        response = utils.backend.get(JOB_URL, self.params)
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("BUILD", response.json()["result"][0]["status"])
+        self.assertDictEqual(
+            {"If-None-Match": '"abc"', "If-Modified-Since": "yesterday"},
+            self.req_get.call_args[1]["headers"])
+        self.assertEqual(1, self.cache.stats()["revalidated"])
+
+        # Job lists are always revalidated.
+        utils.backend.get(JOB_URL, self.params)
+        self.assertEqual(3, self.req_get.call_count)
+        self.assertEqual(2, self.cache.stats()["revalidated"])
+
+    def test_get_errors_not_cached(self):
+        self.req_get.return_value = _response(503)
+
+        utils.backend.get(JOB_URL, self.params)
+        utils.backend.get(JOB_URL, self.params)
+
+        self.assertEqual(2, self.req_get.call_count)
+        self.assertEqual(0, self.cache.stats()["size"])
+
+    def test_lru_eviction(self):
+        self.cache.max_entries = 2
+        self.req_get.return_value = self._boots(1)
+
+        for version in ["1", "2", "1", "3"]:
+            utils.backend.get(BOOT_URL, [("kernel_version", version)])
+
+        self.assertEqual(1, self.cache.stats()["evicted"])
+        self.assertIsNotNone(
+            self.cache.lookup(BOOT_URL + "?kernel_version=1"))
+        self.assertIsNone(self.cache.lookup(BOOT_URL + "?kernel_version=2"))
+
+    def test_dump_load(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        path = os.path.join(path, "cache", "backend.json")
+
+        self.req_get.return_value = self._boots(1)
+        utils.backend.get(BOOT_URL, self.params)
+        self.cache.dump(path)
+
+        cache = utils.backend.ResponseCache()
+        cache.load(path)
+
+        self.assertEqual(1, cache.stats()["size"])
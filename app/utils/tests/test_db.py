@@ -0,0 +1,115 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Database connection test module."""
+
+import logging
+import unittest
+import unittest.mock
+
+import pymongo
+
+import utils
+import utils.db
+
+
+class TestDb(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        patcher = unittest.mock.patch("pymongo.MongoClient")
+        self.addCleanup(patcher.stop)
+        self.client_class = patcher.start()
+        self.client_class.side_effect = lambda **kwargs: \
+            unittest.mock.MagicMock()
+
+        utils.db.close_connection()
+        self.addCleanup(utils.db.close_connection)
+
+        self.options = {
+            utils.DB_SERVER: "db.example.org",
+            utils.DB_SERVER_PORT: "27018",
+            utils.DB_USERNAME: "user",
+            utils.DB_PASSWORD: "secret"
+        }
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_get_connection_options(self):
+        utils.db.get_connection(self.options)
+
+        kwargs = self.client_class.call_args[1]
+        self.assertEqual("db.example.org", kwargs["host"])
+        self.assertEqual(27018, kwargs["port"])
+        self.assertEqual(utils.db.DEFAULT_POOL_SIZE, kwargs["maxPoolSize"])
+        self.assertEqual("user", kwargs["username"])
+        self.assertEqual("secret", kwargs["password"])
+        self.assertIn(utils.db.POOL_STATS, kwargs["event_listeners"])
+
+    def test_get_connection_shared(self):
+        first = utils.db.get_connection(self.options)
+        second = utils.db.get_connection(self.options)
+
+        self.assertIs(first, second)
+        self.assertEqual(1, self.client_class.call_count)
+        first.close.assert_not_called()
+
+    @unittest.mock.patch("os.getpid")
+    def test_get_connection_after_fork(self, mock_getpid):
+        mock_getpid.return_value = 1
+        parent = utils.db.get_connection(self.options)
+        mock_getpid.return_value = 2
+        child = utils.db.get_connection(self.options)
+
+        self.assertIsNot(parent, child)
+        parent.close.assert_not_called()
+
+    @unittest.mock.patch("time.monotonic")
+    def test_get_connection_health_check(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        first = utils.db.get_connection(self.options)
+
+        def ping(command):
+            # pylint: disable=protected-access
+            self.assertFalse(utils.db._lock.locked())
+            raise pymongo.errors.ServerSelectionTimeoutError("down")
+        first.admin.command.side_effect = ping
+
+        mock_monotonic.return_value = 101.0
+        self.assertIs(first, utils.db.get_connection(self.options))
+        first.admin.command.assert_not_called()
+
+        mock_monotonic.return_value = \
+            101.0 + utils.db.HEALTH_CHECK_INTERVAL
+        second = utils.db.get_connection(self.options)
+
+        # Still used by other threads, the client is kept.
+        first.admin.command.assert_called_once_with("ping")
+        first.close.assert_not_called()
+        self.assertIs(first, second)
+
+    def test_pool_stats(self):
+        stats = utils.db.PoolStats()
+        stats.connection_created(None)
+        for _ in range(3):
+            stats.connection_checked_out(None)
+            stats.connection_checked_in(None)
+
+        snapshot = stats.snapshot()
+
+        self.assertEqual(1, snapshot["created"])
+        self.assertEqual(1, snapshot["open"])
+        self.assertEqual(3, snapshot["checked_out"])
+        self.assertEqual(2, snapshot["reused"])
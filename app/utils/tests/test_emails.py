@@ -14,8 +14,13 @@
 """Email utilities test module."""
 
 import datetime
+import email
 import logging
+import os
+import re
+import tempfile
 import unittest
+import unittest.mock
 
 from email.mime.text import MIMEText
 
@@ -159,3 +164,283 @@ class TestEmails(unittest.TestCase):
 
     def test_hack_patches(self):
         self.assertListEqual(["0", "1"], utils.emails.hack_patches_count(0))
+
+    def test_split_headers(self):
+        self.assertEqual(
+            b"Subject: foo\r\nTo: bar\r\n",
+            utils.emails.split_headers(
+                b"Subject: foo\r\nTo: bar\r\n\r\nbody\r\n\r\nmore\r\n"))
+        self.assertEqual(
+            b"Subject: foo\n",
+            utils.emails.split_headers(b"Subject: foo\n\nbody\n"))
+
+    def test_message_id(self):
+        self.assertEqual(
+            "<foo@example.org>",
+            utils.emails.message_id(
+                b"Subject: foo\r\nMessage-ID:\r\n <foo@example.org>\r\n"))
+        self.assertEqual(
+            "<bar@example.org>",
+            utils.emails.message_id(
+                b"X-Message-Id: <foo@example.org>\n"
+                b"message-id: <bar@example.org>\n"))
+        self.assertIsNone(utils.emails.message_id(b"Subject: foo\r\n"))
+
+    def test_read_headers(self):
+        headers = b"Subject: foo\r\nX-Folded: a\r\n b\r\n"
+
+        with tempfile.NamedTemporaryFile(delete=False) as write_file:
+            write_file.write(headers + b"\r\n" + b"body\r\n" * 1000)
+        self.addCleanup(os.unlink, write_file.name)
+
+        self.assertEqual(headers, utils.emails.read_headers(write_file.name))
+
+    def test_parse_from_file(self):
+        mail = MIMEText("foo" * 100000)
+        mail["Subject"] = "[PATCH 4.1 00/45] 4.1.15-stable review"
+        mail["From"] = "Someone <someone@example.org>"
+        mail["Date"] = "Fri, 01 Jan 2016 00:00:00 +0000"
+
+        with tempfile.NamedTemporaryFile(delete=False) as write_file:
+            write_file.write(mail.as_bytes())
+
+        data = utils.emails.parse_from_file(write_file.name)
+
+        self.assertEqual("stable-queue", data["tree"])
+        self.assertFalse(os.path.exists(write_file.name))
+
+    def _raw_messages(self):
+        raw = []
+        for subject in ["[PATCH 4.1 00/45] 4.1.15-stable review", "Lunch?"]:
+            mail = MIMEText("foo")
+            mail["Subject"] = subject
+            mail["From"] = "Someone <someone@example.org>"
+            mail["Date"] = "Fri, 01 Jan 2016 00:00:00 +0000"
+            raw.append(mail.as_bytes())
+
+        return raw * 3
+
+    def test_parse_many_in_process(self):
+        with unittest.mock.patch(
+                "concurrent.futures.ProcessPoolExecutor") as mock_pool:
+            parsed = utils.emails.parse_many(
+                self._raw_messages(), workers=4, threshold=10)
+
+        mock_pool.assert_not_called()
+        self.assertEqual(6, len(parsed))
+        self.assertEqual(3, len([data for data in parsed if data]))
+
+    def test_parse_many_process_pool(self):
+        raw = self._raw_messages()
+        parsed = utils.emails.parse_many(raw, workers=2, threshold=1)
+
+        self.assertListEqual(
+            [utils.emails.parse_bytes(message) for message in raw], parsed)
+
+    def test_parse_pool_start_method(self):
+        with unittest.mock.patch(
+                "concurrent.futures.ProcessPoolExecutor") as mock_pool:
+            utils.emails.parse_pool(2)
+
+        self.assertEqual(
+            "forkserver",
+            mock_pool.call_args[1]["mp_context"].get_start_method())
+
+
+# Messages used to compare the IMAP search criteria with the Python parser.
+SEARCH_CORPUS = [
+    # Stable review cover letter.
+    (
+        "Subject: [PATCH 4.1 00/45] 4.1.15-stable review\n"
+        "Message-Id: <1@example.org>\n"
+    ),
+    # Cover letter with the custom headers.
+    (
+        "Subject: [PATCH 4.6 00/47] 4.6.2-stable review\n"
+        "Message-Id: <2@example.org>\n"
+        "X-KernelTest-Tree: git://git.kernel.org/pub/scm/linux/kernel/git/"
+        "stable/linux-stable-rc.git\n"
+        "X-KernelTest-Branch: linux-4.6.y\n"
+        "X-KernelTest-PatchCount: 47\n"
+        "X-KernelTest-Version: 4.6.2-rc1\n"
+    ),
+    # Custom headers with an unrelated subject.
+    (
+        "Subject: Linux 4.6.2-rc1\n"
+        "Message-Id: <3@example.org>\n"
+        "X-KernelTest-Version: 4.6.2-rc1\n"
+    ),
+    # Custom header without a value.
+    (
+        "Subject: [PATCH 4.4 00/12] 4.4.20-stable review\n"
+        "Message-Id: <4@example.org>\n"
+        "X-KernelTest-Branch: \n"
+    ),
+    # Only one of the reply headers.
+    (
+        "Subject: [PATCH 4.4 00/12] 4.4.20-stable review\n"
+        "Message-Id: <5@example.org>\n"
+        "In-Reply-To: <0@example.org>\n"
+    ),
+    # Empty reply headers.
+    (
+        "Subject: [PATCH 4.4 00/12] 4.4.20-stable review\n"
+        "Message-Id: <6@example.org>\n"
+        "In-Reply-To: \n"
+        "References: \n"
+    ),
+    # Single patch of the series, in reply to the cover letter.
+    (
+        "Subject: [PATCH 4.1 01/45] ext4: fix race\n"
+        "Message-Id: <7@example.org>\n"
+        "In-Reply-To: <1@example.org>\n"
+        "References: <1@example.org>\n"
+    ),
+    # Reply to the cover letter.
+    (
+        "Subject: Re: [PATCH 4.1 00/45] 4.1.15-stable review\n"
+        "Message-Id: <8@example.org>\n"
+        "In-Reply-To: <1@example.org>\n"
+        "References: <1@example.org>\n"
+    ),
+    # Reply to the cover letter, without the reply headers.
+    (
+        "Subject: Re: [PATCH 4.1 00/45] 4.1.15-stable review\n"
+        "Message-Id: <9@example.org>\n"
+    ),
+    # Reply with the custom headers.
+    (
+        "Subject: Re: Linux 4.6.2-rc1\n"
+        "Message-Id: <10@example.org>\n"
+        "In-Reply-To: <3@example.org>\n"
+        "References: <3@example.org>\n"
+        "X-KernelTest-Version: 4.6.2-rc1\n"
+    ),
+    # Patch not for a stable tree.
+    (
+        "Subject: [PATCH v2 3/7] mm: fix something\n"
+        "Message-Id: <11@example.org>\n"
+    ),
+    # Subject with "[PATCH" not at the beginning.
+    (
+        "Subject: FW: [PATCH 4.1 00/45] 4.1.15-stable review\n"
+        "Message-Id: <12@example.org>\n"
+    ),
+    # Unrelated traffic.
+    (
+        "Subject: Lunch?\n"
+        "Message-Id: <13@example.org>\n"
+    ),
+]
+
+SEARCH_TOKEN_RGX = re.compile(r'\(|\)|"[^"]*"|[^\s()]+')
+
+
+def _search_matches(criteria, mail):
+    """Evaluate IMAP SEARCH criteria against a message as RFC 3501 does.
+
+    Only the keys used by the report request criteria are supported.
+    """
+    tokens = SEARCH_TOKEN_RGX.findall(criteria)
+
+    def string():
+        return tokens.pop(0).strip('"').lower()
+
+    def header_contains(name, value):
+        return any(
+            value in header.lower() for header in mail.get_all(name, []))
+
+    def key():
+        token = tokens.pop(0)
+        upper = token.upper()
+
+        if token == "(":
+            result = True
+            while tokens[0] != ")":
+                result = key() and result
+            tokens.pop(0)
+        elif upper == "ALL":
+            result = True
+        elif upper == "NOT":
+            result = not key()
+        elif upper == "OR":
+            first = key()
+            result = key() or first
+        elif upper == "HEADER":
+            name = tokens.pop(0)
+            result = header_contains(name, string())
+        elif upper == "SUBJECT":
+            result = header_contains("Subject", string())
+        else:
+            raise ValueError("Unsupported search key: {0:s}".format(token))
+
+        return result
+
+    matches = True
+    while tokens:
+        matches = key() and matches
+
+    return matches
+
+
+class TestSearchCriteria(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        self.corpus = [
+            email.message_from_string(
+                message + "From: Someone <someone@example.org>\n"
+                "Date: Fri, 01 Jan 2016 00:00:00 +0000\n\nbody\n")
+            for message in SEARCH_CORPUS
+        ]
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_search_criteria_not_looser_than_parser(self):
+        """Every message the parser accepts must match the criteria."""
+        for mail in self.corpus:
+            if utils.emails.extract_mail_values(mail):
+                self.assertTrue(
+                    _search_matches(utils.emails.SEARCH_CRITERIA, mail),
+                    mail["Message-Id"])
+
+    def test_search_criteria_filters_messages(self):
+        matched = [
+            mail["Message-Id"] for mail in self.corpus
+            if _search_matches(utils.emails.SEARCH_CRITERIA, mail)
+        ]
+
+        self.assertListEqual(
+            [
+                "<1@example.org>",
+                "<2@example.org>",
+                "<3@example.org>",
+                "<4@example.org>",
+                "<5@example.org>",
+                "<6@example.org>",
+                "<9@example.org>",
+                "<11@example.org>",
+                "<12@example.org>"
+            ],
+            matched
+        )
+
+    def test_search_criteria_parser_accepted(self):
+        accepted = [
+            mail["Message-Id"] for mail in self.corpus
+            if utils.emails.extract_mail_values(mail)
+        ]
+
+        self.assertListEqual(
+            [
+                "<1@example.org>",
+                "<2@example.org>",
+                "<3@example.org>",
+                "<4@example.org>",
+                "<5@example.org>",
+                "<6@example.org>"
+            ],
+            accepted
+        )
@@ -0,0 +1,111 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""IMAP utilities test module."""
+
+import imaplib
+import logging
+import socket
+import threading
+import unittest
+import unittest.mock
+
+import utils.imap
+
+
+class TestImap(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        self.client_sock, self.server_sock = socket.socketpair()
+        self.addCleanup(self.client_sock.close)
+        self.addCleanup(self.server_sock.close)
+
+        self.server = unittest.mock.Mock()
+        self.server.sock = self.client_sock
+        self.server.send.side_effect = self.client_sock.sendall
+        self.server._new_tag.return_value = b"A1"
+        self.server.tagged_commands = {b"A1": None}
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_has_idle(self):
+        self.server.capabilities = ("IMAP4REV1", "IDLE")
+        self.assertTrue(utils.imap.has_idle(self.server))
+
+        self.server.capabilities = ("IMAP4REV1",)
+        self.assertFalse(utils.imap.has_idle(self.server))
+
+    def test_idle_exists(self):
+        self.server_sock.sendall(
+            b"+ idling\r\n* 3 EXISTS\r\nA1 OK IDLE terminated\r\n")
+
+        self.assertTrue(utils.imap.idle(self.server, 5.0))
+        self.assertEqual(
+            b"A1 IDLE\r\nDONE\r\n", self.server_sock.recv(1024))
+        self.assertDictEqual({}, self.server.tagged_commands)
+
+    def test_idle_timeout(self):
+        self.server_sock.sendall(b"+ idling\r\n* 1 EXPUNGE\r\n")
+
+        def reply():
+            self.server_sock.recv(1024)
+            self.server_sock.sendall(b"A1 OK IDLE terminated\r\n")
+
+        thread = threading.Thread(target=reply)
+        thread.start()
+
+        self.assertFalse(utils.imap.idle(self.server, 0.2))
+        thread.join()
+
+    def test_idle_stop(self):
+        self.server_sock.sendall(b"+ idling\r\nA1 OK IDLE terminated\r\n")
+        stop = threading.Event()
+        stop.set()
+
+        self.assertFalse(utils.imap.idle(self.server, 60.0, stop=stop))
+
+    def test_idle_rejected(self):
+        self.server_sock.sendall(b"A1 BAD Unknown command\r\n")
+
+        self.assertRaises(
+            imaplib.IMAP4.error, utils.imap.idle, self.server, 5.0)
+
+    def test_idle_connection_closed(self):
+        self.server_sock.sendall(b"+ idling\r\n")
+        self.server_sock.shutdown(socket.SHUT_WR)
+
+        self.assertRaises(
+            imaplib.IMAP4.abort, utils.imap.idle, self.server, 5.0)
+
+    @unittest.mock.patch("utils.imap.connect")
+    def test_session_reuse(self, mock_connect):
+        session = utils.imap.Session({})
+
+        self.assertIs(session.connect(), session.connect())
+        self.assertEqual(1, mock_connect.call_count)
+        mock_connect.return_value.noop.assert_called_once_with()
+
+    @unittest.mock.patch("utils.imap.connect")
+    def test_session_reconnect(self, mock_connect):
+        lost = unittest.mock.Mock()
+        lost.noop.side_effect = imaplib.IMAP4.abort("connection lost")
+        mock_connect.side_effect = [lost, self.server]
+
+        session = utils.imap.Session({})
+        session.connect()
+
+        self.assertIs(self.server, session.connect())
+        lost.shutdown.assert_called_once_with()
@@ -0,0 +1,76 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Journal test module."""
+
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import utils.journal
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.path = os.path.join(path, "spool", "journal.sqlite")
+
+        self.journal = utils.journal.Journal()
+        self.addCleanup(self.journal.close)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_disabled(self):
+        self.assertFalse(self.journal.enabled)
+
+    def test_append_peek_remove(self):
+        deadline = datetime.datetime(
+            2016, 1, 1, 12, 30, tzinfo=datetime.timezone.utc)
+        self.journal.open(self.path)
+        self.journal.append([
+            {"message_id": "<1@example.org>", "deadline": deadline},
+            {"message_id": "<2@example.org>", "from": ("Foo", "foo@bar")}
+        ])
+        self.journal.append([{"message_id": "<3@example.org>"}])
+
+        entries = self.journal.peek(2)
+
+        self.assertEqual(2, len(entries))
+        self.assertEqual(deadline, entries[0][1]["deadline"])
+        self.assertListEqual(["Foo", "foo@bar"], entries[1][1]["from"])
+
+        self.journal.remove([entry_id for entry_id, _ in entries])
+
+        self.assertEqual(1, self.journal.count())
+        self.assertEqual(
+            "<3@example.org>", self.journal.peek(10)[0][1]["message_id"])
+
+    def test_reopen(self):
+        self.journal.open(self.path)
+        self.journal.append([{"message_id": "<1@example.org>"}])
+        self.journal.close()
+
+        journal = utils.journal.Journal()
+        self.addCleanup(journal.close)
+        journal.open(self.path)
+
+        self.assertEqual(1, journal.count())
+        self.assertTrue(journal.appended.is_set())
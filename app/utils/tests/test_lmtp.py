@@ -0,0 +1,148 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""LMTP listener test module."""
+
+import logging
+import os
+import shutil
+import smtplib
+import socket
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+import utils.lmtp
+
+MESSAGE = (
+    b"From: Greg KH <gregkh@example.org>\r\n"
+    b"Subject: [PATCH 4.1 00/45] 4.1.15-stable review\r\n"
+    b"\r\n"
+    b".leading dot\r\n"
+)
+
+
+class TestLmtp(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.address = os.path.join(path, "lmtp.sock")
+
+        self.delivered = []
+        self.result = True
+
+        patcher = unittest.mock.patch("utils.lmtp.STOP_POLL", 0.05)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def _deliver(self, message):
+        self.delivered.append(message)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+    def _serve(self, **kwargs):
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=utils.lmtp.serve,
+            args=(self.address, self._deliver, stop),
+            kwargs=kwargs)
+        thread.start()
+
+        def _stop():
+            stop.set()
+            thread.join()
+        self.addCleanup(_stop)
+
+        # The socket file exists before the server listens on it.
+        end = time.monotonic() + 5.0
+        while True:
+            try:
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(self.address)
+                break
+            except OSError:
+                self.assertLess(time.monotonic(), end)
+                time.sleep(0.01)
+
+    def _send(self, client_class=smtplib.LMTP):
+        client = client_class(self.address)
+        try:
+            return client.sendmail(
+                "sender@example.org", ["kernelci@example.org"], MESSAGE)
+        finally:
+            client.quit()
+
+    def test_deliver(self):
+        self._serve()
+
+        self.assertDictEqual({}, self._send())
+        self.assertListEqual([MESSAGE], self.delivered)
+
+    def test_deliver_not_saved(self):
+        self.result = False
+        self._serve()
+
+        with self.assertRaises(smtplib.SMTPDataError) as ex:
+            self._send()
+        self.assertEqual(451, ex.exception.smtp_code)
+
+    def test_deliver_error(self):
+        self.result = RuntimeError("database down")
+        self._serve()
+
+        with self.assertRaises(smtplib.SMTPDataError) as ex:
+            self._send()
+        self.assertEqual(451, ex.exception.smtp_code)
+
+    def test_deliver_timeout(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self._deliver = lambda message: release.wait(5.0)
+        self._serve(timeout=0.1)
+
+        start = time.monotonic()
+        with self.assertRaises(smtplib.SMTPDataError) as ex:
+            self._send()
+        self.assertEqual(451, ex.exception.smtp_code)
+        self.assertLess(time.monotonic() - start, 2.0)
+
+    def test_deliver_too_many_pending(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self._deliver = lambda message: release.wait(5.0)
+        self._serve(timeout=0.1, max_pending=1)
+
+        for _ in range(2):
+            with self.assertRaises(smtplib.SMTPDataError) as ex:
+                self._send()
+            self.assertEqual(451, ex.exception.smtp_code)
+
+        # The first delivery is still being handled.
+        self.assertIn(b"pending", ex.exception.smtp_error)
+
+    def test_deliver_too_big(self):
+        self._serve(max_size=10)
+
+        with self.assertRaises(smtplib.SMTPDataError) as ex:
+            self._send()
+        self.assertEqual(552, ex.exception.smtp_code)
+        self.assertListEqual([], self.delivered)
@@ -0,0 +1,89 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Maildir utilities test module."""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import utils.maildir
+
+
+class TestMaildir(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def _deliver(self, name, content=b"Subject: foo\n\nbar\n"):
+        tmp_path = os.path.join(self.path, "tmp", name)
+        with open(tmp_path, "wb") as write_file:
+            write_file.write(content)
+
+        new_path = os.path.join(self.path, "new", name)
+        os.rename(tmp_path, new_path)
+
+        return new_path
+
+    def test_create(self):
+        self.assertFalse(utils.maildir.is_maildir(self.path))
+        utils.maildir.create(self.path)
+        self.assertTrue(utils.maildir.is_maildir(self.path))
+
+    def test_list_new(self):
+        utils.maildir.create(self.path)
+        new_path = self._deliver("1.host")
+        with open(os.path.join(self.path, "tmp", "2.host"), "wb"):
+            pass
+        with open(os.path.join(self.path, "new", ".hidden"), "wb"):
+            pass
+
+        self.assertListEqual([new_path], utils.maildir.list_new(self.path))
+
+    def test_mark_read(self):
+        utils.maildir.create(self.path)
+        new_path = self._deliver("1.host")
+
+        self.assertTrue(utils.maildir.mark_read(self.path, new_path))
+        self.assertListEqual([], utils.maildir.list_new(self.path))
+        self.assertListEqual(
+            ["1.host:2,S"], os.listdir(os.path.join(self.path, "cur")))
+        self.assertFalse(utils.maildir.mark_read(self.path, new_path))
+
+    def test_watcher(self):
+        utils.maildir.create(self.path)
+        watcher = utils.maildir.Watcher(self.path)
+        self.addCleanup(watcher.close)
+
+        self._deliver("1.host")
+        self.assertTrue(watcher.wait(5.0))
+
+    def test_watcher_ignores_tmp(self):
+        utils.maildir.create(self.path)
+        watcher = utils.maildir.Watcher(self.path)
+        self.addCleanup(watcher.close)
+
+        if watcher.fd is None:
+            self.skipTest("inotify not available")
+
+        with open(os.path.join(self.path, "tmp", "1.host"), "wb"):
+            pass
+        self.assertFalse(watcher.wait(0.1))
@@ -0,0 +1,70 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""mbox splitting test module."""
+
+import logging
+import unittest
+
+import utils.mbox
+
+MBOX = (
+    b"From foo@example.org Fri Jan  1 00:00:00 2016\n"
+    b"Subject: first\n"
+    b"\n"
+    b"body\n"
+    b">From the escaped line\n"
+    b"From the unescaped line, not after an empty line\n"
+    b"\n"
+    b"From bar@example.org Fri Jan  1 00:00:01 2016\n"
+    b"Subject: second\n"
+    b"X-Folded: a\n"
+    b" b\n"
+    b"\n"
+    b"From body line after an empty line\n"
+)
+
+
+class TestMbox(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_messages(self):
+        offsets = list(utils.mbox.messages(MBOX))
+
+        self.assertEqual(3, len(offsets))
+        self.assertTrue(MBOX[offsets[0][0]:].startswith(b"Subject: first"))
+        self.assertTrue(MBOX[offsets[1][0]:].startswith(b"Subject: second"))
+        self.assertEqual(len(MBOX), offsets[2][1])
+        self.assertEqual(offsets[0][1], MBOX.index(b"From bar"))
+
+    def test_messages_empty(self):
+        self.assertListEqual([], list(utils.mbox.messages(b"")))
+
+    def test_headers(self):
+        start, end = list(utils.mbox.messages(MBOX))[1]
+
+        self.assertEqual(
+            b"Subject: second\nX-Folded: a\n b\n",
+            utils.mbox.headers(MBOX, start, end))
+
+    def test_headers_crlf(self):
+        mbox = b"From a\r\nSubject: foo\r\n\r\nbody\r\n"
+        start, end = list(utils.mbox.messages(mbox))[0]
+
+        self.assertEqual(
+            b"Subject: foo\r\n", utils.mbox.headers(mbox, start, end))
@@ -0,0 +1,138 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""public-inbox archives test module."""
+
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import utils.publicinbox
+
+GIT_ENV = {
+    "GIT_AUTHOR_NAME": "a",
+    "GIT_AUTHOR_EMAIL": "a@example.org",
+    "GIT_COMMITTER_NAME": "a",
+    "GIT_COMMITTER_EMAIL": "a@example.org"
+}
+
+
+def _git(repository, *args, **kwargs):
+    env = dict(os.environ)
+    env.update(GIT_ENV)
+    return subprocess.run(
+        ["git", "--git-dir", repository] + list(args),
+        env=env, stdout=subprocess.PIPE, check=True, **kwargs
+    ).stdout.decode().strip()
+
+
+def init_epoch(path, epoch):
+    """Create an empty v2 epoch repository."""
+    repository = os.path.join(path, "git", "{0:d}.git".format(epoch))
+    os.makedirs(repository)
+    _git(repository, "init", "-q", "--bare")
+    return repository
+
+
+def add_message(repository, message, name="m"):
+    """Commit a message as public-inbox does, without a work tree."""
+    blob = _git(repository, "hash-object", "-w", "--stdin", input=message)
+    tree = _git(
+        repository, "mktree",
+        input="100644 blob {0:s}\t{1:s}\n".format(blob, name).encode())
+
+    parent = utils.publicinbox.head(repository)
+    args = ["commit-tree", tree, "-m", "msg"]
+    if parent:
+        args.extend(["-p", parent])
+    commit = _git(repository, *args)
+    _git(repository, "update-ref", "HEAD", commit)
+
+    return commit
+
+
+class TestPublicInbox(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_repositories(self):
+        for epoch in [10, 2, 0]:
+            init_epoch(self.path, epoch)
+        os.makedirs(os.path.join(self.path, "git", "foo"))
+
+        self.assertListEqual(
+            [
+                os.path.join(self.path, "git", "0.git"),
+                os.path.join(self.path, "git", "2.git"),
+                os.path.join(self.path, "git", "10.git")
+            ],
+            utils.publicinbox.repositories(self.path))
+
+    def test_repositories_v1(self):
+        self.assertListEqual(
+            [self.path], utils.publicinbox.repositories(self.path))
+
+    def test_head_empty(self):
+        repository = init_epoch(self.path, 0)
+        self.assertIsNone(utils.publicinbox.head(repository))
+
+    def test_new_messages(self):
+        repository = init_epoch(self.path, 0)
+        first = add_message(repository, b"Subject: 1\n\n")
+        second = add_message(repository, b"Subject: 2\n\n")
+        deleted = add_message(repository, b"Subject: 2\n\n", name="d")
+        third = add_message(repository, b"Subject: 3\n\n")
+
+        commits = utils.publicinbox.new_messages(repository, first, third)
+
+        self.assertListEqual(
+            [second, deleted, third], [commit for commit, _ in commits])
+        self.assertListEqual([], commits[1][1])
+
+        reader = utils.publicinbox.BlobReader(repository)
+        try:
+            self.assertEqual(b"Subject: 2\n\n", reader.read(commits[0][1][0]))
+            self.assertEqual(b"Subject: 3\n\n", reader.read(commits[2][1][0]))
+            self.assertIsNone(reader.read("0" * 40))
+        finally:
+            reader.close()
+
+    def test_new_messages_from_start(self):
+        repository = init_epoch(self.path, 0)
+        first = add_message(repository, b"Subject: 1\n\n")
+
+        commits = utils.publicinbox.new_messages(repository, None, first)
+
+        self.assertEqual(1, len(commits))
+        self.assertEqual(first, commits[0][0])
+
+    def test_has_commit(self):
+        repository = init_epoch(self.path, 0)
+        commit = add_message(repository, b"Subject: 1\n\n")
+
+        self.assertTrue(utils.publicinbox.has_commit(repository, commit))
+        self.assertFalse(utils.publicinbox.has_commit(repository, "0" * 40))
+
+    def test_git_error(self):
+        with self.assertRaises(utils.publicinbox.Error):
+            utils.publicinbox.new_messages(self.path, None, "HEAD")
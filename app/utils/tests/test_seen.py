@@ -0,0 +1,91 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Seen Message-Ids test module."""
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import utils.seen
+
+
+class TestSeen(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_bloom_filter(self):
+        bloom = utils.seen.BloomFilter(capacity=1000, error_rate=0.01)
+        for idx in range(1000):
+            bloom.add("<{0:d}@example.org>".format(idx))
+
+        self.assertTrue(all(
+            "<{0:d}@example.org>".format(idx) in bloom
+            for idx in range(1000)))
+
+        false_positives = sum(
+            "<{0:d}@example.net>".format(idx) in bloom
+            for idx in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_bloom_filter_dump_load(self):
+        path = os.path.join(self.path, "seen.bloom")
+        bloom = utils.seen.BloomFilter(capacity=100)
+        bloom.add("<foo@example.org>")
+        bloom.dump(path)
+
+        loaded = utils.seen.BloomFilter.load(path)
+
+        self.assertEqual(bloom.size, loaded.size)
+        self.assertEqual(bloom.hashes, loaded.hashes)
+        self.assertIn("<foo@example.org>", loaded)
+        self.assertNotIn("<bar@example.org>", loaded)
+
+    def test_seen_set_disabled(self):
+        seen = utils.seen.SeenSet()
+
+        self.assertFalse(seen.enabled)
+        self.assertTrue(seen.might_contain("<foo@example.org>"))
+
+    def test_seen_set_rebuild_dump_load(self):
+        path = os.path.join(self.path, "cache", "seen.bloom")
+        seen = utils.seen.SeenSet()
+        seen.rebuild(["<foo@example.org>", None], capacity=100)
+        seen.add(["<bar@example.org>"])
+        seen.dump(path)
+
+        loaded = utils.seen.SeenSet()
+        self.assertTrue(loaded.load(path))
+        self.assertTrue(loaded.might_contain("<foo@example.org>"))
+        self.assertTrue(loaded.might_contain("<bar@example.org>"))
+        self.assertFalse(loaded.might_contain("<baz@example.org>"))
+
+    def test_seen_set_load_invalid(self):
+        path = os.path.join(self.path, "seen.bloom")
+        with open(path, "wb") as write_file:
+            write_file.write(b"not a filter")
+
+        seen = utils.seen.SeenSet()
+
+        self.assertFalse(seen.load(path))
+        self.assertFalse(seen.load(os.path.join(self.path, "missing")))
+        self.assertFalse(seen.enabled)
@@ -0,0 +1,84 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Timer heap test module."""
+
+import unittest
+
+import utils.timers
+
+
+class TestTimerHeap(unittest.TestCase):
+
+    def setUp(self):
+        self.timers = utils.timers.TimerHeap()
+
+    def test_pop_due_order(self):
+        self.timers.schedule("c", 30)
+        self.timers.schedule("a", 10)
+        self.timers.schedule("b", 20)
+
+        self.assertListEqual(["a", "b"], self.timers.pop_due(20))
+        self.assertEqual(1, len(self.timers))
+        self.assertEqual(30, self.timers.next_due())
+
+    def test_reschedule(self):
+        self.timers.schedule("a", 10)
+        self.timers.schedule("b", 20)
+        self.timers.schedule("a", 30)
+
+        self.assertEqual(20, self.timers.next_due())
+        self.assertListEqual(["b"], self.timers.pop_due(25))
+        self.assertListEqual(["a"], self.timers.pop_due(30))
+        self.assertIsNone(self.timers.next_due())
+
+    def test_cancel(self):
+        self.timers.schedule("a", 10)
+        self.timers.schedule("b", 20)
+
+        self.timers.cancel("a")
+        self.timers.cancel("missing")
+
+        self.assertNotIn("a", self.timers)
+        self.assertEqual(20, self.timers.next_due())
+        self.assertListEqual(["b"], self.timers.pop_due(100))
+
+    def test_schedule_same_due(self):
+        self.timers.schedule("a", 10)
+        self.timers.schedule("a", 10)
+
+        self.assertListEqual(["a"], self.timers.pop_due(10))
+        self.assertEqual(0, len(self.timers))
+        self.assertListEqual([], self.timers.pop_due(10))
+
+    def test_due_time(self):
+        self.timers.schedule("a", 10)
+        self.timers.schedule("a", 30)
+
+        self.assertEqual(30, self.timers.due_time("a"))
+        self.assertIsNone(self.timers.due_time("missing"))
+
+    def test_rebuild(self):
+        self.timers.schedule("a", 10)
+        self.timers.schedule("b", 20)
+        mark = self.timers.mark()
+        # Scheduled while the new due times are collected.
+        self.timers.schedule("b", 50)
+        self.timers.schedule("c", 40)
+
+        self.timers.rebuild({"b": 25, "d": 5}, mark)
+
+        self.assertNotIn("a", self.timers)
+        self.assertEqual(50, self.timers.due_time("b"))
+        self.assertEqual(40, self.timers.due_time("c"))
+        self.assertListEqual(["d", "c", "b"], self.timers.pop_due(100))
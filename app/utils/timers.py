@@ -0,0 +1,144 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Due times of keys, kept in a heap."""
+
+import heapq
+import itertools
+import threading
+
+
+class TimerHeap(object):
+    """Thread safe set of keys, each one with the time it is due at.
+
+    Scheduling a key again replaces its due time: the old heap entry is left
+    in place and skipped when it reaches the top.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        # The due time and the heap entry serial number of each key.
+        self.due = {}
+        # Orders the entries with the same due time, keys are not compared.
+        self.counter = itertools.count()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.due)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.due
+
+    def _push(self, key, due):
+        """Add a heap entry, the lock must be held."""
+        serial = next(self.counter)
+        self.due[key] = (due, serial)
+        heapq.heappush(self.heap, (due, serial, key))
+
+    def schedule(self, key, due):
+        """Set when a key is due.
+
+        :param key: The key.
+        :param due: When the key is due.
+        """
+        with self.lock:
+            self._push(key, due)
+
+    def cancel(self, key):
+        """Remove a key, if scheduled.
+
+        :param key: The key.
+        """
+        with self.lock:
+            self.due.pop(key, None)
+
+    def due_time(self, key):
+        """Get when a key is due.
+
+        :param key: The key.
+        :return The due time, or None if the key is not scheduled.
+        """
+        with self.lock:
+            entry = self.due.get(key, None)
+            return entry[0] if entry else None
+
+    def mark(self):
+        """Get a mark to rebuild the heap from, see rebuild().
+
+        :return int The mark.
+        """
+        with self.lock:
+            return next(self.counter)
+
+    def rebuild(self, due_times, mark):
+        """Replace all the keys, keeping those scheduled after a mark.
+
+        Keys scheduled while the new due times were being collected are more
+        recent than them, and are kept.
+
+        :param due_times: The due time of each key.
+        :type due_times: dict
+        :param mark: The mark taken before collecting the due times.
+        :type mark: int
+        """
+        with self.lock:
+            recent = dict(
+                (key, entry) for key, entry in self.due.items()
+                if entry[1] > mark)
+
+            self.heap = []
+            self.due = {}
+            for key, due in due_times.items():
+                if key not in recent:
+                    self._push(key, due)
+            for key, (due, serial) in recent.items():
+                self.due[key] = (due, serial)
+                self.heap.append((due, serial, key))
+            heapq.heapify(self.heap)
+
+    def _drop_stale(self):
+        """Remove the replaced or canceled entries from the top."""
+        while self.heap:
+            due, serial, key = self.heap[0]
+            if self.due.get(key, None) == (due, serial):
+                break
+            heapq.heappop(self.heap)
+
+    def next_due(self):
+        """Get the earliest due time.
+
+        :return The due time, or None if no key is scheduled.
+        """
+        with self.lock:
+            self._drop_stale()
+            return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """Remove and get the keys due at or before a time.
+
+        :param now: The time.
+        :return list The keys, the earliest due first.
+        """
+        keys = []
+
+        with self.lock:
+            self._drop_stale()
+            while self.heap and self.heap[0][0] <= now:
+                _, _, key = heapq.heappop(self.heap)
+                del self.due[key]
+                keys.append(key)
+                self._drop_stale()
+
+        return keys